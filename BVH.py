@@ -3,24 +3,47 @@ import math
 import sys
 from typing import Optional
 from collections import deque
+from multiprocessing import Pool
 import random
+import time
 import glm
+import numpy as np
 import pygame
 
 from Objects import * 
 
-class BVHNode:
-    def __init__(self, boundingVolume: AABB):
-        self.boundingVolume = boundingVolume
-        self.leafNodes = []
-
 class BVHPrimitive:
+    __slots__ = ("bounds", "centroid", "object")
+
     def __init__(self, obj):
         self.bounds = AABB(obj=obj)
         self.centroid = self.bounds.Centroid
         self.object = obj
 
 
+# objectData of a tree built from a SphereSet. a primitive is made when it is
+# asked for rather than one per sphere up front, inserted ones are kept as usual
+class SpherePrimitives:
+    def __init__(self, spheres: SphereSet):
+        self.spheres = spheres
+        self.inserted = []
+
+    def __len__(self) -> int:
+        return len(self.spheres) + len(self.inserted)
+
+    def __getitem__(self, index: int) -> BVHPrimitive:
+        if index < len(self.spheres):
+            return BVHPrimitive(self.spheres[index])
+
+        return self.inserted[index - len(self.spheres)]
+
+    def __iter__(self):
+        return (self[i] for i in range(len(self)))
+
+    def append(self, primitive: BVHPrimitive):
+        self.inserted.append(primitive)
+
+
 def CalculateSAH(volumeA: AABB, volumeB: AABB, outerVolume: AABB, 
                  traversalTime: float, objectIntersectTime: float, 
                  objectsA: list, objectsB: list) -> float:
@@ -48,16 +71,50 @@ def CalculateSAHL(volumeA: AABB, volumeB: AABB, outerVolume: AABB,
 def CalculateSAHLowerBound(inheritedCost: float, outerBounds, primtive, primitiveCount) -> float:
     return inheritedCost + (primtive.bounds.SurfaceArea / outerBounds.SurfaceArea) * primitiveCount
 
+# the reciprocal is divided in double precision and stored as a vec3, the
+# same float32 values ReciprocalDirections gives for the batched paths
 class Ray:
+    __slots__ = ("origin", "direction", "directionReciprocal")
+
     def __init__(self, origin, direction):
         self.origin = origin
         self.direction = glm.normalize(direction)
-        copy = [sys.float_info.epsilon if x == 0 else x for x in self.direction]
-        self.directionReciprocal = [1 / x for x in copy]
+
+        x, y, z = self.direction
+        epsilon = sys.float_info.epsilon
+
+        self.directionReciprocal = glm.vec3(1 / (x or epsilon), 1 / (y or epsilon), 1 / (z or epsilon))
 
 def RayBoxIntersection(ray: Ray, box: AABB) -> float:
-    tminVec = (box.minn - ray.origin) * ray.directionReciprocal
-    tmaxVec = (box.maxx - ray.origin) * ray.directionReciprocal
+    return RayBoundsIntersection(ray, box.minn, box.maxx)
+
+def RayBoundsIntersection(ray: Ray, minn: glm.vec3, maxx: glm.vec3) -> float:
+    slabs = RaySlabs(ray, minn, maxx)
+
+    if slabs is None:
+        return -1.0
+
+    tmin, tmax = slabs
+
+    if tmin >= 0:
+        return tmin
+
+    return tmax
+
+# distance along the ray at which it enters the box, 0 when the origin is 
+# inside it and -1 on a miss
+def RayBoundsEntry(ray: Ray, minn: glm.vec3, maxx: glm.vec3) -> float:
+    slabs = RaySlabs(ray, minn, maxx)
+
+    if slabs is None:
+        return -1.0
+
+    return max(slabs[0], 0.0)
+
+# parametric range (tmin, tmax) of the ray within the box, None on a miss
+def RaySlabs(ray: Ray, minn: glm.vec3, maxx: glm.vec3):
+    tminVec = (minn - ray.origin) * ray.directionReciprocal
+    tmaxVec = (maxx - ray.origin) * ray.directionReciprocal
 
     tmin, tymin, tzmin = tminVec.x, tminVec.y, tminVec.z
     tmax, tymax, tzmax = tmaxVec.x, tmaxVec.y, tmaxVec.z
@@ -69,7 +126,7 @@ def RayBoxIntersection(ray: Ray, box: AABB) -> float:
         tymin, tymax = tymax, tymin
  
     if (tmin > tymax) or (tymin > tmax):
-        return -1.0
+        return None
  
     if (tymin > tmin): 
         tmin = tymin
@@ -81,15 +138,12 @@ def RayBoxIntersection(ray: Ray, box: AABB) -> float:
         tzmin, tzmax = tzmax, tzmin
  
     if (tmin > tzmax) or (tzmin > tmax):
-        return -1.0 
+        return None 
 
     if tmin < 0 and tmax < 0:
-        return -1.0
-
-    if tmin >= 0:
-        return tmin
+        return None
 
-    return tmax
+    return (tmin, tmax)
 
 def RaySphereIntersection(ray: Ray, sphere: Sphere):
     oc = ray.origin - sphere.center
@@ -115,181 +169,759 @@ def RaySphereIntersection(ray: Ray, sphere: Sphere):
         return (max(root1, root2), sphere.index)
 
 
+# the batched versions below follow the scalar functions step for step
+# (float32 vector maths, float64 for the quadratic) so TraceRays and
+# TraceRay agree exactly on the same rays.
+
+def _Dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    product = a * b
+    return (product[..., 0] + product[..., 1]) + product[..., 2]
+
+def NormalizeDirections(directions: np.ndarray) -> np.ndarray:
+    directions = np.asarray(directions, dtype=np.float32).reshape(-1, 3)
+    return directions * (np.float32(1) / np.sqrt(_Dot(directions, directions)))[:, None]
+
+def ReciprocalDirections(directions: np.ndarray) -> np.ndarray:
+    directions = directions.astype(np.float64)
+    directions[directions == 0] = sys.float_info.epsilon
+    return (1 / directions).astype(np.float32)
+
+# returns (hit, tmin, tmax) per ray/box pair, tmin and tmax are the same
+# values RayBoxIntersection compares (the z slab only rejects, like there).
+def RayBoxIntersections(origins: np.ndarray, reciprocals: np.ndarray, minn: np.ndarray, maxx: np.ndarray):
+    tminVec = (minn - origins) * reciprocals
+    tmaxVec = (maxx - origins) * reciprocals
+
+    lower = np.minimum(tminVec, tmaxVec)
+    upper = np.maximum(tminVec, tmaxVec)
+
+    tmin, tymin, tzmin = lower[:, 0], lower[:, 1], lower[:, 2]
+    tmax, tymax, tzmax = upper[:, 0], upper[:, 1], upper[:, 2]
+
+    hit = (tmin <= tymax) & (tymin <= tmax)
+
+    tmin = np.maximum(tmin, tymin)
+    tmax = np.minimum(tmax, tymax)
+
+    hit &= (tmin <= tzmax) & (tzmin <= tmax)
+    hit &= (tmin >= 0) | (tmax >= 0)
+
+    return hit, tmin, tmax
+
+def RaySphereIntersections(origins: np.ndarray, directions: np.ndarray, centers: np.ndarray, radii: np.ndarray) -> np.ndarray:
+    oc = origins - centers
+
+    a = _Dot(directions, directions).astype(np.float64)
+    b = 2 * _Dot(directions, oc).astype(np.float64)
+    c = _Dot(oc, oc).astype(np.float64) - radii ** 2
+
+    discriminant = (b * b) - (4 * a * c)
+    root = np.sqrt(np.maximum(discriminant, 0))
+
+    root1 = (-b + root) / (2 * a)
+    root2 = (-b - root) / (2 * a)
+
+    distances = np.where((root1 >= 0) & (root2 >= 0), np.minimum(root1, root2), np.maximum(root1, root2))
+    distances[(discriminant < 0) | ((root1 < 0) & (root2 < 0))] = -1
+
+    return distances
+
+# distances from points to boxes, 0 inside them, in double precision. an empty
+# box (minn inf) is infinitely far
+def PointBoxDistances(points: np.ndarray, minn: np.ndarray, maxx: np.ndarray) -> np.ndarray:
+    points = points.astype(np.float64)
+    outside = np.maximum(np.maximum(minn - points, points - maxx), 0)
+    return np.sqrt(_Dot(outside, outside))
+
+# PointBoxDistances for one point and box of vec3s, in python floats so it
+# gives the same doubles
+def PointBoundsDistance(point: glm.vec3, minn: glm.vec3, maxx: glm.vec3) -> float:
+    x = max(minn.x - point.x, point.x - maxx.x, 0.0)
+    y = max(minn.y - point.y, point.y - maxx.y, 0.0)
+    z = max(minn.z - point.z, point.z - maxx.z, 0.0)
+
+    return math.sqrt(x * x + y * y + z * z)
+
+
+def SurfaceAreas(minn: np.ndarray, maxx: np.ndarray) -> np.ndarray:
+    diagonal = np.maximum(maxx.astype(np.float64) - minn, 0)
+    x, y, z = diagonal[..., 0], diagonal[..., 1], diagonal[..., 2]
+    return 2 * (x * y + x * z + y * z)
+
+def _SpreadBits(values: np.ndarray) -> np.ndarray:
+    values = values.astype(np.uint64)
+
+    for shift, mask in ((32, 0x1f00000000ffff), (16, 0x1f0000ff0000ff), (8, 0x100f00f00f00f00f), 
+                        (4, 0x10c30c30c30c30c3), (2, 0x1249249249249249)):
+        values = (values | (values << np.uint64(shift))) & np.uint64(mask)
+
+    return values
+
+# interleaved bits of the points quantized inside [minn, maxx], 10 bits per axis
+# for 30 bit codes and 21 for 63 bit ones. sorting by code orders the points
+# along a Z-order curve.
+def MortonCodes(points: np.ndarray, minn: np.ndarray, maxx: np.ndarray, bits: int = 30) -> np.ndarray:
+    axisBits = bits // 3
+    extent = np.maximum(maxx - minn, np.finfo(np.float32).tiny).astype(np.float64)
+
+    quantized = (points - minn) / extent * ((1 << axisBits) - 1)
+    quantized = np.clip(quantized, 0, (1 << axisBits) - 1).astype(np.uint64)
+
+    spread = _SpreadBits(quantized)
+
+    return (spread[:, 0] << np.uint64(2)) | (spread[:, 1] << np.uint64(1)) | spread[:, 2]
+
+# traversal counters are summed into a caller supplied dict, if any
+def _AddStatistics(statistics, counts: dict):
+    if statistics is None:
+        return
+
+    for key, value in counts.items():
+        statistics[key] = statistics.get(key, 0) + value
+
+# process pool entry point of BuildSAHParallel, builds a tree over the given
+# primitive bounds and returns its trimmed arrays
+def _BuildSubtree(task):
+    primitiveMin, primitiveMax, primitiveCentroid, settings = task
+    count = len(primitiveMin)
+
+    bvh = BVH(capacity=max(2 * count - 1, 1))
+
+    for name, value in settings.items():
+        setattr(bvh, name, value)
+
+    bvh._ReservePrimitives(count)
+    bvh.primitiveMin[:count] = primitiveMin
+    bvh.primitiveMax[:count] = primitiveMax
+    bvh.primitiveCentroid[:count] = primitiveCentroid
+
+    bvh.BuildSAH(0, np.arange(count, dtype=np.int32))
+
+    nodeCount = bvh.nodeCount
+
+    return (bvh.nodeMin[:nodeCount], bvh.nodeMax[:nodeCount], bvh.leftChild[:nodeCount], 
+            bvh.rightChild[:nodeCount], bvh.parent[:nodeCount], bvh.primitiveOffset[:nodeCount], 
+            bvh.primitiveCount[:nodeCount], bvh.primitiveIndices[:count])
+
+def _GrowArray(array: np.ndarray, capacity: int, fill) -> np.ndarray:
+    grown = np.full((capacity,) + array.shape[1:], fill, dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+# one node of the flattened tree Shaders/BVH.glsl traverses, the std430 layout
+# of its BVHNode struct. see BVH.Flatten
+GPU_NODE = np.dtype([
+    ("min", "<f4", 3),
+    ("leftFirst", "<i4"),
+    ("max", "<f4", 3),
+    ("count", "<i4")
+])
+
+
+# nodes are stored as a struct of arrays, a node is just an index into them.
+# inner nodes always have two children, leaves have leftChild == -1 and
+# reference the range [primitiveOffset, primitiveOffset + primitiveCount)
+# of primitiveIndices, which in turn indexes objectData.
+
 class BVH:
-    def __init__(self):
-        self.nodes = [BVHNode(AABB())]
-        self.objectData = []
+    def __init__(self, capacity: int = 16):
         self.threshold = 3
+        self.binCount = 16
+        self.traversalCost = 1
+        self.intersectionCost = 2
+        self.mortonBits = 30
+        self.parallelLevels = 6
+        self.rebuildThreshold = 1.3
+        self.rotationBatch = 4096
+        self.buildStatistics = {}
+        self.updateStatistics = {}
+
+        self.objectData = []
+        self.primitiveMin = np.zeros((capacity, 3), dtype=np.float32)
+        self.primitiveMax = np.zeros((capacity, 3), dtype=np.float32)
+        self.primitiveCentroid = np.zeros((capacity, 3), dtype=np.float32)
+        self.primitiveMorton = np.zeros(0, dtype=np.uint64)
+
+        self.nodeCount = 0
+        self.nodeMin = np.full((capacity, 3), np.inf, dtype=np.float32)
+        self.nodeMax = np.full((capacity, 3), -np.inf, dtype=np.float32)
+        self.leftChild = np.full(capacity, -1, dtype=np.int32)
+        self.rightChild = np.full(capacity, -1, dtype=np.int32)
+        self.parent = np.full(capacity, -1, dtype=np.int32)
+        self.primitiveOffset = np.zeros(capacity, dtype=np.int32)
+        self.primitiveCount = np.zeros(capacity, dtype=np.int32)
+
+        self.primitiveIndexCount = 0
+        self.primitiveIndices = np.zeros(capacity, dtype=np.int32)
+
+        # nodes that Remove and partial rebuilds cut loose, empty leaves no
+        # longer reachable from the root. a full rebuild reclaims them
+        self.orphanCount = 0
+
+        # SAH cost and node areas right after the last build, what Update
+        # measures drift against
+        self.builtSAHCost = 0.0
+        self._builtAreas = np.zeros(0)
+
+        # costs and moves of the last Optimize call, and where its sweep
+        # stopped
+        self.optimizeStatistics = {}
+        self._optimizeDepth = None
+        self._levelOffset = 0
+        self._reinsertQueue = None
+        self._sweepMoves = 0
+        self._reinsertFraction = 0.01
+
+        self._sphereArrays = None
+        self._nodeBoxes = None
+
+        self._AllocateNode()
+
+    def Clear(self):
+        self.objectData = []
+
+        self.nodeCount = 0
+        self.nodeMin[:] = np.inf
+        self.nodeMax[:] = -np.inf
+        self.leftChild[:] = -1
+        self.rightChild[:] = -1
+        self.parent[:] = -1
+        self.primitiveOffset[:] = 0
+        self.primitiveCount[:] = 0
+
+        self.primitiveIndexCount = 0
+        self.orphanCount = 0
+
+        self.builtSAHCost = 0.0
+        self._builtAreas = np.zeros(0)
+        self._optimizeDepth = None
+        self._levelOffset = 0
+        self._reinsertQueue = None
+        self._sweepMoves = 0
+        self._reinsertFraction = 0.01
+
+        self._sphereArrays = None
+        self._nodeBoxes = None
+
+        self._AllocateNode()
     
-    def Build(self, objects):
-        self.nodes.clear()
-        self.objectData.clear()
+    # method picks the builder: "sah" for binned SAH splits everywhere, "lbvh"
+    # for splits on the Morton order of the centroids, "hybrid" for those splits
+    # with leaves chosen by SAH cost as in "sah". passing workers 
+    # builds SAH trees in parallel, see BuildSAHParallel. objects is a list of
+    # spheres or a SphereSet, whose bounds are taken in one go.
+    def Build(self, objects, method: str = "sah", workers: int = None):
+        if method not in ("sah", "lbvh", "hybrid"):
+            raise ValueError(f"unknown build method '{method}'")
+
+        start = time.perf_counter()
+
+        self.Clear()
+
+        if isinstance(objects, SphereSet):
+            self.objectData = SpherePrimitives(objects)
+
+            count = len(objects)
+            self._ReservePrimitives(count)
 
-        newObjects = [BVHPrimitive(obj) for obj in objects]
+            self.primitiveMin[:count], self.primitiveMax[:count] = objects.Bounds()
+        else:
+            self.objectData.extend(BVHPrimitive(obj) for obj in objects)
+
+            count = len(self.objectData)
+            self._ReservePrimitives(count)
+
+            self.primitiveMin[:count] = [p.bounds.minn.to_list() for p in self.objectData]
+            self.primitiveMax[:count] = [p.bounds.maxx.to_list() for p in self.objectData]
+
+        self.primitiveCentroid[:count] = (self.primitiveMin[:count] + self.primitiveMax[:count]) / 2
 
-        bounds = AABB()
-        for newObj in newObjects:
-            bounds.Grow(newObj.bounds)
+        # a binary tree with a leaf per primitive is the worst case
+        self._ReserveNodes(max(2 * count - 1, 1))
+        self._ReservePrimitiveIndices(count)
+
+        setupTime = time.perf_counter() - start
         
-        self.BuildSAH(0, newObjects, bounds)
+        if method == "sah" and workers is not None:
+            self.BuildSAHParallel(0, np.arange(count, dtype=np.int32), workers)
+        elif method == "sah":
+            self.BuildSAH(0, np.arange(count, dtype=np.int32))
+        else:
+            self.BuildLBVH(0, np.arange(count, dtype=np.int32), method == "hybrid")
+
+        self.buildStatistics = {
+            "method": method,
+            "workers": workers,
+            "primitives": count,
+            "nodes": self.nodeCount,
+            "setupTime": setupTime,
+            "buildTime": time.perf_counter() - start - setupTime,
+            "sahCost": self.SAHCost()
+        }
+
+        self._MarkBuilt(self.buildStatistics["sahCost"])
 
     def Insert(self, object_):
         primitive = BVHPrimitive(object_)
+        self._InsertPrimitive(primitive, self._AddPrimitive(primitive))
 
-        self.nodes[0].boundingVolume.Grow(primitive.bounds)
+    # puts objectData[index] into the tree with its bounds read again: one
+    # Remove took out, or a sphere its SphereSet gained after the build
+    def InsertIndex(self, index: int):
+        self._ReservePrimitives(index + 1)
+        self._ReadPrimitiveBounds(np.array([index], dtype=np.int32))
+
+        self._InsertPrimitive(self.objectData[index], index)
+
+    def _InsertPrimitive(self, primitive, primitiveIndex: int):
+        self._GrowNode(0, primitive.bounds)
 
         queue = deque([(0, 0)])
         bestCost = float("inf")
-
-        nodeIndex = -1
+        bestNodeIndex = 0
     
         while queue:
             nodeIndex, inheritedCost = queue.popleft()            
-            cost = CalculateSAHLowerBound(inheritedCost, self.nodes[nodeIndex].boundingVolume, 
-                                          primitive, len(self.nodes[nodeIndex].leafNodes) + 1)
+            cost = CalculateSAHLowerBound(inheritedCost, self.NodeBounds(nodeIndex), 
+                                          primitive, self.primitiveCount[nodeIndex] + 1)
             
             if cost > bestCost:
                 continue
 
-            bestCost = cost 
+            if self.IsLeaf(nodeIndex):
+                bestCost = cost
+                bestNodeIndex = nodeIndex
+                continue
 
-            if self._LeftChildExists(nodeIndex):
-                queue.append((self._GetLeftNodeIndex(nodeIndex),  inheritedCost + cost))
+            queue.append((self.leftChild[nodeIndex],  inheritedCost + cost))
+            queue.append((self.rightChild[nodeIndex], inheritedCost + cost))
 
-            if self._RightChildExists(nodeIndex):
-                queue.append((self._GetRightNodeIndex(nodeIndex), inheritedCost + cost))
-        
-        if not self._TryInsert(nodeIndex, primitive):
-            self.SplitAndPush(nodeIndex, primitive)
+        nodeIndex = bestNodeIndex
 
-        while nodeIndex != 0:
-            nodeIndex = self._GetParentNodeIndex(nodeIndex)
-            self.nodes[nodeIndex].boundingVolume.Grow(primitive.bounds)
+        if self.primitiveCount[nodeIndex] < self.threshold:
+            self._SetLeaf(nodeIndex, np.append(self.LeafPrimitives(nodeIndex), primitiveIndex))
+        else:
+            self.SplitAndPush(nodeIndex, primitiveIndex=primitiveIndex)
+
+        while nodeIndex != -1:
+            self._GrowNode(nodeIndex, primitive.bounds)
+            nodeIndex = self.parent[nodeIndex]
+
+    # recomputes bounds after primitives moved. changedIndices index objectData
+    # (all of it when None) and their objects are read again, spheres of a
+    # SphereSet from its columns and anything else through AABB. the leaves
+    # holding them are refitted, then their ancestors a level at a time until
+    # no box changes. the tree keeps its shape, Update rebuilds it when that
+    # gets too expensive to trace.
+    def Refit(self, changedIndices=None):
+        if changedIndices is None:
+            changedIndices = np.arange(len(self.objectData))
+
+        changedIndices = np.unique(np.asarray(changedIndices, dtype=np.int32))
+
+        if not len(changedIndices):
+            return
+
+        self._ReadPrimitiveBounds(changedIndices)
+
+        leaves = self._PrimitiveLeaves()[changedIndices]
+        self._RefitNodes(np.unique(leaves[leaves >= 0]))
+
+    # takes objectData[index] out of the tree. indices are not shifted, the
+    # primitive keeps its slot in objectData and is never hit again. a leaf
+    # left empty is folded away, its parent takes over the sibling
+    def Remove(self, index: int):
+        nodeIndex = self._FindLeaf(index)
+
+        if nodeIndex is None:
+            raise ValueError(f"primitive {index} is not in the tree")
+
+        objects = self.LeafPrimitives(nodeIndex)
+        objects = objects[objects != index]
+
+        offset = self.primitiveOffset[nodeIndex]
+        self.primitiveIndices[offset:offset + len(objects)] = objects
+        self.primitiveCount[nodeIndex] = len(objects)
+
+        nodes = [nodeIndex]
+
+        # the parent already holds the sibling's box, refitting has to start
+        # above it
+        if not len(objects) and self.parent[nodeIndex] >= 0:
+            nodes = [self._FoldIntoParent(nodeIndex)]
+            nodes += [self.parent[nodes[0]]] if self.parent[nodes[0]] >= 0 else []
+
+        self._RefitNodes(np.array(nodes, dtype=np.int32))
+
+    # Refit, then a check of the tree's quality. once the SAH cost is more than
+    # rebuildThreshold times what it was after the last build, the subtrees
+    # whose boxes grew the most are rebuilt, or the whole tree when they hold
+    # most of it or too many nodes were cut loose. returns "refit", "partial"
+    # or "full", updateStatistics has the timings and costs
+    def Update(self, changedIndices=None) -> str:
+        start = time.perf_counter()
+
+        self.Refit(changedIndices)
+
+        refitTime = time.perf_counter() - start
+        cost = self.SAHCost()
+        kind = "refit"
+
+        if cost > self.rebuildThreshold * self.builtSAHCost:
+            kind = self._RebuildDrifted()
+            cost = self.SAHCost()
+
+            if kind == "partial" and cost > self.rebuildThreshold * self.builtSAHCost:
+                self.Rebuild()
+                kind, cost = "full", self.builtSAHCost
+
+        self.updateStatistics = {
+            "rebuild": kind,
+            "refitTime": refitTime,
+            "updateTime": time.perf_counter() - start,
+            "sahCost": cost,
+            "builtSAHCost": self.builtSAHCost
+        }
+
+        return kind
+
+    # a fresh SAH build over the primitives in the tree from their current
+    # bounds, objectData is kept as it is
+    def Rebuild(self):
+        objects, _, _ = self._GatherRanges(self._Leaves())
+        objects = objects.copy()
+
+        self.nodeCount = 0
+        self.primitiveIndexCount = 0
+        self.orphanCount = 0
+
+        self._AllocateNode()
+        self.BuildSAH(0, objects)
+
+        self._MarkBuilt(self.SAHCost())
+
+    # lowers the SAH cost for at most timeBudget seconds. a sweep first rotates
+    # every level from the deepest up, swapping a child of a node with a
+    # grandchild, or two grandchildren, when that shrinks the boxes in between.
+    # rotations only reach so far, so the sweep then takes out the nodes that
+    # waste the most area and reinserts each where it costs least. a sweep
+    # that runs out of time carries on in the next call, so a few milliseconds
+    # between frames clean up a tree grown by Insert. stops early once a
+    # whole sweep changes nothing. returns the number of nodes moved,
+    # optimizeStatistics has the SAH cost before and after
+    def Optimize(self, timeBudget: float = 0.005) -> int:
+        start = time.perf_counter()
+
+        sahBefore = self.SAHCost()
+        levels = None
+        rotations = reinsertions = 0
+        converged = bool(self.leftChild[0] < 0)
+
+        while not converged and time.perf_counter() - start < timeBudget:
+            if self._optimizeDepth is None and self._reinsertQueue is None:
+                levels = self._InnerLevels()
+                self._optimizeDepth, self._sweepMoves = len(levels) - 1, 0
+
+            if self._optimizeDepth is not None:
+                # rotations keep the levels above them as they were. a level
+                # goes rotationBatch nodes at a time to stay within the budget
+                levels = self._InnerLevels() if levels is None else levels
+                depth = min(self._optimizeDepth, len(levels) - 1)
+                offset = self._levelOffset
+
+                count = self._RotateLevel(levels[depth][offset:offset + self.rotationBatch])
+                rotations += count
+                self._sweepMoves += count
+
+                self._levelOffset += self.rotationBatch
+
+                if self._levelOffset >= len(levels[depth]):
+                    self._optimizeDepth, self._levelOffset = (depth - 1 if depth > 0 else None), 0
+
+                if self._optimizeDepth is None:
+                    self._reinsertQueue = self._ReinsertCandidates()
+            elif self._Reinsert(self._reinsertQueue.pop()):
+                reinsertions += 1
+                self._sweepMoves += 1
+
+            # a sweep that moved nothing widens the next one, until every
+            # node has been tried
+            if self._optimizeDepth is None and not self._reinsertQueue:
+                self._reinsertQueue = None
+                converged = self._sweepMoves == 0 and self._reinsertFraction >= 1
+                levels = None
+
+                if not self._sweepMoves:
+                    self._reinsertFraction = min(4 * self._reinsertFraction, 1.0)
+
+        sahAfter = self.SAHCost()
+
+        self.optimizeStatistics = {
+            "rotations": rotations,
+            "reinsertions": reinsertions,
+            "optimizeTime": time.perf_counter() - start,
+            "sahBefore": sahBefore,
+            "sahAfter": sahAfter,
+            "converged": converged
+        }
+
+        return rotations + reinsertions
 
     def SplitAndPush(self, nodeIndex, primitive=None, primitiveIndex=None):
         if primitiveIndex is None and primitive is not None:
-            primitiveIndex = len(self.objectData)
-            self.objectData.append(primitive)
+            primitiveIndex = self._AddPrimitive(primitive)
 
-        node = self.nodes[nodeIndex]
+        objects = self.LeafPrimitives(nodeIndex)
 
-        if primitive is not None:
-            node.boundingVolume.Grow(primitive.bounds)
+        if primitiveIndex is not None:
+            objects = np.append(objects, primitiveIndex)
 
-        axis = node.boundingVolume.MaxDimension
+        self.BuildSAH(nodeIndex, objects)
 
-        centroidBounds = AABB()
-        if primitive is not None:
-            centroidBounds.Grow(primitive.centroid)
+    # builds the subtree under a leaf node from the given primitives. each node
+    # takes the cheapest binned SAH split, and becomes a leaf once it holds no
+    # more than threshold primitives and splitting would not lower its cost.
+    # the tree is grown a level at a time, every node of a level binned at once.
+    def BuildSAH(self, currentNodeIndex, objects):
+        self._SetLeaf(currentNodeIndex, objects)
+        self._FitNode(currentNodeIndex)
 
-        for i in node.leafNodes:
-            centroidBounds.Grow(self.objectData[i].centroid)
+        self._BuildLevels(np.array([currentNodeIndex], dtype=np.int32), lambda nodes, level: self._SAHSplits(nodes))
 
-        bestCost = float("inf")
-        bestLeftObjects, bestRightObjects = None, None
-        bestBoundsA, bestBoundsB = None, None
+    # same as BuildSAH but nodes are split where the Morton codes of their 
+    # centroids first differ, which needs no cost evaluation at all. with
+    # sahLeaves a node of threshold or fewer primitives is still split when
+    # that lowers its SAH cost, as BuildSAH decides its leaves.
+    def BuildLBVH(self, currentNodeIndex, objects, sahLeaves: bool = False):
+        objects = np.asarray(objects, dtype=np.int32)
+        centroids = self.primitiveCentroid[objects]
 
-        objects = node.leafNodes[:]
+        codes = MortonCodes(centroids, centroids.min(axis=0), centroids.max(axis=0), self.mortonBits)
 
-        if primitive is not None:
-            objects.append(primitiveIndex)
+        self._ReserveMortonCodes(len(self.primitiveMin))
+        self.primitiveMorton[objects] = codes
 
-        for i in range(1, 9):
-            splitPosition = (centroidBounds.minn[axis] + centroidBounds.maxx[axis]) * (i / 10)
+        # partitioning is stable, every range stays sorted by code
+        self._SetLeaf(currentNodeIndex, objects[np.argsort(codes, kind="stable")])
+        self._FitNode(currentNodeIndex)
 
-            leftObjects  = [x for x in objects if self.objectData[x].centroid[axis] < splitPosition]
-            rightObjects = [x for x in objects if self.objectData[x].centroid[axis] >= splitPosition]
+        findSplits = self._SAHLeafSplits if sahLeaves else self._MortonSplits
 
-            boundsA = AABB()
-            boundsA.GrowFromObjects(leftObjects, key=lambda x: self.objectData[x].bounds)
+        self._BuildLevels(np.array([currentNodeIndex], dtype=np.int32), lambda nodes, level: findSplits(nodes))
 
-            boundsB = AABB()
-            boundsB.GrowFromObjects(rightObjects, key=lambda x: self.objectData[x].bounds)
+    # splits the nodes level by level until no leaf wants to split, or for at 
+    # most levels levels. returns the leaves that could still be split.
+    def _BuildLevels(self, nodes: np.ndarray, findSplits, levels: int = None):
+        level = 0
 
-            cost = CalculateSAH(boundsA, boundsB, node.boundingVolume, 1, 2, leftObjects, rightObjects)
+        while len(nodes) and level != levels:
+            nodes = nodes[self.primitiveCount[nodes] > 1]
 
-            if cost < bestCost:
-                bestCost = cost
-                bestLeftObjects = leftObjects
-                bestRightObjects = rightObjects
-                bestBoundsA = boundsA
-                bestBoundsB = boundsB
-        
+            if not len(nodes):
+                break
 
-        leftNode = self._GetLeftNode(nodeIndex)
-        rightNode = self._GetRightNode(nodeIndex)
+            split, leftMask, segments = findSplits(nodes, level)
+            
+            nodes = self._Partition(nodes, leftMask, segments, split)
+            level += 1
 
-        leftNode.leafNodes.extend(bestLeftObjects)
-        leftNode.boundingVolume.Grow(bestBoundsA)
+        return nodes
 
-        rightNode.leafNodes.extend(bestRightObjects)
-        rightNode.boundingVolume.Grow(bestBoundsB)
+    # BuildSAH with the work spread over a process pool. the top parallelLevels
+    # levels are split here, every subtree below them is built by a worker and
+    # stitched back in order. the tree only depends on parallelLevels, never on
+    # the worker count, and workers=1 builds the subtrees in this process.
+    def BuildSAHParallel(self, currentNodeIndex, objects, workers: int):
+        self._SetLeaf(currentNodeIndex, objects)
+        self._FitNode(currentNodeIndex)
 
-        if len(leftNode.leafNodes) >= self.threshold:
-            self.SplitAndPush(self._GetLeftNodeIndex(nodeIndex))
+        nodes = self._BuildLevels(np.array([currentNodeIndex], dtype=np.int32), 
+                                  lambda nodes, level: self._SAHSplits(nodes), self.parallelLevels)
+        
+        nodes = nodes[self.primitiveCount[nodes] > 1]
+        
+        settings = {
+            "threshold": self.threshold,
+            "binCount": self.binCount,
+            "traversalCost": self.traversalCost,
+            "intersectionCost": self.intersectionCost
+        }
+
+        tasks = []
+        for nodeIndex in nodes:
+            subtreeObjects = self.LeafPrimitives(nodeIndex)
+            
+            tasks.append((self.primitiveMin[subtreeObjects], self.primitiveMax[subtreeObjects], 
+                          self.primitiveCentroid[subtreeObjects], settings))
 
-        if len(rightNode.leafNodes) >= self.threshold:
-            self.SplitAndPush(self._GetRightNodeIndex(nodeIndex))
+        if workers > 1 and len(tasks) > 1:
+            with Pool(min(workers, len(tasks))) as pool:
+                subtrees = pool.map(_BuildSubtree, tasks)
+        else:
+            subtrees = [_BuildSubtree(task) for task in tasks]
 
-        node.leafNodes = []  
+        for nodeIndex, subtree in zip(nodes, subtrees):
+            self._Graft(nodeIndex, subtree)
 
+    # replaces a leaf with a subtree built over its primitives by _BuildSubtree.
+    # the subtree's root becomes the leaf and its other nodes are appended.
+    def _Graft(self, nodeIndex: int, subtree):
+        nodeMin, nodeMax, leftChild, rightChild, parent, primitiveOffset, primitiveCount, primitiveIndices = subtree
 
+        offset = self.primitiveOffset[nodeIndex]
+        objects = self.LeafPrimitives(nodeIndex).copy()
 
-    def BuildSAH(self, currentNodeIndex, objects, bounds):
-        while currentNodeIndex >= len(self.nodes):
-            self.nodes.append(BVHNode(AABB()))
+        nodes = self._AllocateNodes(np.full(len(nodeMin) - 1, -1)) 
         
-        node = self.nodes[currentNodeIndex]
-        node.boundingVolume = bounds
+        remap = np.concatenate(([nodeIndex], nodes)).astype(np.int32)
+        remap = np.append(remap, -1)
 
-        if self._TryInsertPrimitives(currentNodeIndex, objects):            
-            return 
+        self._nodeBoxes = None
 
-        centroidBounds = AABB()
-        centroidBounds.GrowFromObjects(objects, key=lambda x: x.centroid)
+        self.nodeMin[remap[:-1]] = nodeMin
+        self.nodeMax[remap[:-1]] = nodeMax
+        self.leftChild[remap[:-1]] = remap[leftChild]
+        self.rightChild[remap[:-1]] = remap[rightChild]
+        self.parent[nodes] = remap[parent[1:]]
+        self.primitiveOffset[remap[:-1]] = primitiveOffset + offset
+        self.primitiveCount[remap[:-1]] = primitiveCount
 
-        #decide which axis to split
-        axis = centroidBounds.MaxDimension
+        self.primitiveIndices[offset:offset + len(objects)] = objects[primitiveIndices]
 
-        # if the axis are the same theres nothing left to split (need to think of a better fix)
+    def _SAHSplits(self, nodes: np.ndarray):
+        costs, leftMask, segments = self._FindSplits(nodes)
+        counts = self.primitiveCount[nodes]
 
-        if centroidBounds.minn[axis] == centroidBounds.maxx[axis]:
-            start = len(self.objectData)
-            
-            self.objectData.extend(objects)
-            node.leafNodes.extend((i for i in range(start, len(self.objectData))))
-            return 
+        return (counts > self.threshold) | (costs < self.intersectionCost * counts), leftMask, segments
 
-        bestCost = float("inf")
-        bestLeftObjects, bestRightObjects = None, None 
-        bestBoundsA, bestBoundsB = None, None
+    # ranges are sorted by code, so the primitives of a node share every bit
+    # above the highest one where its first and last codes differ. splitting on
+    # that bit is exactly a radix tree split. equal codes are split in half.
+    def _MortonSplits(self, nodes: np.ndarray):
+        objects, segments, starts = self._GatherRanges(nodes)
+        counts = self.primitiveCount[nodes]
+
+        codes = self.primitiveMorton[objects]
+        different = codes[starts] ^ codes[starts + counts - 1]
+
+        highestBit = np.zeros(len(nodes), dtype=np.uint64)
+        remaining = different.copy()
+
+        for shift in (32, 16, 8, 4, 2, 1):
+            shift = np.uint64(shift)
+            above = remaining >> shift > 0
 
-        # 0.1 -> 0.8 
-        for i in range(1, 9):
-            currAxis = (centroidBounds.minn[axis] + centroidBounds.maxx[axis]) * (i / 10)
+            highestBit[above] += shift
+            remaining[above] >>= shift
 
-            leftObjects  = list(filter(lambda x: x.centroid[axis] <  currAxis,  objects))
-            rightObjects = list(filter(lambda x: x.centroid[axis] >= currAxis, objects))
+        leftMask = (codes >> highestBit[segments]) & np.uint64(1) == 0
 
-            boundsA = AABB()
-            boundsA.GrowFromObjects(leftObjects, key=lambda x: x.bounds)
+        duplicates = (different == 0)[segments]
+        leftMask[duplicates] = ((np.arange(len(segments)) - starts[segments]) < (counts // 2)[segments])[duplicates]
 
-            boundsB = AABB()
-            boundsB.GrowFromObjects(rightObjects, key=lambda x: x.bounds)
+        return counts > self.threshold, leftMask, segments
 
-            cost = CalculateSAH(boundsA, boundsB, bounds, 1, 2, leftObjects, rightObjects)
+    # _MortonSplits, and the nodes it would leave as leaves of two or more
+    # primitives are split too where that is cheaper than intersecting them all.
+    # ranges are sorted by code, so each split's left side is a prefix.
+    def _SAHLeafSplits(self, nodes: np.ndarray):
+        split, leftMask, segments = self._MortonSplits(nodes)
+        counts = self.primitiveCount[nodes]
 
-            if cost < bestCost:
-                bestCost = cost 
-                bestLeftObjects = leftObjects
-                bestRightObjects = rightObjects
-                bestBoundsA = boundsA
-                bestBoundsB = boundsB
+        small = np.flatnonzero(~split & (counts > 1))
+
+        if not len(small):
+            return split, leftMask, segments
+
+        leftCounts = np.bincount(segments, weights=leftMask, minlength=len(nodes)).astype(np.int32)[small]
+        counts = counts[small]
+
+        objects, _, starts = self._GatherRanges(nodes[small])
+        valid = (leftCounts > 0) & (leftCounts < counts)
+
+        # a left side of every primitive reduces nothing, its node is invalid
+        childStarts = np.stack((starts, np.minimum(starts + leftCounts, len(objects) - 1)), axis=1).ravel()
+        childMin = np.minimum.reduceat(self.primitiveMin[objects], childStarts)
+        childMax = np.maximum.reduceat(self.primitiveMax[objects], childStarts)
+
+        childAreas = SurfaceAreas(childMin, childMax).reshape(-1, 2)
+        parentArea = np.maximum(SurfaceAreas(self.nodeMin[nodes[small]], self.nodeMax[nodes[small]]), 1e-30)
+
+        costs = self.traversalCost + self.intersectionCost * (
+            leftCounts * childAreas[:, 0] + (counts - leftCounts) * childAreas[:, 1]) / parentArea
+
+        split[small] = valid & (costs < self.intersectionCost * counts)
+
+        return split, leftMask, segments
+
+    # binned SAH over all three axes of each node's centroid bounds. returns the 
+    # cost of every node's best split, whether each primitive of the nodes' 
+    # concatenated ranges goes left, and which node each of those primitives
+    # belongs to. nodes whose centroids coincide cannot be binned apart and are 
+    # split in half at infinite cost.
+    def _FindSplits(self, nodes: np.ndarray):
+        binCount = self.binCount
+        counts = self.primitiveCount[nodes]
+
+        objects, segments, starts = self._GatherRanges(nodes)
+
+        centroids = self.primitiveCentroid[objects]
+        centroidMin = np.minimum.reduceat(centroids, starts)
+        extent = np.maximum.reduceat(centroids, starts) - centroidMin
+
+        scale = np.zeros_like(extent)
+        scale[extent > 0] = binCount / extent[extent > 0]
+
+        bins = ((centroids - centroidMin[segments]) * scale[segments]).astype(np.int32)
+        np.minimum(bins, binCount - 1, out=bins)
+
+        keys = ((segments[:, None] * 3 + np.arange(3)) * binCount + bins).ravel()
+        binShape = (len(nodes), 3, binCount)
+
+        binCounts = np.bincount(keys, minlength=np.prod(binShape)).reshape(binShape)
+
+        binMin = np.full((np.prod(binShape), 3), np.inf, dtype=np.float32)
+        binMax = np.full((np.prod(binShape), 3), -np.inf, dtype=np.float32)
+
+        np.minimum.at(binMin, keys, np.repeat(self.primitiveMin[objects], 3, axis=0))
+        np.maximum.at(binMax, keys, np.repeat(self.primitiveMax[objects], 3, axis=0))
+
+        binMin = binMin.reshape(binShape + (3,))
+        binMax = binMax.reshape(binShape + (3,))
+
+        # split k puts bins [0, k] on the left and (k, binCount) on the right
+        leftCount = np.cumsum(binCounts, axis=2)[..., :-1]
+        rightCount = counts[:, None, None] - leftCount
+
+        leftArea = SurfaceAreas(np.minimum.accumulate(binMin, axis=2)[:, :, :-1], 
+                                np.maximum.accumulate(binMax, axis=2)[:, :, :-1])
+        
+        rightArea = SurfaceAreas(np.minimum.accumulate(binMin[:, :, ::-1], axis=2)[:, :, ::-1][:, :, 1:], 
+                                 np.maximum.accumulate(binMax[:, :, ::-1], axis=2)[:, :, ::-1][:, :, 1:])
+
+        parentArea = np.maximum(SurfaceAreas(self.nodeMin[nodes], self.nodeMax[nodes]), 1e-30)
+
+        valid = (leftCount > 0) & (rightCount > 0)
+
+        with np.errstate(invalid="ignore"):
+            costs = self.traversalCost + self.intersectionCost * (
+                leftCount * leftArea + rightCount * rightArea) / parentArea[:, None, None]
+
+        costs = np.where(valid, costs, np.inf).reshape(len(nodes), -1)
+
+        best = np.argmin(costs, axis=1)
+        axis, splitBin = np.divmod(best, binCount - 1)
+        costs = costs[np.arange(len(nodes)), best]
+
+        leftMask = bins[np.arange(len(segments)), axis[segments]] <= splitBin[segments]
+
+        degenerate = ~np.isfinite(costs)
+        halves = (np.arange(len(segments)) - starts[segments]) < (counts // 2)[segments]
+        leftMask[degenerate[segments]] = halves[degenerate[segments]]
+
+        return costs, leftMask, segments
 
-        if bestLeftObjects:
-            self.BuildSAH(self._GetLeftNodeIndex(currentNodeIndex), bestLeftObjects, bestBoundsA)
-        if bestRightObjects:
-            self.BuildSAH(self._GetRightNodeIndex(currentNodeIndex), bestRightObjects, bestBoundsB)
 
 
     # if hits will call function with hit function, else miss function
@@ -299,16 +931,11 @@ class BVH:
     # is called with user data. the ray miss function should take in the ray back.
     # the result of these functions (user choice) is returned
 
-    def TraceRay(self, ray: Ray, rayObjectFunction, rayHitFunction=None, rayMissFunction=None):
-        distance = RayBoxIntersection(ray, self.nodes[0].boundingVolume)
+    def TraceRay(self, ray: Ray, rayObjectFunction, rayHitFunction=None, rayMissFunction=None, statistics=None):
+        distance = self._RayNodeEntry(ray, 0)
+        counts = {"rays": 1, "nodesVisited": 0, "nodesPruned": 0, "primitiveTests": 0}
 
-        if distance < 0:
-            if rayMissFunction:
-                return rayMissFunction(ray)
-            
-            return None
-
-        heap = [(distance, 0)]
+        heap = [(distance, 0)] if distance >= 0 else []
 
         minimumDistance = float("inf")
         userData = None
@@ -316,26 +943,36 @@ class BVH:
         while heap:
             distance, nodeIndex = heapq.heappop(heap)
 
-            newDistance, newUserData = self._TraceWithinBox(ray, rayObjectFunction, nodeIndex)
+            # entries come out nearest first, nothing left can beat the hit
+            if distance > minimumDistance:
+                counts["nodesPruned"] += len(heap) + 1
+                break
+
+            counts["nodesVisited"] += 1
+
+            if self.IsLeaf(nodeIndex):
+                counts["primitiveTests"] += int(self.primitiveCount[nodeIndex])
+                newDistance, newUserData = self._TraceWithinBox(ray, rayObjectFunction, nodeIndex)
+
+                if newDistance < minimumDistance:
+                    userData = newUserData
+                    minimumDistance = newDistance
 
-            if newDistance < minimumDistance:
-                userData = newUserData
-                minimumDistance = newDistance
+                continue
                 
-            if self._LeftChildExists(nodeIndex):
-                child = self._GetLeftNode(nodeIndex)
+            for child in (self.leftChild[nodeIndex], self.rightChild[nodeIndex]):
+                distance = self._RayNodeEntry(ray, child)
 
-                distance = RayBoxIntersection(ray, child.boundingVolume)
+                if distance < 0:
+                    continue
 
-                if distance >= 0:
-                    heapq.heappush(heap, (distance, self._GetLeftNodeIndex(nodeIndex)))
-            
-            if self._RightChildExists(nodeIndex):
-                child = self._GetRightNode(nodeIndex)
-                distance = RayBoxIntersection(ray, child.boundingVolume)
+                if distance > minimumDistance:
+                    counts["nodesPruned"] += 1
+                    continue
 
-                if distance >= 0:
-                    heapq.heappush(heap, (distance, self._GetRightNodeIndex(nodeIndex)))
+                heapq.heappush(heap, (distance, child))
+
+        _AddStatistics(statistics, counts)
         
         if minimumDistance == float("inf"):
             if rayMissFunction:
@@ -345,12 +982,417 @@ class BVH:
                 return rayHitFunction(userData) 
 
         return None
+
+    # any hit query for shadow and visibility rays, true as soon as any object
+    # is hit closer than tMax. the first hit found ends the traversal.
+    def Occluded(self, ray: Ray, tMax: float = float("inf"), rayObjectFunction=RaySphereIntersection, statistics=None) -> bool:
+        counts = {"rays": 1, "nodesVisited": 0, "nodesPruned": 0, "primitiveTests": 0}
+        
+        distance = self._RayNodeEntry(ray, 0)
+        stack = [0] if 0 <= distance < tMax else []
+
+        occluded = False
+
+        while stack and not occluded:
+            nodeIndex = stack.pop()
+            counts["nodesVisited"] += 1
+
+            if self.IsLeaf(nodeIndex):
+                for leaf in self.LeafPrimitives(nodeIndex):
+                    counts["primitiveTests"] += 1
+                    distance, _ = rayObjectFunction(ray, self.objectData[leaf].object)
+
+                    if 0 <= distance < tMax:
+                        occluded = True
+                        break
+
+                continue
+
+            for child in (self.leftChild[nodeIndex], self.rightChild[nodeIndex]):
+                distance = self._RayNodeEntry(ray, child)
+
+                if distance < 0:
+                    continue
+                
+                if distance >= tMax:
+                    counts["nodesPruned"] += 1
+                    continue
+
+                stack.append(child)
+
+        _AddStatistics(statistics, counts)
+
+        return occluded
+
+    # batched closest hit against spheres. origins and directions are (N, 3),
+    # returns the hit distance (inf on a miss) and the index into objectData
+    # (-1 on a miss) of every ray. rays are streamed through the tree breadth
+    # first as (ray, node) pairs, batchSize rays at a time.
+
+    def TraceRays(self, origins, directions, batchSize: int = 65536, statistics=None):
+        origins = np.asarray(origins, dtype=np.float32).reshape(-1, 3)
+        directions = NormalizeDirections(directions)
+        reciprocals = ReciprocalDirections(directions)
+
+        distances = np.full(len(origins), np.inf)
+        primitives = np.full(len(origins), -1, dtype=np.int32)
+
+        if not self.primitiveIndexCount:
+            return distances, primitives
+
+        counts = {"rays": len(origins), "nodesVisited": 0, "nodesPruned": 0, "primitiveTests": 0}
+
+        for start in range(0, len(origins), batchSize):
+            rays = np.arange(start, min(start + batchSize, len(origins)))
+            self._TraceRayStream(rays, origins, directions, reciprocals, distances, primitives, counts)
+
+        _AddStatistics(statistics, counts)
+
+        return distances, primitives
+
+    def _TraceRayStream(self, rays, origins, directions, reciprocals, distances, primitives, counts):
+        centers, radii = self.SphereArrays()
+        nodes = np.zeros(len(rays), dtype=np.int32)
+
+        while len(rays):
+            hit, tmin, _ = RayBoxIntersections(origins[rays], reciprocals[rays], self.nodeMin[nodes], self.nodeMax[nodes])
+
+            # boxes that start behind the closest hit so far cannot improve it
+            closer = np.maximum(tmin, 0) <= distances[rays]
+
+            counts["nodesPruned"] += int(np.count_nonzero(hit & ~closer))
+            hit &= closer
+
+            rays, nodes = rays[hit], nodes[hit]
+            counts["nodesVisited"] += len(nodes)
+
+            leaf = self.leftChild[nodes] < 0
+
+            leafRays, leafNodes = rays[leaf], nodes[leaf]
+            leafCounts = self.primitiveCount[leafNodes]
+
+            pairRays = np.repeat(leafRays, leafCounts)
+            counts["primitiveTests"] += len(pairRays)
+            firsts = np.repeat(self.primitiveOffset[leafNodes] - np.cumsum(leafCounts) + leafCounts, leafCounts)
+            pairPrimitives = self.primitiveIndices[firsts + np.arange(len(pairRays))]
+
+            pairDistances = RaySphereIntersections(origins[pairRays], directions[pairRays], 
+                                                   centers[pairPrimitives], radii[pairPrimitives])
+
+            valid = pairDistances >= 0
+            pairRays, pairPrimitives, pairDistances = pairRays[valid], pairPrimitives[valid], pairDistances[valid]
+
+            # closest candidate per ray, ties resolved in favour of the earlier pair
+            order = np.lexsort((pairDistances, pairRays))
+            pairRays, pairPrimitives, pairDistances = pairRays[order], pairPrimitives[order], pairDistances[order]
+
+            first = np.ones(len(pairRays), dtype=bool)
+            first[1:] = pairRays[1:] != pairRays[:-1]
+            pairRays, pairPrimitives, pairDistances = pairRays[first], pairPrimitives[first], pairDistances[first]
+
+            closer = pairDistances < distances[pairRays]
+            distances[pairRays[closer]] = pairDistances[closer]
+            primitives[pairRays[closer]] = pairPrimitives[closer]
+
+            inner = ~leaf
+            rays = np.repeat(rays[inner], 2)
+            nodes = np.stack((self.leftChild[nodes[inner]], self.rightChild[nodes[inner]]), axis=1).ravel()
+
+    # the objectData indices of the spheres that overlap box, in order. the
+    # scalar queries walk the tree with a stack over the vec3 node boxes and
+    # test the spheres of a leaf in one go
+    def QueryBox(self, box: AABB, statistics=None) -> np.ndarray:
+        minn, maxx = box.minn, box.maxx
+        queryMin, queryMax = np.array(minn.to_list(), dtype=np.float32), np.array(maxx.to_list(), dtype=np.float32)
+
+        def NodeTest(nodeMin, nodeMax):
+            return glm.all(glm.lessThanEqual(nodeMin, maxx)) and glm.all(glm.greaterThanEqual(nodeMax, minn))
+
+        def PrimitiveTest(centers, radii):
+            return PointBoxDistances(centers, queryMin, queryMax) <= radii
+
+        return self._QueryNodes(NodeTest, PrimitiveTest, statistics)
+
+    # the objectData indices of the spheres that overlap the sphere at center,
+    # in order
+    def QuerySphere(self, center, radius: float, statistics=None) -> np.ndarray:
+        point = glm.vec3(*center)
+        queryCenter = np.array(point.to_list(), dtype=np.float32)
+        radius = float(radius)
+
+        def NodeTest(nodeMin, nodeMax):
+            return PointBoundsDistance(point, nodeMin, nodeMax) <= radius
+
+        def PrimitiveTest(centers, radii):
+            offsets = centers.astype(np.float64) - queryCenter
+            return np.sqrt(_Dot(offsets, offsets)) <= radii + radius
+
+        return self._QueryNodes(NodeTest, PrimitiveTest, statistics)
+
+    # the k spheres nearest to point, nearest first, as objectData indices and
+    # distances from point to their surfaces (0 inside one). equal distances
+    # go to the lower index. fewer than k when the tree holds fewer. nodes
+    # come off a heap nearest first until the next is farther than the k-th
+    # nearest sphere
+    def Nearest(self, point, k: int = 1, statistics=None):
+        point = glm.vec3(*point)
+        queryPoint = np.array(point.to_list(), dtype=np.float32)
+
+        counts = {"queries": 1, "nodesVisited": 0, "primitiveTests": 0}
+        nearest = []
+
+        if self.primitiveIndexCount and k >= 1:
+            boxes = self.NodeBoxes()
+            centers, radii = self.SphereArrays()
+
+            heap = [(PointBoundsDistance(point, *boxes[0]), 0)]
+            bound = float("inf")
+
+            while heap:
+                distance, nodeIndex = heapq.heappop(heap)
+
+                if distance > bound:
+                    break
+
+                counts["nodesVisited"] += 1
+
+                if self.IsLeaf(nodeIndex):
+                    objects = self.LeafPrimitives(nodeIndex)
+                    counts["primitiveTests"] += len(objects)
+
+                    offsets = centers[objects].astype(np.float64) - queryPoint
+                    distances = np.maximum(np.sqrt(_Dot(offsets, offsets)) - radii[objects], 0)
+
+                    nearest = sorted(nearest + list(zip(distances.tolist(), objects.tolist())))[:k]
+
+                    if len(nearest) == k:
+                        bound = nearest[-1][0]
+
+                    continue
+
+                for child in (self.leftChild[nodeIndex], self.rightChild[nodeIndex]):
+                    distance = PointBoundsDistance(point, *boxes[child])
+
+                    if distance <= bound:
+                        heapq.heappush(heap, (distance, int(child)))
+
+        _AddStatistics(statistics, counts)
+
+        return (np.array([index for _, index in nearest], dtype=np.int64),
+                np.array([distance for distance, _ in nearest], dtype=np.float64))
+
+    # QueryBox for many boxes, given by their corners (N, 3). returns
+    # (query, object) index pairs of every overlap, sorted by query then object
+    def QueryBoxes(self, minn, maxx, statistics=None):
+        minn = np.asarray(minn, dtype=np.float32).reshape(-1, 3)
+        maxx = np.asarray(maxx, dtype=np.float32).reshape(-1, 3)
+
+        def NodeTest(queries, nodeMin, nodeMax):
+            return (nodeMin <= maxx[queries]).all(axis=1) & (nodeMax >= minn[queries]).all(axis=1)
+
+        def PrimitiveTest(queries, objects, centers, radii):
+            return PointBoxDistances(centers[objects], minn[queries], maxx[queries]) <= radii[objects]
+
+        return self._QueryStream(len(minn), NodeTest, PrimitiveTest, statistics)
+
+    # QuerySphere for many spheres, centres (N, 3) and radii (N)
+    def QuerySpheres(self, centers, radii, statistics=None):
+        queryCenters = np.asarray(centers, dtype=np.float32).reshape(-1, 3)
+        queryRadii = np.asarray(radii, dtype=np.float64).reshape(-1)
+
+        def NodeTest(queries, nodeMin, nodeMax):
+            return PointBoxDistances(queryCenters[queries], nodeMin, nodeMax) <= queryRadii[queries]
+
+        def PrimitiveTest(queries, objects, centers, radii):
+            offsets = centers[objects].astype(np.float64) - queryCenters[queries]
+            return np.sqrt(_Dot(offsets, offsets)) <= radii[objects] + queryRadii[queries]
+
+        return self._QueryStream(len(queryCenters), NodeTest, PrimitiveTest, statistics)
+
+    # Nearest for many points (N, 3), returns (N, k) indices and distances
+    # padded with -1 and inf. each point walks the tree depth first, nearer
+    # child first, from a stack of its own. every step pops one node for
+    # every point, and boxes farther away than a point's k-th nearest sphere
+    # so far are skipped
+    def NearestPoints(self, points, k: int = 1, statistics=None):
+        points = np.asarray(points, dtype=np.float32).reshape(-1, 3)
+        count = len(points)
+
+        indices = np.full((count, k), -1, dtype=np.int64)
+        distances = np.full((count, k), np.inf)
+
+        counts = {"queries": count, "nodesVisited": 0, "primitiveTests": 0}
+
+        if not self.primitiveIndexCount or k < 1 or not count:
+            _AddStatistics(statistics, counts)
+            return indices, distances
+
+        centers, radii = self.SphereArrays()
+        leafSize = int(self.primitiveCount[:self.nodeCount].max())
+        slots = np.arange(leafSize)
+
+        # a stack never holds more than a node per level and the root
+        stackSize = len(self._InnerLevels()) + 2
+        stack = np.zeros((count, stackSize), dtype=np.int32)
+        stackDistances = np.zeros((count, stackSize))
+
+        stackDistances[:, 0] = PointBoxDistances(points, self.nodeMin[0], self.nodeMax[0])
+        size = np.ones(count, dtype=np.int32)
+
+        while True:
+            queries = np.flatnonzero(size)
+
+            if not len(queries):
+                break
+
+            size[queries] -= 1
+            nodes = stack[queries, size[queries]]
+
+            # the k-th nearest may have come closer since the node was pushed
+            near = stackDistances[queries, size[queries]] <= distances[queries, -1]
+            queries, nodes = queries[near], nodes[near]
+
+            counts["nodesVisited"] += len(nodes)
+
+            leaf = self.leftChild[nodes] < 0
+            leafQueries, leaves = queries[leaf], nodes[leaf]
+
+            # the spheres of every leaf, padded to the largest leaf, merged
+            # with the k nearest so far
+            filled = slots < self.primitiveCount[leaves][:, None]
+            objects = self.primitiveIndices[np.where(filled, self.primitiveOffset[leaves][:, None] + slots, 0)]
+
+            counts["primitiveTests"] += int(filled.sum())
+
+            offsets = centers[objects].astype(np.float64) - points[leafQueries][:, None]
+            leafDistances = np.maximum(np.sqrt(_Dot(offsets, offsets)) - radii[objects], 0)
+
+            mergedIndices = np.concatenate((indices[leafQueries], np.where(filled, objects, -1)), axis=1)
+            mergedDistances = np.concatenate((distances[leafQueries], np.where(filled, leafDistances, np.inf)), axis=1)
+
+            order = np.lexsort((mergedIndices, mergedDistances))[:, :k]
+            indices[leafQueries] = np.take_along_axis(mergedIndices, order, axis=1)
+            distances[leafQueries] = np.take_along_axis(mergedDistances, order, axis=1)
+
+            # children within reach are pushed, the nearer one last so it is
+            # popped first
+            innerQueries, inner = queries[~leaf], nodes[~leaf]
+            left, right = self.leftChild[inner], self.rightChild[inner]
+
+            leftDistances = PointBoxDistances(points[innerQueries], self.nodeMin[left], self.nodeMax[left])
+            rightDistances = PointBoxDistances(points[innerQueries], self.nodeMin[right], self.nodeMax[right])
+
+            leftFirst = leftDistances <= rightDistances
+            bound = distances[innerQueries, -1]
+            top = size[innerQueries]
+
+            for child, childDistances in ((np.where(leftFirst, right, left), np.maximum(leftDistances, rightDistances)),
+                                          (np.where(leftFirst, left, right), np.minimum(leftDistances, rightDistances))):
+                push = childDistances <= bound
+
+                stack[innerQueries[push], top[push]] = child[push]
+                stackDistances[innerQueries[push], top[push]] = childDistances[push]
+                top = top + push
+
+            size[innerQueries] = top
+
+        _AddStatistics(statistics, counts)
+
+        return indices, distances
+
+    def _QueryNodes(self, nodeTest, primitiveTest, statistics):
+        counts = {"queries": 1, "nodesVisited": 0, "primitiveTests": 0}
+        found = [np.zeros(0, dtype=np.int64)]
+
+        if self.primitiveIndexCount:
+            boxes = self.NodeBoxes()
+            centers, radii = self.SphereArrays()
+
+            stack = [0]
+
+            while stack:
+                nodeIndex = stack.pop()
+
+                if not nodeTest(*boxes[nodeIndex]):
+                    continue
+
+                counts["nodesVisited"] += 1
+
+                if self.IsLeaf(nodeIndex):
+                    objects = self.LeafPrimitives(nodeIndex)
+                    counts["primitiveTests"] += len(objects)
+
+                    found.append(objects[primitiveTest(centers[objects], radii[objects])])
+                else:
+                    stack += [self.rightChild[nodeIndex], self.leftChild[nodeIndex]]
+
+        _AddStatistics(statistics, counts)
+
+        return np.sort(np.concatenate(found).astype(np.int64))
+
+    # breadth first (query, node) pairs like _TraceRayStream. nodeTest keeps
+    # the pairs whose box may hold an answer and primitiveTest decides for the
+    # spheres of the leaves, both take the query indices of the pairs
+    def _QueryStream(self, queryCount: int, nodeTest, primitiveTest, statistics):
+        counts = {"queries": queryCount, "nodesVisited": 0, "primitiveTests": 0}
+        found = [(np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))]
+
+        queries = np.arange(queryCount) if self.primitiveIndexCount else np.zeros(0, dtype=np.int64)
+        nodes = np.zeros(len(queries), dtype=np.int32)
+
+        if len(queries):
+            centers, radii = self.SphereArrays()
+
+        while len(queries):
+            hit = nodeTest(queries, self.nodeMin[nodes], self.nodeMax[nodes])
+            queries, nodes = queries[hit], nodes[hit]
+
+            counts["nodesVisited"] += len(nodes)
+
+            leaf = self.leftChild[nodes] < 0
+            leafNodes = nodes[leaf]
+            leafCounts = self.primitiveCount[leafNodes]
+
+            pairQueries = np.repeat(queries[leaf], leafCounts)
+            firsts = np.repeat(self.primitiveOffset[leafNodes] - np.cumsum(leafCounts) + leafCounts, leafCounts)
+            pairObjects = self.primitiveIndices[firsts + np.arange(len(pairQueries))].astype(np.int64)
+
+            counts["primitiveTests"] += len(pairQueries)
+
+            overlap = primitiveTest(pairQueries, pairObjects, centers, radii)
+            found.append((pairQueries[overlap], pairObjects[overlap]))
+
+            inner = ~leaf
+            queries = np.repeat(queries[inner], 2)
+            nodes = np.stack((self.leftChild[nodes[inner]], self.rightChild[nodes[inner]]), axis=1).ravel()
+
+        _AddStatistics(statistics, counts)
+
+        pairQueries, pairObjects = (np.concatenate(column) for column in zip(*found))
+        order = np.lexsort((pairObjects, pairQueries))
+
+        return pairQueries[order], pairObjects[order]
+
+    # centres (float32) and radii (float64, like the python floats RaySphereIntersection 
+    # squares) of the sphere behind every primitive, rebuilt when objects are added
+    def SphereArrays(self):
+        if self._sphereArrays is None and isinstance(self.objectData, SpherePrimitives) and not self.objectData.inserted:
+            spheres = self.objectData.spheres
+            self._sphereArrays = (spheres.center, spheres.radius.astype(np.float64))
+
+        if self._sphereArrays is None:
+            centers = np.array([p.object.center.to_list() for p in self.objectData], dtype=np.float32).reshape(-1, 3)
+            radii = np.array([p.object.radius for p in self.objectData], dtype=np.float64)
+
+            self._sphereArrays = (centers, radii)
+
+        return self._sphereArrays
+
     def _TraceWithinBox(self, ray: Ray, rayObjectFunction, nodeIndex: int):
-        node = self.nodes[nodeIndex]
         minimumDistance  = float("inf")
         userData = None
 
-        for leaf in node.leafNodes:
+        for leaf in self.LeafPrimitives(nodeIndex):
             primitive = self.objectData[leaf]
             
             distance, result = rayObjectFunction(ray, primitive.object)
@@ -361,67 +1403,687 @@ class BVH:
 
         return (minimumDistance, userData)
 
+    def _RayNodeEntry(self, ray: Ray, nodeIndex: int) -> float:
+        if self.primitiveCount[nodeIndex] == 0 and self.IsLeaf(nodeIndex):
+            return -1.0
+
+        minn, maxx = self.NodeBoxes()[nodeIndex]
+        return RayBoundsEntry(ray, minn, maxx)
+
+    # (minn, maxx) of every node as vec3s for the scalar queries, which would
+    # otherwise convert two array rows per box test. made on first use after
+    # any node bounds changed
+    def NodeBoxes(self) -> list:
+        if self._nodeBoxes is None:
+            nodeCount = self.nodeCount
+            self._nodeBoxes = [(glm.vec3(minn), glm.vec3(maxx)) for minn, maxx in
+                               zip(self.nodeMin[:nodeCount].tolist(), self.nodeMax[:nodeCount].tolist())]
 
-    def _GetLeftNodeIndex(self, nodeIndex: int) -> int:
-        return 2 * nodeIndex + 1
-    
-    def _GetRightNodeIndex(self, nodeIndex: int) -> int:
-        return 2 * nodeIndex + 2
-    
-    def _GetParentNodeIndex(self, nodeIndex: int) -> int:
-        return (nodeIndex - 1) // 2
-    
-    def _GetLeftNode(self, nodeIndex: int) -> BVHNode:
-        leftNodeIndex = self._GetLeftNodeIndex(nodeIndex)
+        return self._nodeBoxes
 
-        while leftNodeIndex >= len(self.nodes):
-            self.nodes.append(BVHNode(AABB()))
 
-        return self.nodes[leftNodeIndex]
-    
-    def _GetRightNode(self, nodeIndex: int) -> BVHNode:
-        rightNodeIndex = self._GetRightNodeIndex(nodeIndex)
+    # the arrays TraceRays reads, trimmed to their used length
+    def Arrays(self) -> dict:
+        centers, radii = self.SphereArrays()
+        nodeCount = self.nodeCount
 
-        while rightNodeIndex >= len(self.nodes):
-            self.nodes.append(BVHNode(AABB()))
+        return {
+            "nodeMin": self.nodeMin[:nodeCount],
+            "nodeMax": self.nodeMax[:nodeCount],
+            "leftChild": self.leftChild[:nodeCount],
+            "rightChild": self.rightChild[:nodeCount],
+            "primitiveOffset": self.primitiveOffset[:nodeCount],
+            "primitiveCount": self.primitiveCount[:nodeCount],
+            "primitiveIndices": self.primitiveIndices[:self.primitiveIndexCount],
+            "sphereCenters": centers,
+            "sphereRadii": radii
+        }
 
-        return self.nodes[rightNodeIndex]
-    
-    def _GetParentNode(self, nodeIndex: int) -> Optional[BVHNode]:
-        parentNodeIndex = self._GetParentNodeIndex(nodeIndex)
+    # the tree as Shaders/BVH.glsl reads it, returns (nodes, primitiveIndices,
+    # depth). nodes are GPU_NODE records numbered level by level, so the two
+    # children of a node are next to each other. an inner node's leftFirst is
+    # its left child and its count is 0, a leaf's leftFirst is where its count
+    # primitives start in primitiveIndices (-1 for an empty leaf). depth is the
+    # number of levels below the root, the shader's stack needs depth + 1.
+    def Flatten(self):
+        levels = [np.zeros(1, dtype=np.int32)]
 
-        if parentNodeIndex < 0:
-            return None    
-        
-        return self.nodes[parentNodeIndex]
-    
-    def _TryInsert(self, nodeIndex, primitive) -> bool:
-        node = self.nodes[nodeIndex]
+        while True:
+            inner = levels[-1][self.leftChild[levels[-1]] != -1]
 
-        if len(node.leafNodes) < self.threshold:
-            node.leafNodes.append(len(self.objectData))
-            self.objectData.append(primitive)
-            return True
-        
-        return False
-    
-    def _TryInsertPrimitives(self, nodeIndex, primitives) -> bool:
-        node = self.nodes[nodeIndex]
+            if not len(inner):
+                break
 
-        if (len(primitives) + len(node.leafNodes)) <= self.threshold:
-            start = len(self.objectData)
+            levels.append(np.stack((self.leftChild[inner], self.rightChild[inner]), axis=1).ravel())
 
-            self.objectData.extend(primitives)
-            node.leafNodes.extend((i for i in range(start, len(self.objectData))))
-            return True 
-        
-        return False
-    
-    def _LeftChildExists(self, nodeIndex) -> bool:
-        return self._GetLeftNodeIndex(nodeIndex) < len(self.nodes)
+        order = np.concatenate(levels)
+
+        position = np.full(self.nodeCount + 1, -1, dtype=np.int32)
+        position[order] = np.arange(len(order), dtype=np.int32)
+
+        nodes = np.zeros(len(order), dtype=GPU_NODE)
+        nodes["min"] = self.nodeMin[order]
+        nodes["max"] = self.nodeMax[order]
+        nodes["leftFirst"] = position[self.leftChild[order]]
+
+        leaves = np.flatnonzero(self.leftChild[order] == -1)
+        objects, _, starts = self._GatherRanges(order[leaves])
+
+        counts = self.primitiveCount[order[leaves]]
+        nodes["leftFirst"][leaves] = np.where(counts > 0, starts, -1)
+        nodes["count"][leaves] = counts
+
+        return nodes, objects.astype(np.int32), len(levels) - 1
+
+    # a tree that traces straight out of the given arrays (from Arrays, maybe
+    # in shared memory) without copying them. it has no objectData, so only 
+    # TraceRays works on it.
+    @classmethod
+    def FromArrays(cls, arrays: dict) -> "BVH":
+        bvh = cls(capacity=1)
+
+        bvh.nodeMin, bvh.nodeMax = arrays["nodeMin"], arrays["nodeMax"]
+        bvh.leftChild, bvh.rightChild = arrays["leftChild"], arrays["rightChild"]
+        bvh.primitiveOffset, bvh.primitiveCount = arrays["primitiveOffset"], arrays["primitiveCount"]
+        bvh.primitiveIndices = arrays["primitiveIndices"]
+        bvh._sphereArrays = (arrays["sphereCenters"], arrays["sphereRadii"])
+        bvh._nodeBoxes = None
+
+        bvh.nodeCount = len(bvh.nodeMin)
+        bvh.primitiveIndexCount = len(bvh.primitiveIndices)
+
+        return bvh
+
+    def IsLeaf(self, nodeIndex: int) -> bool:
+        return self.leftChild[nodeIndex] < 0
+
+    def NodeBounds(self, nodeIndex: int) -> AABB:
+        return AABB(glm.vec3(self.nodeMin[nodeIndex]), glm.vec3(self.nodeMax[nodeIndex]))
+
+    def LeafPrimitives(self, nodeIndex: int) -> np.ndarray:
+        offset = self.primitiveOffset[nodeIndex]
+        return self.primitiveIndices[offset:offset + self.primitiveCount[nodeIndex]]
+
+    # expected cost of a ray through the tree relative to the root, the quantity
+    # the builders minimise. lower is better.
+    def SAHCost(self) -> float:
+        nodeCount = self.nodeCount
+        areas = SurfaceAreas(self.nodeMin[:nodeCount], self.nodeMax[:nodeCount])
+
+        if areas[0] <= 0 or not np.isfinite(areas[0]):
+            return 0.0
+
+        leaf = self.leftChild[:nodeCount] < 0
+
+        cost  = self.traversalCost * areas[~leaf].sum()
+        cost += self.intersectionCost * (areas[leaf] * self.primitiveCount[:nodeCount][leaf]).sum()
+
+        return float(cost / areas[0])
+
+    @property
+    def MemoryUsage(self) -> int:
+        arrays = (self.nodeMin, self.nodeMax, self.leftChild, self.rightChild, 
+                  self.parent, self.primitiveOffset, self.primitiveCount, 
+                  self.primitiveIndices, self.primitiveMin, self.primitiveMax, self.primitiveCentroid)
+
+        return sum(a.nbytes for a in arrays)
+
+    # bytes of the used part of the node arrays, what traversal reads
+    @property
+    def NodeMemoryUsage(self) -> int:
+        arrays = (self.nodeMin, self.nodeMax, self.leftChild, self.rightChild, 
+                  self.parent, self.primitiveOffset, self.primitiveCount)
+
+        return sum(a[:self.nodeCount].nbytes for a in arrays)
+
+    def _MarkBuilt(self, sahCost: float):
+        self.builtSAHCost = sahCost
+        self._builtAreas = SurfaceAreas(self.nodeMin[:self.nodeCount], self.nodeMax[:self.nodeCount])
+
+    # the nodes under nodeIndex reachable through child links, nodeIndex first
+    def _Subtree(self, nodeIndex: int = 0) -> np.ndarray:
+        levels = [np.array([nodeIndex], dtype=np.int32)]
+
+        while True:
+            inner = levels[-1][self.leftChild[levels[-1]] >= 0]
+
+            if not len(inner):
+                break
+
+            levels.append(np.concatenate((self.leftChild[inner], self.rightChild[inner])))
+
+        return np.concatenate(levels)
+
+    def _Leaves(self, nodeIndex: int = 0) -> np.ndarray:
+        nodes = self._Subtree(nodeIndex)
+        return nodes[self.leftChild[nodes] < 0]
+
+    # the leaf holding every primitive, -1 for those not in the tree
+    def _PrimitiveLeaves(self) -> np.ndarray:
+        leaves = self._Leaves()
+        objects, segments, _ = self._GatherRanges(leaves)
+
+        primitiveLeaves = np.full(len(self.objectData), -1, dtype=np.int32)
+        primitiveLeaves[objects] = leaves[segments]
+
+        return primitiveLeaves
+
+    # the leaf holding primitive index, found through the boxes that contain
+    # its bounds
+    def _FindLeaf(self, index: int):
+        minn, maxx = self.primitiveMin[index], self.primitiveMax[index]
+        stack = [0]
+
+        while stack:
+            nodeIndex = stack.pop()
+
+            if (self.nodeMin[nodeIndex] > minn).any() or (self.nodeMax[nodeIndex] < maxx).any():
+                continue
+
+            if not self.IsLeaf(nodeIndex):
+                stack += [self.leftChild[nodeIndex], self.rightChild[nodeIndex]]
+            elif index in self.LeafPrimitives(nodeIndex):
+                return nodeIndex
+
+        return None
+
+    # primitive bounds and centroids from the objects at indices, and the
+    # sphere arrays with them
+    def _ReadPrimitiveBounds(self, indices: np.ndarray):
+        others = indices
+
+        if isinstance(self.objectData, SpherePrimitives):
+            spheres = self.objectData.spheres
+            inSet = indices < len(spheres)
+
+            setIndices, others = indices[inSet], indices[~inSet]
+            center, radius = spheres.center[setIndices], spheres.radius[setIndices, None]
+
+            self.primitiveMin[setIndices] = center - radius
+            self.primitiveMax[setIndices] = center + radius
+            self._sphereArrays = None
+
+        for index in others.tolist():
+            primitive = self.objectData[index]
+            primitive.bounds = AABB(obj=primitive.object)
+            primitive.centroid = primitive.bounds.Centroid
+
+            self.primitiveMin[index] = primitive.bounds.minn.to_list()
+            self.primitiveMax[index] = primitive.bounds.maxx.to_list()
+
+            if self._sphereArrays is not None:
+                self._sphereArrays[0][index] = primitive.object.center.to_list()
+                self._sphereArrays[1][index] = primitive.object.radius
+
+        self.primitiveCentroid[indices] = (self.primitiveMin[indices] + self.primitiveMax[indices]) / 2
+
+    # refits nodes, leaves from their primitives and inner nodes from their
+    # children, then every ancestor of a node whose box changed. an ancestor
+    # reached early through a short branch is simply refitted again when a
+    # deeper one catches up
+    def _RefitNodes(self, nodes: np.ndarray):
+        self._nodeBoxes = None
+
+        while len(nodes):
+            leaf = self.leftChild[nodes] < 0
+            minn, maxx = np.empty((len(nodes), 3), np.float32), np.empty((len(nodes), 3), np.float32)
+
+            leaves, inner = nodes[leaf], nodes[~leaf]
+
+            objects, _, starts = self._GatherRanges(leaves)
+            filled = self.primitiveCount[leaves] > 0
+
+            leafMin = np.full((len(leaves), 3), np.inf, dtype=np.float32)
+            leafMax = np.full((len(leaves), 3), -np.inf, dtype=np.float32)
+
+            if len(objects):
+                leafMin[filled] = np.minimum.reduceat(self.primitiveMin[objects], starts[filled])
+                leafMax[filled] = np.maximum.reduceat(self.primitiveMax[objects], starts[filled])
+
+            minn[leaf], maxx[leaf] = leafMin, leafMax
+            minn[~leaf] = np.minimum(self.nodeMin[self.leftChild[inner]], self.nodeMin[self.rightChild[inner]])
+            maxx[~leaf] = np.maximum(self.nodeMax[self.leftChild[inner]], self.nodeMax[self.rightChild[inner]])
+
+            changed = (minn != self.nodeMin[nodes]).any(axis=1) | (maxx != self.nodeMax[nodes]).any(axis=1)
+
+            self.nodeMin[nodes], self.nodeMax[nodes] = minn, maxx
+
+            parents = self.parent[nodes[changed]]
+            nodes = np.unique(parents[parents >= 0])
+
+    # the parent of an emptied leaf takes over its sibling, returns the parent
+    def _FoldIntoParent(self, nodeIndex: int) -> int:
+        parent = self.parent[nodeIndex]
+        sibling = self.rightChild[parent] if self.leftChild[parent] == nodeIndex else self.leftChild[parent]
+
+        for array in (self.nodeMin, self.nodeMax, self.leftChild, self.rightChild, self.primitiveOffset, self.primitiveCount):
+            array[parent] = array[sibling]
+
+        if self.leftChild[parent] >= 0:
+            self.parent[self.leftChild[parent]] = parent
+            self.parent[self.rightChild[parent]] = parent
+
+        self._Orphan(np.array([nodeIndex, sibling], dtype=np.int32))
+
+        return parent
+
+    def _Orphan(self, nodes: np.ndarray):
+        self._nodeBoxes = None
+
+        self.nodeMin[nodes] = np.inf
+        self.nodeMax[nodes] = -np.inf
+        self.leftChild[nodes] = -1
+        self.rightChild[nodes] = -1
+        self.parent[nodes] = -1
+        self.primitiveCount[nodes] = 0
+
+        self.orphanCount += len(nodes)
+
+    # rebuilds the topmost inner nodes whose surface area grew by more than
+    # rebuildThreshold since they were built. the whole tree is rebuilt when
+    # the root drifted, when they hold half the primitives or more, or when
+    # half the nodes are orphans
+    def _RebuildDrifted(self) -> str:
+        nodeCount = self.nodeCount
+
+        areas = SurfaceAreas(self.nodeMin[:nodeCount], self.nodeMax[:nodeCount])
+        # nodes made since the last build (by Insert) count as not drifted
+        known = min(len(self._builtAreas), nodeCount)
+        builtAreas = areas.copy()
+        builtAreas[:known] = self._builtAreas[:known]
+
+        drifted = areas > self.rebuildThreshold * builtAreas
+
+        chosen = []
+        nodes = np.zeros(1, dtype=np.int32)
+
+        while len(nodes):
+            inner = nodes[self.leftChild[nodes] >= 0]
+            chosen.append(inner[drifted[inner]])
+
+            inner = inner[~drifted[inner]]
+            nodes = np.concatenate((self.leftChild[inner], self.rightChild[inner]))
+
+        chosen = np.concatenate(chosen)
+        subtrees = [self._Subtree(nodeIndex) for nodeIndex in chosen.tolist()]
+
+        primitiveCount = sum(int(self.primitiveCount[nodes].sum()) for nodes in subtrees)
+        total = int(self.primitiveCount[self._Leaves()].sum())
+
+        if (not len(chosen) or drifted[0] or 2 * primitiveCount >= total 
+                or 2 * (self.orphanCount + sum(len(nodes) - 1 for nodes in subtrees)) >= nodeCount):
+            self.Rebuild()
+            return "full"
+
+        for nodeIndex, nodes in zip(chosen.tolist(), subtrees):
+            objects, _, _ = self._GatherRanges(nodes[self.leftChild[nodes] < 0])
+            objects = objects.copy()
+
+            self._Orphan(nodes[1:])
+            self.leftChild[nodeIndex] = self.rightChild[nodeIndex] = -1
+
+            first = self.nodeCount
+            self.BuildSAH(nodeIndex, objects)
+
+            self._builtAreas = _GrowArray(self._builtAreas, self.nodeCount, 0)
+            rebuilt = np.append(np.arange(first, self.nodeCount), nodeIndex)
+            self._builtAreas[rebuilt] = SurfaceAreas(self.nodeMin[rebuilt], self.nodeMax[rebuilt])
+
+        return "partial"
+
+    # the inner nodes at every depth, the root's level first. nodes of one
+    # level have disjoint subtrees
+    def _InnerLevels(self) -> list:
+        levels = []
+        nodes = np.zeros(1, dtype=np.int32)
+
+        while len(nodes):
+            inner = nodes[self.leftChild[nodes] >= 0]
+
+            if len(inner):
+                levels.append(inner)
+
+            nodes = np.concatenate((self.leftChild[inner], self.rightChild[inner]))
+
+        return levels
+
+    # the best rotation under each of nodes, all of them at once. only the
+    # children of a node change their box, so the cost falls by the area they
+    # lose. returns how many nodes were rotated
+    def _RotateLevel(self, nodes: np.ndarray) -> int:
+        left, right = self.leftChild[nodes], self.rightChild[nodes]
+        leftInner, rightInner = self.leftChild[left] >= 0, self.leftChild[right] >= 0
+
+        # the grandchildren under a leaf are garbage, masked out below
+        leftLeft, leftRight = self.leftChild[left], self.rightChild[left]
+        rightLeft, rightRight = self.leftChild[right], self.rightChild[right]
+
+        def UnionArea(a, b):
+            return SurfaceAreas(np.minimum(self.nodeMin[a], self.nodeMin[b]), np.maximum(self.nodeMax[a], self.nodeMax[b]))
+
+        leftArea = SurfaceAreas(self.nodeMin[left], self.nodeMax[left])
+        rightArea = SurfaceAreas(self.nodeMin[right], self.nodeMax[right])
+
+        # (subtree, grandchild it swaps places with, area change, possible)
+        candidates = [
+            (left, rightLeft, UnionArea(left, rightRight) - rightArea, rightInner),
+            (left, rightRight, UnionArea(left, rightLeft) - rightArea, rightInner),
+            (right, leftLeft, UnionArea(right, leftRight) - leftArea, leftInner),
+            (right, leftRight, UnionArea(right, leftLeft) - leftArea, leftInner),
+            (leftLeft, rightLeft, UnionArea(rightLeft, leftRight) + UnionArea(leftLeft, rightRight) - leftArea - rightArea,
+             leftInner & rightInner),
+            (leftLeft, rightRight, UnionArea(rightRight, leftRight) + UnionArea(rightLeft, leftLeft) - leftArea - rightArea,
+             leftInner & rightInner)
+        ]
+
+        changes = np.stack([np.where(possible, change, np.inf) for _, _, change, possible in candidates])
+        best = np.argmin(changes, axis=0)
+
+        # rounding must not let a rotation and its inverse both look better
+        nodeArea = SurfaceAreas(self.nodeMin[nodes], self.nodeMax[nodes])
+        rotate = changes[best, np.arange(len(nodes))] < -1e-6 * nodeArea
+
+        if not rotate.any():
+            return 0
+
+        best = best[rotate]
+        subtrees = np.stack([candidate[0] for candidate in candidates])[:, rotate]
+        grandchildren = np.stack([candidate[1] for candidate in candidates])[:, rotate]
+
+        self._SwapSubtrees(subtrees[best, np.arange(len(best))], grandchildren[best, np.arange(len(best))])
+
+        return int(rotate.sum())
+
+    # swaps subtrees a[i] and b[i] between their parents and refits the
+    # parents, b's first since a's may be its parent now
+    def _SwapSubtrees(self, a: np.ndarray, b: np.ndarray):
+        self._nodeBoxes = None
+
+        parentA, parentB = self.parent[a], self.parent[b]
+        aLeft, bLeft = self.leftChild[parentA] == a, self.leftChild[parentB] == b
+
+        self.leftChild[parentA[aLeft]], self.rightChild[parentA[~aLeft]] = b[aLeft], b[~aLeft]
+        self.leftChild[parentB[bLeft]], self.rightChild[parentB[~bLeft]] = a[bLeft], a[~bLeft]
+        self.parent[a], self.parent[b] = parentB, parentA
+
+        for nodes in (parentB, parentA):
+            self.nodeMin[nodes] = np.minimum(self.nodeMin[self.leftChild[nodes]], self.nodeMin[self.rightChild[nodes]])
+            self.nodeMax[nodes] = np.maximum(self.nodeMax[self.leftChild[nodes]], self.nodeMax[self.rightChild[nodes]])
+
+        # the rotated boxes are as good as built, Update measures drift from them
+        known = np.concatenate((parentA, parentB))
+        known = known[known < len(self._builtAreas)]
+        self._builtAreas[known] = SurfaceAreas(self.nodeMin[known], self.nodeMax[known])
+
+    # the share of inner nodes Optimize reinserts in a sweep, the worst one
+    # last. a box much bigger than its children, both the smaller one and
+    # their mean, is wasted area (the combined measure of Bittner et al.). the
+    # root and its children stay where they are
+    def _ReinsertCandidates(self) -> list:
+        nodes = np.concatenate(self._InnerLevels()[2:] or [np.zeros(0, dtype=np.int32)])
+
+        area = SurfaceAreas(self.nodeMin[nodes], self.nodeMax[nodes])
+        leftArea = SurfaceAreas(self.nodeMin[self.leftChild[nodes]], self.nodeMax[self.leftChild[nodes]])
+        rightArea = SurfaceAreas(self.nodeMin[self.rightChild[nodes]], self.nodeMax[self.rightChild[nodes]])
+
+        smallest = np.maximum(np.minimum(leftArea, rightArea), np.finfo(np.float32).tiny)
+        mean = np.maximum((leftArea + rightArea) / 2, np.finfo(np.float32).tiny)
+
+        waste = area * (area / smallest) * (area / mean)
+        count = max(int(self._reinsertFraction * len(nodes)), min(len(nodes), 16))
+
+        return nodes[np.argsort(waste)[-count:]].tolist()
+
+    # takes nodeIndex out of the tree with its parent, whose place the sibling
+    # takes, and reinserts it next to the node where the new parent plus the
+    # growth of every box above it is smallest. the search goes a level at a
+    # time and drops a branch once the growth above it alone is more than the
+    # best cost found. returns whether the node moved
+    def _Reinsert(self, nodeIndex: int) -> bool:
+        parent = int(self.parent[nodeIndex])
+
+        if parent <= 0:
+            return False
+
+        grandparent = int(self.parent[parent])
+        sibling = int(self.rightChild[parent] if self.leftChild[parent] == nodeIndex else self.leftChild[parent])
+
+        self._ReplaceChild(grandparent, parent, sibling)
+        self._RefitPath(grandparent)
+
+        minn, maxx = self.nodeMin[nodeIndex], self.nodeMax[nodeIndex]
+        nodeArea = SurfaceAreas(minn, maxx)
+
+        def Growth(nodes):
+            areas = SurfaceAreas(self.nodeMin[nodes], self.nodeMax[nodes])
+            return SurfaceAreas(np.minimum(self.nodeMin[nodes], minn), np.maximum(self.nodeMax[nodes], maxx)) - areas, areas
+
+        # where it came from, anything else has to beat it by more than rounding
+        growth, areas = Growth(self._Ancestors(sibling))
+        bestCost = growth.sum() + areas[0] - 1e-6 * areas[-1]
+        bestNode = sibling
+
+        growth, _ = Growth(np.zeros(1, dtype=np.int32))
+        nodes = np.array([self.leftChild[0], self.rightChild[0]])
+        inherited = np.repeat(growth, 2)
+
+        while len(nodes):
+            growth, areas = Growth(nodes)
+            cost = inherited + areas + growth
+            best = int(np.argmin(cost))
+
+            if cost[best] < bestCost:
+                bestCost, bestNode = cost[best], int(nodes[best])
+
+            inherited = inherited + growth
+            descend = (self.leftChild[nodes] >= 0) & (inherited + nodeArea < bestCost)
+
+            nodes = np.concatenate((self.leftChild[nodes[descend]], self.rightChild[nodes[descend]]))
+            inherited = np.concatenate((inherited[descend], inherited[descend]))
+
+        self._ReplaceChild(int(self.parent[bestNode]), bestNode, parent)
+
+        self.leftChild[parent], self.rightChild[parent] = bestNode, nodeIndex
+        self.parent[bestNode] = parent
+
+        self._RefitPath(parent)
+
+        if parent < len(self._builtAreas):
+            self._builtAreas[parent] = SurfaceAreas(self.nodeMin[parent], self.nodeMax[parent])
+
+        return bestNode != sibling
+
+    # nodeIndex and the nodes above it up to the root
+    def _Ancestors(self, nodeIndex: int) -> np.ndarray:
+        path = [nodeIndex]
+
+        while path[-1] != 0:
+            path.append(int(self.parent[path[-1]]))
+
+        return np.array(path, dtype=np.int32)
+
+    # refits the inner node nodeIndex from its children and every node above
+    # it. each box on the path is the one below it grown by that one's
+    # sibling, a running minimum and maximum up the path
+    def _RefitPath(self, nodeIndex: int):
+        self._nodeBoxes = None
+
+        path = self._Ancestors(nodeIndex)
+        children, parents = path[:-1], path[1:]
+        siblings = np.where(self.leftChild[parents] == children, self.rightChild[parents], self.leftChild[parents])
+
+        left, right = self.leftChild[nodeIndex], self.rightChild[nodeIndex]
+
+        minn = np.concatenate((np.minimum(self.nodeMin[left], self.nodeMin[right])[None], self.nodeMin[siblings]))
+        maxx = np.concatenate((np.maximum(self.nodeMax[left], self.nodeMax[right])[None], self.nodeMax[siblings]))
+
+        self.nodeMin[path] = np.minimum.accumulate(minn)
+        self.nodeMax[path] = np.maximum.accumulate(maxx)
+
+    # puts child in the place of the old one under nodeIndex
+    def _ReplaceChild(self, nodeIndex: int, old: int, child: int):
+        if self.leftChild[nodeIndex] == old:
+            self.leftChild[nodeIndex] = child
+        else:
+            self.rightChild[nodeIndex] = child
+
+        self.parent[child] = nodeIndex
+
+    def _AllocateNode(self, parent: int = -1) -> int:
+        return int(self._AllocateNodes(np.array([parent]))[0])
+
+    def _AllocateNodes(self, parents: np.ndarray) -> np.ndarray:
+        start = self.nodeCount
+        self._ReserveNodes(start + len(parents))
+        self.nodeCount += len(parents)
+
+        nodes = np.arange(start, self.nodeCount, dtype=np.int32)
+        self._nodeBoxes = None
+
+        self.nodeMin[nodes] = np.inf
+        self.nodeMax[nodes] = -np.inf
+        self.leftChild[nodes] = -1
+        self.rightChild[nodes] = -1
+        self.parent[nodes] = parents
+        self.primitiveOffset[nodes] = 0
+        self.primitiveCount[nodes] = 0
+
+        return nodes
+
+    def _ReserveNodes(self, count: int):
+        capacity = len(self.leftChild)
+
+        if count <= capacity:
+            return
+
+        capacity = max(count, 2 * capacity)
+
+        self.nodeMin = _GrowArray(self.nodeMin, capacity, np.inf)
+        self.nodeMax = _GrowArray(self.nodeMax, capacity, -np.inf)
+        self.leftChild = _GrowArray(self.leftChild, capacity, -1)
+        self.rightChild = _GrowArray(self.rightChild, capacity, -1)
+        self.parent = _GrowArray(self.parent, capacity, -1)
+        self.primitiveOffset = _GrowArray(self.primitiveOffset, capacity, 0)
+        self.primitiveCount = _GrowArray(self.primitiveCount, capacity, 0)
+
+    def _ReservePrimitiveIndices(self, count: int):
+        capacity = len(self.primitiveIndices)
+
+        if count <= capacity:
+            return
+
+        self.primitiveIndices = _GrowArray(self.primitiveIndices, max(count, 2 * capacity), 0)
+
+
+
+    def _GrowNode(self, nodeIndex: int, bounds: AABB):
+        self._nodeBoxes = None
+        np.minimum(self.nodeMin[nodeIndex], bounds.minn, out=self.nodeMin[nodeIndex])
+        np.maximum(self.nodeMax[nodeIndex], bounds.maxx, out=self.nodeMax[nodeIndex])
+
+    # leaf ranges are appended to primitiveIndices, a leaf that changes is moved
+    # to the end of it. BuildSAH packs subtrees tightly, Insert leaves gaps.
+    def _SetLeaf(self, nodeIndex: int, objects):
+        count = len(objects)
+        offset = self.primitiveIndexCount
+
+        self._ReservePrimitiveIndices(offset + count)
+        self.primitiveIndices[offset:offset + count] = objects
+        self.primitiveIndexCount += count
+
+        self.primitiveOffset[nodeIndex] = offset
+        self.primitiveCount[nodeIndex] = count
+
+    def _FitNode(self, nodeIndex: int):
+        objects = self.LeafPrimitives(nodeIndex)
+
+        if len(objects):
+            self._nodeBoxes = None
+            self.nodeMin[nodeIndex] = self.primitiveMin[objects].min(axis=0)
+            self.nodeMax[nodeIndex] = self.primitiveMax[objects].max(axis=0)
+
+    # the primitives of the nodes' ranges back to back, with the node (position
+    # in nodes) each belongs to and where each node's run starts
+    def _GatherRanges(self, nodes: np.ndarray):
+        counts = self.primitiveCount[nodes]
+        starts = np.cumsum(counts) - counts
+
+        segments = np.repeat(np.arange(len(nodes)), counts)
+        positions = np.repeat(self.primitiveOffset[nodes] - starts, counts) + np.arange(len(segments))
+
+        return self.primitiveIndices[positions], segments, starts
+
+    # turns the chosen leaves into inner nodes. each range is reordered in place
+    # so the two new leaves own its left and right parts, returns the new leaves.
+    def _Partition(self, nodes: np.ndarray, leftMask: np.ndarray, segments: np.ndarray, split: np.ndarray):
+        leftMask, segments = leftMask[split[segments]], segments[split[segments]]
+        nodes = nodes[split]
+
+        if not len(nodes):
+            return nodes
+
+        segments = np.cumsum(split)[segments] - 1
+        counts = self.primitiveCount[nodes]
+        offsets = self.primitiveOffset[nodes]
+        starts = np.cumsum(counts) - counts
+
+        positions = np.repeat(offsets - starts, counts) + np.arange(len(segments))
+
+        # a stable sort, the order within each side is kept
+        order = np.lexsort((~leftMask, segments))
+        objects = self.primitiveIndices[positions][order]
+        self.primitiveIndices[positions] = objects
+
+        leftCounts = np.bincount(segments, weights=leftMask, minlength=len(nodes)).astype(np.int32)
+
+        children = self._AllocateNodes(np.repeat(nodes, 2))
+        leftChildren, rightChildren = children[0::2], children[1::2]
+
+        self.leftChild[nodes] = leftChildren
+        self.rightChild[nodes] = rightChildren
+
+        self.primitiveOffset[leftChildren] = offsets
+        self.primitiveCount[leftChildren] = leftCounts
+        self.primitiveOffset[rightChildren] = offsets + leftCounts
+        self.primitiveCount[rightChildren] = counts - leftCounts
+
+        self.primitiveOffset[nodes] = 0
+        self.primitiveCount[nodes] = 0
+
+        childStarts = np.stack((starts, starts + leftCounts), axis=1).ravel()
+        self._nodeBoxes = None
+        self.nodeMin[children] = np.minimum.reduceat(self.primitiveMin[objects], childStarts)
+        self.nodeMax[children] = np.maximum.reduceat(self.primitiveMax[objects], childStarts)
+
+        return children
+
+    def _AddPrimitive(self, primitive) -> int:
+        primitiveIndex = len(self.objectData)
+        self._ReservePrimitives(primitiveIndex + 1)
+        self._sphereArrays = None
+
+        self.objectData.append(primitive)
+        self.primitiveMin[primitiveIndex] = primitive.bounds.minn.to_list()
+        self.primitiveMax[primitiveIndex] = primitive.bounds.maxx.to_list()
+        self.primitiveCentroid[primitiveIndex] = (self.primitiveMin[primitiveIndex] + self.primitiveMax[primitiveIndex]) / 2
+
+        return primitiveIndex
+
+    def _ReservePrimitives(self, count: int):
+        capacity = len(self.primitiveMin)
+
+        if count <= capacity:
+            return
+
+        capacity = max(count, 2 * capacity)
+
+        self.primitiveMin = _GrowArray(self.primitiveMin, capacity, 0)
+        self.primitiveMax = _GrowArray(self.primitiveMax, capacity, 0)
+        self.primitiveCentroid = _GrowArray(self.primitiveCentroid, capacity, 0)
     
-    def _RightChildExists(self, nodeIndex) -> bool:
-        return self._GetRightNodeIndex(nodeIndex) < len(self.nodes)
+    def _ReserveMortonCodes(self, count: int):
+        if count > len(self.primitiveMorton):
+            self.primitiveMorton = _GrowArray(self.primitiveMorton, count, 0)
 
 
 def DrawAABB(box: AABB, screen, color):
@@ -476,10 +2138,10 @@ if __name__ == "__main__":
 
         ray = Ray(glm.vec3(mouse_x, mouse_y, 0), glm.vec3(1, -1, 0))
 
-        for node in bvh.nodes:
-            DrawAABB(node.boundingVolume, screen, "#0000FF00")
+        for nodeIndex in range(bvh.nodeCount):
+            DrawAABB(bvh.NodeBounds(nodeIndex), screen, "#0000FF00")
 
-            for leaf in node.leafNodes:
+            for leaf in bvh.LeafPrimitives(nodeIndex):
                 DrawCircle(bvh.objectData[leaf].object, screen)
         
         def RayHitFunction(userData):
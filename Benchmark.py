@@ -0,0 +1,493 @@
+import os
+import sys
+import tempfile
+import time
+
+import glm
+import numpy as np
+
+from BVH import *
+from Scene import *
+from WideBVH import *
+from InstanceBVH import *
+
+# usage: python Benchmark.py <benchmark> [primitive count] [scene]
+# scenes are procedural sphere sets, "uniform" fills a cube and "clustered"
+# packs the spheres into a few dozen gaussian blobs of different sizes.
+
+def UniformScene(count: int, seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+
+    centers = rng.uniform(-100, 100, (count, 3))
+    radii = rng.uniform(0.2, 1.5, count)
+
+    return _MakeSpheres(centers, radii, rng)
+
+def ClusteredScene(count: int, seed: int = 0) -> list:
+    rng = np.random.default_rng(seed)
+
+    clusterCount = 40
+    clusterCenters = rng.uniform(-500, 500, (clusterCount, 3))
+    clusterSizes = rng.choice([2.0, 10.0, 60.0], clusterCount)
+
+    cluster = rng.integers(0, clusterCount, count)
+    centers = clusterCenters[cluster] + rng.normal(0, 1, (count, 3)) * clusterSizes[cluster, None]
+    radii = rng.uniform(0.2, 1.5, count)
+
+    return _MakeSpheres(centers, radii, rng)
+
+def _MakeSpheres(centers: np.ndarray, radii: np.ndarray, rng) -> list:
+    colours = rng.uniform(0, 1, (len(centers), 3))
+    spheres = []
+
+    for i, (center, radius, colour) in enumerate(zip(centers.tolist(), radii.tolist(), colours.tolist())):
+        sphere = Sphere(glm.vec3(center), radius, glm.vec3(colour), 0.0)
+        sphere.index = i
+        spheres.append(sphere)
+
+    return spheres
+
+# rays from random points in the scene bounds aimed at random spheres
+def RandomRays(objects: list, count: int, seed: int = 1):
+    rng = np.random.default_rng(seed)
+    centers = np.array([o.center.to_list() for o in objects], dtype=np.float32)
+
+    minn, maxx = centers.min(axis=0), centers.max(axis=0)
+    origins = rng.uniform(minn, maxx, (count, 3)).astype(np.float32)
+    targets = centers[rng.integers(0, len(centers), count)]
+
+    return origins, targets - origins
+
+# objects cut into clusters of clusterSize spheres, each shrunk to a tenth
+# around its own origin, and instanceCount copies of them spread over the
+# bounds of objects with random rotations and scales. returns the built
+# InstanceBVH
+def InstancedScene(objects: list, clusterSize: int, instanceCount: int, seed: int = 0) -> InstanceBVH:
+    rng = np.random.default_rng(seed)
+    spheres = SphereSet.FromObjects(objects)
+
+    instanced = InstanceBVH()
+
+    for start in range(0, len(spheres), clusterSize):
+        cluster = SphereSet(spheres.data[start:start + clusterSize].copy())
+        cluster.center[:] = (cluster.center - cluster.center.mean(axis=0)) * 0.1
+
+        instanced.AddCluster(cluster)
+
+    minn, maxx = spheres.center.min(axis=0), spheres.center.max(axis=0)
+    transforms = [RandomSimilarity(rng, minn, maxx) for _ in range(instanceCount)]
+
+    instanced.AddInstances(rng.integers(0, len(instanced.clusters), instanceCount), transforms)
+    instanced.Build()
+
+    return instanced
+
+SCENES = {
+    "uniform": UniformScene,
+    "clustered": ClusteredScene
+}
+
+
+def BenchmarkBuild(objects: list):
+    print(f"{'method':>8} {'nodes':>9} {'setup (s)':>10} {'build (s)':>10} {'SAH cost':>10}")
+
+    for method in ("sah", "lbvh", "hybrid"):
+        bvh = BVH()
+        bvh.Build(objects, method)
+
+        stats = bvh.buildStatistics
+        print(f"{method:>8} {stats['nodes']:>9} {stats['setupTime']:>10.3f} {stats['buildTime']:>10.3f} {stats['sahCost']:>10.2f}")
+
+    # the same SAH build from a SphereSet, which skips the per object setup
+    bvh = BVH()
+    bvh.Build(SphereSet.FromObjects(objects))
+
+    stats = bvh.buildStatistics
+    print(f"{'sah set':>8} {stats['nodes']:>9} {stats['setupTime']:>10.3f} {stats['buildTime']:>10.3f} {stats['sahCost']:>10.2f}")
+
+def BenchmarkParallelBuild(objects: list):
+    print(f"{'workers':>8} {'build (s)':>10} {'SAH cost':>10}")
+
+    workerCounts = [None, 1]
+    while workerCounts[-1] < os.cpu_count():
+        workerCounts.append(min(2 * workerCounts[-1], os.cpu_count()))
+
+    for workers in workerCounts:
+        bvh = BVH()
+        bvh.Build(objects, "sah", workers)
+
+        stats = bvh.buildStatistics
+        print(f"{str(workers or 'serial'):>8} {stats['buildTime']:>10.3f} {stats['sahCost']:>10.2f}")
+
+def BenchmarkTraversal(objects: list, rayCount: int = 2000):
+    bvh = BVH()
+    bvh.Build(objects)
+
+    origins, directions = RandomRays(objects, rayCount)
+    rays = [Ray(glm.vec3(o), glm.vec3(d)) for o, d in zip(origins, directions)]
+
+    # shadow rays stop anywhere up to twice the closest hit, about half are blocked
+    distances, _ = bvh.TraceRays(origins, directions)
+    limits = np.random.default_rng(2).uniform(0, 2, rayCount) * np.where(np.isfinite(distances), distances, 1000)
+
+    queries = {
+        "TraceRay": lambda statistics: [bvh.TraceRay(ray, RaySphereIntersection, statistics=statistics) for ray in rays],
+        "Occluded": lambda statistics: [bvh.Occluded(ray, tMax, statistics=statistics) for ray, tMax in zip(rays, limits)],
+        "TraceRays": lambda statistics: bvh.TraceRays(origins, directions, statistics=statistics)
+    }
+
+    print(f"{'query':>10} {'us/ray':>8} {'visited':>8} {'pruned':>8} {'prim tests':>10}")
+
+    for name, query in queries.items():
+        statistics = {}
+
+        start = time.perf_counter()
+        query(statistics)
+        elapsed = time.perf_counter() - start
+
+        perRay = {key: value / statistics["rays"] for key, value in statistics.items()}
+
+        print(f"{name:>10} {elapsed / rayCount * 1e6:>8.1f} {perRay['nodesVisited']:>8.1f} "
+              f"{perRay['nodesPruned']:>8.1f} {perRay['primitiveTests']:>10.1f}")
+
+# the binary tree against its 4 and 8 wide collapses, with full precision and
+# quantized child bounds, TraceRay and TraceRays on the same rays. visited
+# counts the boxes entered, leaves included. bytes are those of the node
+# arrays, per node and per primitive
+def BenchmarkWide(objects: list, rayCount: int = 2000):
+    bvh = BVH()
+    bvh.Build(objects)
+
+    origins, directions = RandomRays(objects, rayCount)
+    rays = [Ray(glm.vec3(o), glm.vec3(d)) for o, d in zip(origins, directions)]
+
+    layouts = {"binary": bvh}
+
+    for width in (4, 8):
+        layouts[f"wide {width}"] = WideBVH(bvh, width)
+
+        for bits in (16, 8):
+            layouts[f"wide {width} q{bits}"] = WideBVH(bvh, width, bits)
+
+    # the first call builds the vec3 copy of the node bounds
+    bvh.TraceRay(rays[0], RaySphereIntersection)
+
+    print(f"{'layout':>11} {'nodes':>8} {'B/node':>7} {'B/prim':>7} {'collapse (s)':>12} "
+          f"{'query':>10} {'us/ray':>8} {'visited':>8} {'prim tests':>10}")
+
+    for name, tree in layouts.items():
+        queries = {
+            "TraceRay": lambda statistics: [tree.TraceRay(ray, RaySphereIntersection, statistics=statistics) for ray in rays],
+            "TraceRays": lambda statistics: tree.TraceRays(origins, directions, statistics=statistics)
+        }
+
+        for query, trace in queries.items():
+            statistics = {}
+
+            start = time.perf_counter()
+            trace(statistics)
+            elapsed = time.perf_counter() - start
+
+            print(f"{name:>11} {tree.nodeCount:>8} {tree.NodeMemoryUsage / tree.nodeCount:>7.1f} "
+                  f"{tree.NodeMemoryUsage / len(objects):>7.1f} {getattr(tree, 'collapseTime', 0):>12.3f} "
+                  f"{query:>10} {elapsed / rayCount * 1e6:>8.1f} {statistics['nodesVisited'] / rayCount:>8.1f} "
+                  f"{statistics['primitiveTests'] / rayCount:>10.1f}")
+
+# moves movingCount spheres of a SphereSet a little every frame and keeps the
+# tree up to date with BVH.Update, against a full build per frame. the first
+# frames are refits whose SAH cost creeps up until Update rebuilds
+def BenchmarkUpdate(objects: list, movingCount: int = 10000, frames: int = 30):
+    spheres = SphereSet.FromObjects(objects)
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    buildTime = bvh.buildStatistics["setupTime"] + bvh.buildStatistics["buildTime"]
+    print(f"full build {buildTime * 1000:.1f}ms, SAH cost {bvh.builtSAHCost:.2f}")
+
+    rng = np.random.default_rng(3)
+    moving = rng.choice(len(spheres), min(movingCount, len(spheres)), replace=False)
+    velocities = rng.normal(0, 1, (len(moving), 3)).astype(np.float32)
+
+    print(f"{'frame':>6} {'update (ms)':>12} {'of build':>9} {'rebuild':>8} {'SAH cost':>9}")
+
+    for frame in range(frames):
+        spheres.center[moving] += velocities
+
+        bvh.Update(moving)
+        stats = bvh.updateStatistics
+
+        print(f"{frame:>6} {stats['updateTime'] * 1000:>12.1f} {stats['updateTime'] / buildTime:>9.1%} "
+              f"{stats['rebuild']:>8} {stats['sahCost']:>9.2f}")
+
+# grows a tree with Insert, one sphere at a time, then runs BVH.Optimize for
+# frameBudget seconds a frame as a renderer would between frames. reported
+# after 1, 2, 4... frames: the time spent optimizing, the SAH cost, TraceRays
+# per ray and how many microseconds per ray each millisecond of optimizing
+# saved. a fresh build of the same spheres is the target
+def BenchmarkOptimize(objects: list, insertCount: int = 2000, frameBudget: float = 0.005,
+                      frames: int = 1024, rayCount: int = 2000):
+    objects = objects[:insertCount]
+
+    bvh = BVH()
+    bvh.Build(objects[:1])
+
+    start = time.perf_counter()
+
+    for object_ in objects[1:]:
+        bvh.Insert(object_)
+
+    print(f"{len(objects)} inserts {time.perf_counter() - start:.2f}s")
+
+    origins, directions = RandomRays(objects, rayCount)
+
+    def TraceTime(tree):
+        start = time.perf_counter()
+        tree.TraceRays(origins, directions)
+        return (time.perf_counter() - start) / rayCount * 1e6
+
+    insertedTrace = TraceTime(bvh)
+    optimizeTime = 0.0
+
+    print(f"{'frame':>6} {'optimize (ms)':>14} {'SAH cost':>9} {'us/ray':>8} {'us/ray per ms':>14}")
+    print(f"{0:>6} {0:>14.1f} {bvh.SAHCost():>9.2f} {insertedTrace:>8.1f} {'':>14}")
+
+    for frame in range(1, frames + 1):
+        bvh.Optimize(frameBudget)
+        stats = bvh.optimizeStatistics
+        optimizeTime += stats["optimizeTime"]
+
+        if frame & (frame - 1) == 0 or frame == frames or stats["converged"]:
+            traceTime = TraceTime(bvh)
+
+            print(f"{frame:>6} {optimizeTime * 1000:>14.1f} {stats['sahAfter']:>9.2f} {traceTime:>8.1f} "
+                  f"{(insertedTrace - traceTime) / (optimizeTime * 1000):>14.3f}")
+
+        if stats["converged"]:
+            break
+
+    fresh = BVH()
+    fresh.Build(objects)
+
+    buildTime = fresh.buildStatistics["setupTime"] + fresh.buildStatistics["buildTime"]
+    print(f" built {buildTime * 1000:>14.1f} {fresh.SAHCost():>9.2f} {TraceTime(fresh):>8.1f}")
+
+# clusterCount clusters of clusterSize spheres instanced into a scene of
+# about as many spheres as objects, the two-level BVH against a flat BVH
+# over the flattened scene. build times, bytes and TraceRays on the same
+# rays, visited counts the boxes of both levels
+def BenchmarkInstancing(objects: list, clusterSize: int = 100, clusterCount: int = 8, rayCount: int = 2000):
+    instanced = InstancedScene(objects[:clusterSize * clusterCount], clusterSize, max(len(objects) // clusterSize, 1))
+    spheres = instanced.Flatten()
+
+    flat = BVH()
+    flat.Build(spheres)
+
+    stats = instanced.buildStatistics
+    print(f"{stats['clusters']} clusters of {clusterSize} spheres, {stats['instances']} instances, "
+          f"{stats['instancedSpheres']} spheres")
+
+    origins, directions = RandomRays(objects, rayCount)
+
+    layouts = {
+        "flat": (flat, flat.buildStatistics["setupTime"] + flat.buildStatistics["buildTime"], 
+                 flat.MemoryUsage + spheres.data.nbytes),
+        "two-level": (instanced, stats["clusterBuildTime"] + stats["topBuildTime"], instanced.MemoryUsage)
+    }
+
+    expected = flat.TraceRays(origins, directions)
+
+    print(f"{'layout':>10} {'build (s)':>10} {'MB':>8} {'us/ray':>8} {'visited':>8} {'prim tests':>10} {'differ':>7}")
+
+    for name, (tree, buildTime, memory) in layouts.items():
+        statistics = {}
+
+        start = time.perf_counter()
+        hits = tree.TraceRays(origins, directions, statistics=statistics)
+        elapsed = time.perf_counter() - start
+
+        differ = np.count_nonzero((hits[1] != expected[1]) & ~np.isclose(hits[0], expected[0], rtol=1e-3, atol=1e-3))
+
+        print(f"{name:>10} {buildTime:>10.3f} {memory / 2 ** 20:>8.2f} {elapsed / rayCount * 1e6:>8.1f} "
+              f"{statistics['nodesVisited'] / rayCount:>8.1f} {statistics['primitiveTests'] / rayCount:>10.1f} {differ:>7}")
+
+# the spatial queries against brute force over every sphere, one query at a
+# time in numpy, for queryCount boxes and spheres of 1 to 10 units and the k
+# nearest spheres to points, all placed at random in the scene bounds.
+# "scalar" calls QueryBox, QuerySphere and Nearest per query, "batched" the
+# batched variants with every query at once
+def BenchmarkQueries(objects: list, queryCount: int = 1000, k: int = 8):
+    spheres = SphereSet.FromObjects(objects)
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    # the scalar queries walk the vec3 node boxes, built once here
+    bvh.NodeBoxes()
+    bvh.SphereArrays()
+
+    rng = np.random.default_rng(4)
+    points = rng.uniform(spheres.center.min(axis=0), spheres.center.max(axis=0), (queryCount, 3)).astype(np.float32)
+    extents = rng.uniform(1, 10, (queryCount, 3)).astype(np.float32)
+    radii = rng.uniform(1, 10, queryCount)
+
+    centers, sphereRadii = spheres.center.astype(np.float64), spheres.radius.astype(np.float64)
+    boxes = [AABB(glm.vec3(*minn), glm.vec3(*maxx)) for minn, maxx in zip((points - extents).tolist(), (points + extents).tolist())]
+
+    def Distances(point):
+        offsets = centers - point.astype(np.float64)
+        return np.sqrt(np.einsum("ij,ij->i", offsets, offsets))
+
+    def NearestBruteForce(point):
+        distances = np.maximum(Distances(point) - sphereRadii, 0)
+        nearest = np.argpartition(distances, k)[:k] if len(distances) > k else np.arange(len(distances))
+
+        return nearest[np.lexsort((nearest, distances[nearest]))]
+
+    # results as one list of arrays per query, whichever way they were found
+    def Split(pairs):
+        queries, found = pairs
+        return np.split(found, np.searchsorted(queries, np.arange(1, queryCount)))
+
+    queries = {
+        "box": {
+            "brute force": lambda statistics: [np.flatnonzero(PointBoxDistances(centers, p - e, p + e) <= sphereRadii)
+                                               for p, e in zip(points, extents)],
+            "scalar": lambda statistics: [bvh.QueryBox(box, statistics) for box in boxes],
+            "batched": lambda statistics: Split(bvh.QueryBoxes(points - extents, points + extents, statistics))
+        },
+        "sphere": {
+            "brute force": lambda statistics: [np.flatnonzero(Distances(p) <= sphereRadii + r) for p, r in zip(points, radii)],
+            "scalar": lambda statistics: [bvh.QuerySphere(p, r, statistics) for p, r in zip(points, radii)],
+            "batched": lambda statistics: Split(bvh.QuerySpheres(points, radii, statistics))
+        },
+        f"nearest {k}": {
+            "brute force": lambda statistics: [NearestBruteForce(p) for p in points],
+            "scalar": lambda statistics: [bvh.Nearest(p, k, statistics)[0] for p in points],
+            "batched": lambda statistics: list(bvh.NearestPoints(points, k, statistics)[0])
+        }
+    }
+
+    print(f"{'query':>10} {'method':>12} {'us/query':>9} {'speedup':>8} {'visited':>8} {'prim tests':>10} {'match':>6}")
+
+    for name, methods in queries.items():
+        expected, bruteForceTime = None, None
+
+        for method, query in methods.items():
+            statistics = {}
+
+            start = time.perf_counter()
+            results = query(statistics)
+            elapsed = time.perf_counter() - start
+
+            if expected is None:
+                expected, bruteForceTime = results, elapsed
+
+            match = all(np.array_equal(a, b) for a, b in zip(expected, results))
+            visited = statistics.get("nodesVisited", 0) / queryCount
+            tests = statistics.get("primitiveTests", len(objects) * queryCount) / queryCount
+
+            print(f"{name:>10} {method:>12} {elapsed / queryCount * 1e6:>9.1f} {bruteForceTime / elapsed:>8.1f} "
+                  f"{visited:>8.1f} {tests:>10.1f} {str(match):>6}")
+
+# microseconds per call of the scalar value types and of a TraceRay
+def BenchmarkValueTypes(objects: list, rayCount: int = 2000):
+    bvh = BVH()
+    bvh.Build(objects)
+
+    origins, directions = RandomRays(objects, rayCount)
+    origins = [glm.vec3(*o) for o in origins.tolist()]
+    directions = [glm.vec3(*d) for d in directions.tolist()]
+
+    rays = [Ray(o, d) for o, d in zip(origins, directions)]
+    boxes = [BVHPrimitive(o).bounds for o in objects]
+    box = AABB()
+
+    # the first call builds the vec3 copy of the node bounds
+    bvh.TraceRay(rays[0], RaySphereIntersection)
+
+    operations = {
+        "Ray": lambda: [Ray(o, d) for o, d in zip(origins, directions)],
+        "GrowSphere": lambda: [box.GrowSphere(o) for o in objects],
+        "GrowBox": lambda: [box.GrowBox(b) for b in boxes],
+        "GrowPoint": lambda: [box.GrowPoint(o) for o in origins],
+        "SurfaceArea": lambda: [b.SurfaceArea for b in boxes],
+        "Centroid": lambda: [b.Centroid for b in boxes],
+        "TraceRay": lambda: [bvh.TraceRay(ray, RaySphereIntersection) for ray in rays]
+    }
+
+    print(f"{'operation':>12} {'us/call':>8}")
+
+    for name, operation in operations.items():
+        count = len(operation())
+
+        start = time.perf_counter()
+        operation()
+        elapsed = time.perf_counter() - start
+
+        print(f"{name:>12} {elapsed / count * 1e6:>8.3f}")
+
+# YAML is only timed on the first yamlCount spheres, it takes minutes past that
+def BenchmarkSceneIO(objects: list, yamlCount: int = 10000):
+    columns = SceneColumns(objects)
+
+    with tempfile.TemporaryDirectory() as directory:
+        binaryPath = os.path.join(directory, "scene.bin")
+        yamlPath = os.path.join(directory, "scene.yaml")
+
+        timings = []
+
+        start = time.perf_counter()
+        with SceneWriter(binaryPath) as writer:
+            for i in range(0, len(objects), 65536):
+                writer.Write(*(columns[name][i:i + 65536] for name, _ in COLUMNS))
+        timings.append(("binary", len(objects), "save", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        loaded = LoadSceneColumns(binaryPath)
+        timings.append(("binary", len(objects), "load", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        SphereData(loaded)
+        timings.append(("binary", len(objects), "upload data", time.perf_counter() - start))
+
+        subset = objects[:yamlCount]
+
+        start = time.perf_counter()
+        SaveScene(yamlPath, subset)
+        timings.append(("yaml", len(subset), "save", time.perf_counter() - start))
+
+        start = time.perf_counter()
+        LoadScene(yamlPath)
+        timings.append(("yaml", len(subset), "load", time.perf_counter() - start))
+
+        print(f"{'format':>8} {'spheres':>9} {'step':>12} {'ms':>10}")
+
+        for format, count, step, seconds in timings:
+            print(f"{format:>8} {count:>9} {step:>12} {seconds * 1000:>10.2f}")
+
+
+BENCHMARKS = {
+    "build": BenchmarkBuild,
+    "parallel": BenchmarkParallelBuild,
+    "traversal": BenchmarkTraversal,
+    "wide": BenchmarkWide,
+    "update": BenchmarkUpdate,
+    "optimize": BenchmarkOptimize,
+    "instancing": BenchmarkInstancing,
+    "queries": BenchmarkQueries,
+    "sceneio": BenchmarkSceneIO,
+    "values": BenchmarkValueTypes
+}
+
+
+if __name__ == "__main__":
+    name = sys.argv[1] if len(sys.argv) > 1 else "build"
+    count = int(sys.argv[2]) if len(sys.argv) > 2 else 100000
+    scene = sys.argv[3] if len(sys.argv) > 3 else "uniform"
+
+    start = time.perf_counter()
+    objects = SCENES[scene](count)
+    print(f"{scene} scene, {count} spheres generated in {time.perf_counter() - start:.2f}s")
+
+    BENCHMARKS[name](objects)
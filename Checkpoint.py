@@ -0,0 +1,156 @@
+import hashlib
+import os
+import time
+
+import glm
+import numpy as np
+
+from Camera import *
+from Scene import *
+
+# a checkpoint file is a 256 byte header followed by the accumulation buffer
+# (height, width, 4) float32 and the seed image (height, width) uint32, both
+# with row 0 at the bottom like the GL textures. the whole file is memory
+# mapped, saving copies the buffers in and flushes.
+
+HEADER = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u4"),
+    ("width", "<u4"),
+    ("height", "<u4"),
+    ("frameIndex", "<u8"),
+    ("sceneHash", "S32"),
+    ("cameraHash", "S32"),
+    ("camera", "<f8", (10,))
+])
+
+HEADER_SIZE = 256
+MAGIC = b"RTCK"
+VERSION = 1
+
+
+# hashes the float32 columns, so a scene hashes the same from YAML or binary
+def SceneHash(columns: dict) -> bytes:
+    digest = hashlib.sha256()
+
+    for name, _ in COLUMNS:
+        digest.update(np.ascontiguousarray(columns[name], dtype=np.float32).tobytes())
+
+    return digest.digest()
+
+# fov, aspect ratio, near and far planes, position and forward
+def CameraArray(camera: Camera) -> np.ndarray:
+    return np.array([camera.fov, camera.aspectRatio, camera.nearPlane, camera.farPlane,
+                     *camera.position.to_list(), *camera.forward.to_list()], dtype=np.float64)
+
+def CameraHash(camera: Camera, width: int, height: int) -> bytes:
+    return hashlib.sha256(CameraArray(camera).tobytes() + np.array([width, height], "<u4").tobytes()).digest()
+
+
+class Checkpoint:
+    def __init__(self, path: str, columns: dict, camera: Camera, width: int, height: int, interval: float = 60.0):
+        self.path = path
+        self.interval = interval
+        self.lastSave = time.perf_counter()
+
+        self.sceneHash = SceneHash(columns)
+        self.cameraHash = CameraHash(camera, width, height)
+        self.width, self.height = width, height
+
+        size = HEADER_SIZE + width * height * (16 + 4)
+        self.resumed = self._Matches(size)
+
+        self.file = np.memmap(path, dtype=np.uint8, mode="r+" if self.resumed else "w+", shape=(size,))
+
+        self.header = self.file[:HEADER.itemsize].view(HEADER)[0]
+        self.accumulation = self.file[HEADER_SIZE:HEADER_SIZE + width * height * 16].view(np.float32).reshape(height, width, 4)
+        self.seeds = self.file[HEADER_SIZE + width * height * 16:].view(np.uint32).reshape(height, width)
+
+        if not self.resumed:
+            self.header["magic"], self.header["version"] = MAGIC, VERSION
+            self.header["width"], self.header["height"] = width, height
+            self.header["sceneHash"], self.header["cameraHash"] = self.sceneHash, self.cameraHash
+            self.header["camera"] = CameraArray(camera)
+            self.header["frameIndex"] = 0
+
+    # the camera stored in the checkpoint at path, so an application can
+    # restore where it was looking before asking to resume. None if there is
+    # no readable checkpoint
+    @staticmethod
+    def StoredCamera(path: str) -> Camera:
+        header = Checkpoint._ReadHeader(path)
+
+        if header is None:
+            return None
+
+        fov, aspectRatio, nearPlane, farPlane, *pose = header["camera"].tolist()
+
+        camera = Camera(fov, aspectRatio, nearPlane, farPlane)
+        camera.position = glm.vec3(pose[0:3])
+        camera.forward = glm.vec3(pose[3:6])
+
+        return camera
+
+    # samples in the saved accumulation, 0 when there is nothing to resume
+    @property
+    def frameIndex(self) -> int:
+        return int(self.header["frameIndex"])
+
+    # copies the buffers in and flushes. frameIndex is zeroed while the copy
+    # is in flight, a process killed half way leaves a checkpoint that starts
+    # over rather than one that mixes two frames
+    def Save(self, accumulation: np.ndarray, seeds: np.ndarray, frameIndex: int):
+        self.header["frameIndex"] = 0
+        self.file.flush()
+
+        self.accumulation[...] = accumulation
+        self.seeds[...] = seeds
+        self.file.flush()
+
+        self.header["frameIndex"] = frameIndex
+        self.file.flush()
+
+        self.lastSave = time.perf_counter()
+
+    # Save once interval seconds have passed since the last one, returns
+    # whether it saved. the buffers are only fetched when they are needed
+    def SaveIfDue(self, fetch, frameIndex: int) -> bool:
+        if time.perf_counter() - self.lastSave < self.interval:
+            return False
+
+        accumulation, seeds = fetch()
+        self.Save(accumulation, seeds, frameIndex)
+
+        return True
+
+    def Close(self):
+        self.file.flush()
+        del self.header, self.accumulation, self.seeds, self.file
+
+    def _Matches(self, size: int) -> bool:
+        if not os.path.exists(self.path) or os.path.getsize(self.path) != size:
+            return False
+
+        header = Checkpoint._ReadHeader(self.path)
+
+        return (header is not None and header["frameIndex"] > 0
+                and header["width"] == self.width and header["height"] == self.height
+                and header["sceneHash"] == self.sceneHash and header["cameraHash"] == self.cameraHash)
+
+    @staticmethod
+    def _ReadHeader(path: str):
+        try:
+            with open(path, "rb") as file:
+                data = file.read(HEADER.itemsize)
+        except OSError:
+            return None
+
+        if len(data) < HEADER.itemsize:
+            return None
+
+        header = np.frombuffer(data, dtype=HEADER)[0]
+
+        if header["magic"] != MAGIC or header["version"] != VERSION:
+            return None
+
+        return header
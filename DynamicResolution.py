@@ -0,0 +1,317 @@
+import argparse
+import collections
+import csv
+import math
+import os
+import sys
+import time
+
+import glm
+import numpy as np
+
+from BVH import *
+from Renderer import *
+from TemporalReprojection import CameraPath, NearbySpheres
+
+# rendering at a lower resolution while the camera moves. a frame of Main.py
+# traces only the bottom left RenderSize pixels of its images and the raster
+# pass stretches them over the window, ResolutionController picks the size
+# from the frame times so far. a still camera always gets full resolution,
+# its samples are the ones that accumulate. PreviewRenderer does the same on
+# the CPU. run on its own this checks the controller against a simulated cost,
+# then previews a camera path on the CPU:
+#
+#   python DynamicResolution.py
+#   PYOPENGL_PLATFORM=egl EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python DynamicResolution.py --gpu
+
+# the columns of ResolutionController.WriteLog
+DECISION_FIELDS = ("frame", "moving", "frameTime", "costPerArea", "previousScale", "scale", "reason")
+
+
+# the resolution scale of each frame. a frame is taken to cost costPerArea
+# seconds times the square of its scale, which is learned from the frame
+# times as they come in. while moving, a frame predicted to miss
+# targetFrameTime drops to the largest scale that makes it, and the scale
+# only rises again once the next step up fits in headroom of the target, so
+# it does not flip between two steps. scales are multiples of step, at least
+# minScale. every decision is kept in decisions for tuning
+class ResolutionController:
+    def __init__(self, targetFrameTime: float = 1 / 30, minScale: float = 0.25, step: float = 0.125,
+                 headroom: float = 0.85, smoothing: float = 0.3, logSize: int = 100000):
+        self.targetFrameTime, self.minScale, self.step = targetFrameTime, minScale, step
+        self.headroom, self.smoothing = headroom, smoothing
+
+        self.scale = 1.0
+        self.costPerArea = None
+        self.frame = 0
+
+        self.decisions = collections.deque(maxlen=logSize)
+
+    # the scale of the coming frame. frameTime is the seconds the last one
+    # took at the scale this returned for it, None when there was none
+    def Update(self, frameTime: float, moving: bool) -> float:
+        if frameTime is not None:
+            cost = frameTime / self.scale ** 2
+
+            if self.costPerArea is None:
+                self.costPerArea = cost
+            else:
+                self.costPerArea += self.smoothing * (cost - self.costPerArea)
+
+        scale, reason = self.scale, "hold"
+
+        if not moving:
+            scale, reason = 1.0, "still"
+        elif self.costPerArea is None:
+            reason = "unmeasured"
+        elif self.costPerArea * scale ** 2 > self.targetFrameTime:
+            scale, reason = self._Fit(self.targetFrameTime), "over"
+        elif self.costPerArea * min(scale + self.step, 1.0) ** 2 <= self.headroom * self.targetFrameTime:
+            scale, reason = self._Fit(self.headroom * self.targetFrameTime), "under"
+
+        self.decisions.append((self.frame, moving, frameTime, self.costPerArea, self.scale, scale, reason))
+
+        self.frame += 1
+        self.scale = scale
+
+        return scale
+
+    # the pixels traced at the current scale out of width x height
+    def Size(self, width: int, height: int) -> tuple:
+        return max(1, round(width * self.scale)), max(1, round(height * self.scale))
+
+    def WriteLog(self, path: str):
+        with open(path, "w", newline="") as file:
+            writer = csv.writer(file)
+            writer.writerow(DECISION_FIELDS)
+            writer.writerows(self.decisions)
+
+    # the largest step whose predicted time is within frameTime
+    def _Fit(self, frameTime: float) -> float:
+        scale = math.floor(math.sqrt(frameTime / self.costPerArea) / self.step) * self.step
+        return min(max(scale, self.minScale), 1.0)
+
+
+# the raster pass of Shaders/Fragment.glsl: image, traced at its own size,
+# filtered bilinearly over width x height pixels
+def Upscale(image: np.ndarray, width: int, height: int) -> np.ndarray:
+    def Axis(count: int, size: int):
+        texel = (np.arange(count, dtype=np.float32) + np.float32(0.5)) * np.float32(size / count) - np.float32(0.5)
+        texel = np.clip(texel, 0, size - 1)
+        low = np.floor(texel).astype(np.int32)
+
+        return low, np.minimum(low + 1, size - 1), (texel - low)[:, None]
+
+    y0, y1, fy = Axis(height, image.shape[0])
+    x0, x1, fx = Axis(width, image.shape[1])
+
+    bottom, top = image[y0], image[y1]
+
+    bottom = bottom[:, x0] * (1 - fx) + bottom[:, x1] * fx
+    top = top[:, x0] * (1 - fx) + top[:, x1] * fx
+
+    return bottom * (1 - fy)[:, None] + top * fy[:, None]
+
+
+# one sample per frame on the CPU at the scale controller picks, upscaled to
+# width x height. frames with a still camera accumulate at full size, a move
+# or a change of scale starts over
+class PreviewRenderer:
+    def __init__(self, bvh: BVH, colours: np.ndarray, emissions: np.ndarray, width: int, height: int,
+                 controller: ResolutionController, seed: int = 0):
+        self.bvh, self.colours, self.emissions = bvh, colours, emissions
+        self.width, self.height = width, height
+        self.controller = controller
+
+        self.seeds = np.random.default_rng(seed).integers(0, 0xFFFFFFFF, (height, width), dtype=np.uint32, endpoint=True)
+        self.renderer = None
+        self.frameTime = None
+
+    def Frame(self, camera: Camera, moving: bool) -> np.ndarray:
+        start = time.perf_counter()
+
+        self.controller.Update(self.frameTime, moving)
+        width, height = self.controller.Size(self.width, self.height)
+
+        if moving or self.renderer is None or (self.renderer.width, self.renderer.height) != (width, height):
+            self.renderer = Renderer.FromArrays(self.bvh, self.colours, self.emissions, camera,
+                                                np.zeros((height, width, 4), dtype=np.float32), self.seeds[:height, :width])
+
+        self.renderer.RenderFrame()
+        image = Upscale(self.renderer.Image[..., :3], self.width, self.height)
+
+        self.frameTime = time.perf_counter() - start
+
+        return image
+
+
+# a frame that costs cost seconds at full scale plus a fixed overhead and some
+# noise, moving for movingFrames then still. once settled the moving frames
+# have to be near the target, and the still ones at full scale
+def CheckController(targetFrameTime: float, cost: float, movingFrames: int = 40, stillFrames: int = 10) -> int:
+    controller = ResolutionController(targetFrameTime)
+    rng = np.random.default_rng(0)
+
+    frameTime, times = None, []
+
+    for frame in range(movingFrames + stillFrames):
+        moving = frame < movingFrames
+        scale = controller.Update(frameTime, moving)
+
+        frameTime = cost * scale ** 2 + 0.001 + rng.normal(0, 0.05 * cost * scale ** 2)
+        times.append((moving, scale, frameTime))
+
+    settled = [frameTime for moving, _, frameTime in times[movingFrames // 2:movingFrames]]
+    changes = sum(1 for *_, previous, scale, _ in list(controller.decisions)[movingFrames // 2:movingFrames]
+                  if previous != scale)
+    still = [scale for moving, scale, _ in times if not moving]
+
+    print(f"simulated frames of {cost * 1000:.0f} ms at full scale, target {targetFrameTime * 1000:.1f} ms: "
+          f"settled at scale {times[movingFrames - 1][1]}, {np.mean(settled) * 1000:.1f} ms on average, "
+          f"{changes} changes of scale once settled")
+
+    failures = 0
+
+    if np.mean(settled) > 1.1 * targetFrameTime or changes > 2:
+        print("  the moving frames did not settle near the target")
+        failures += 1
+
+    if any(scale != 1.0 for scale in still):
+        print("  a still frame was not at full scale")
+        failures += 1
+
+    return failures
+
+# a camera path previewed on the CPU, then the camera holding still. prints
+# the controller's decisions
+def BenchmarkPreview(spheres: SphereSet, width: int, height: int, targetFrameTime: float, moves: int, stillFrames: int,
+                     log: str = None) -> int:
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    controller = ResolutionController(targetFrameTime)
+    preview = PreviewRenderer(bvh, spheres.colour, spheres.emission, width, height, controller)
+
+    path = CameraPath(width, height, moves, 0.05)
+    frames = [(camera, True) for camera in path] + [(path[-1], False)] * stillFrames
+
+    print(f"CPU preview of {width}x{height}, target {targetFrameTime * 1000:.0f} ms")
+    print(f"{'frame':>6} {'moving':>7} {'scale':>6} {'size':>9} {'time (ms)':>10} {'reason':>11}")
+
+    for camera, moving in frames:
+        image = preview.Frame(camera, moving)
+        frame, _, _, _, _, scale, reason = controller.decisions[-1]
+        size = "x".join(map(str, controller.Size(width, height)))
+
+        print(f"{frame:>6} {str(moving):>7} {scale:>6.3f} {size:>9} {preview.frameTime * 1000:>10.1f} {reason:>11}")
+
+    if log:
+        controller.WriteLog(log)
+
+    failures = 0
+
+    if image.shape != (height, width, 3) or controller.scale != 1.0 or preview.renderer.frameIndex != stillFrames:
+        print("  the still frames did not accumulate at full resolution")
+        failures += 1
+
+    return failures
+
+
+# the shader at half scale has to trace what Renderer does at that size, and
+# the raster pass has to stretch it as Upscale does
+def CheckOnGPU(spheres: SphereSet, width: int, height: int, frames: int = 4) -> int:
+    import OpenGL.GL as GL
+
+    from FrameResources import FrameResources, PackPerFrame, RunFrame
+    from GPUBVH import CreateHeadlessContext, FlattenForShader
+    from Graphics import CreateTexture, GraphicsBuffer, ReadTexture
+    from ShaderCompiler import ShaderCompiler
+    from TemporalReprojection import MakeCamera, MakeRenderer, TemporalHistory
+
+    CreateHeadlessContext()
+
+    shaders = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Shaders")
+    computeProgram = ShaderCompiler.Compile((os.path.join(shaders, "Launch.glsl"), GL.GL_COMPUTE_SHADER))
+    rasterProgram = ShaderCompiler.Compile((os.path.join(shaders, "Fragment.glsl"), GL.GL_FRAGMENT_SHADER),
+                                           (os.path.join(shaders, "Vertex.glsl"), GL.GL_VERTEX_SHADER))
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    nodes, primitiveIndices = FlattenForShader(bvh)
+    buffers = [GraphicsBuffer(spheres.data), GraphicsBuffer(nodes.view(np.float32)), GraphicsBuffer(primitiveIndices)]
+
+    for unit, buffer in zip((0, 2, 3), buffers):
+        buffer.BindUnit(unit)
+
+    renderWidth, renderHeight = width // 2, height // 2
+    renderer = MakeRenderer(bvh, spheres, MakeCamera(width, height, (0, 0, 5)), renderWidth, renderHeight)
+
+    seeds = np.zeros((height, width), dtype=np.uint32)
+    seeds[:renderHeight, :renderWidth] = renderer.seeds
+
+    image, accumulation = CreateTexture(width, height), CreateTexture(width, height)
+    seedTexture = CreateTexture(width, height, seeds, GL.GL_R32UI, GL.GL_RED_INTEGER, GL.GL_UNSIGNED_INT)
+    history = TemporalHistory(width, height)
+
+    GL.glBindImageTexture(0, image, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(1, accumulation, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(2, seedTexture, 0, False, 0, GL.GL_READ_WRITE, GL.GL_R32UI)
+    history.BindImages()
+
+    target = CreateTexture(width, height)
+    framebuffer = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+    GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_TEXTURE_2D, target, 0)
+    GL.glViewport(0, 0, width, height)
+
+    resources = FrameResources()
+    groups = (-(-renderWidth // 16), -(-renderHeight // 16))
+    scale = (renderWidth / width, renderHeight / height)
+
+    for frameIndex in range(1, frames + 1):
+        block = PackPerFrame(renderer.camera, 0, len(spheres), frameIndex, (renderWidth, renderHeight))
+        RunFrame(resources, computeProgram, rasterProgram, image, block, groups, scale)
+
+    GL.glFinish()
+
+    gpuImage = ReadTexture(image, width, height)[:renderHeight, :renderWidth, :3]
+    drawn = ReadTexture(target, width, height)[..., :3]
+
+    renderer.Render(frames)
+
+    differing = float(np.mean(np.abs(gpuImage - renderer.Image[..., :3]).max(axis=-1) > 1e-3))
+    upscaleError = float(np.abs(drawn - Upscale(gpuImage, width, height)).max())
+
+    print(f"{GL.glGetString(GL.GL_RENDERER).decode()}, {renderWidth}x{renderHeight} of {width}x{height}: "
+          f"{differing:.2%} of pixels differ from Renderer, drawn image within {upscaleError:.4f} of Upscale")
+
+    history.Destroy()
+    resources.Destroy()
+
+    # filtering hardware interpolates with a few bits of fraction
+    return 0 if differing <= 0.025 and upscaleError <= 0.02 else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the resolution controller and preview a camera path on the CPU")
+    parser.add_argument("--count", type=int, default=2000, help="spheres in the scene")
+    parser.add_argument("--width", type=int, default=160)
+    parser.add_argument("--height", type=int, default=120)
+    parser.add_argument("--target", type=float, default=0.15, help="seconds per frame while moving")
+    parser.add_argument("--moves", type=int, default=20, help="frames the camera moves for")
+    parser.add_argument("--still", type=int, default=4, help="frames the camera then holds still for")
+    parser.add_argument("--log", default=None, help="CSV file for the preview's decisions")
+    parser.add_argument("--gpu", action="store_true", help="also check the scaled frame on a headless context")
+    args = parser.parse_args()
+
+    spheres = NearbySpheres(args.count)
+
+    failures = CheckController(1 / 60, 0.05)
+    failures += CheckController(1 / 30, 0.02)
+    failures += BenchmarkPreview(spheres, args.width, args.height, args.target, args.moves, args.still, args.log)
+
+    if args.gpu:
+        failures += CheckOnGPU(spheres, args.width, args.height)
+
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,518 @@
+import argparse
+import collections
+import ctypes
+import os
+import sys
+import time
+
+import glm
+import numpy as np
+import OpenGL.GL as GL
+
+from Camera import *
+
+# the GL objects the frame loop of Main.py keeps for its whole life instead of
+# making new ones every frame: the fullscreen quad the image is drawn with, a
+# ring of PerFrame uniform blocks written through a persistent mapping, and
+# uniform locations looked up once per program. every class calls GL through
+# the module it is given, RecordingGL stands in for OpenGL.GL to count calls
+# and live objects without a context, --gpu runs the same frames on Mesa:
+#
+#   python FrameResources.py --frames 10000
+#   PYOPENGL_PLATFORM=egl EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python FrameResources.py --frames 10000 --gpu
+
+# the std140 layout of the PerFrame block in Shaders/Launch.glsl
+PER_FRAME = np.dtype({
+    "names": ["inverseView", "inverseProjection", "cameraPosition", "seed", "objectCount", "frameIndex",
+              "reproject", "maxHistory", "previousViewProjection", "previousPosition", "depthTolerance",
+              "normalTolerance", "lightCount", "renderSize"],
+    "formats": [(np.float32, (4, 4)), (np.float32, (4, 4)), (np.float32, 3), np.float32, np.float32, np.float32,
+                np.float32, np.float32, (np.float32, (4, 4)), (np.float32, 3), np.float32,
+                np.float32, np.float32, (np.float32, 2)],
+    "offsets": [0, 64, 128, 140, 144, 148, 152, 156, 160, 224, 236, 240, 244, 248],
+    "itemsize": 256
+})
+
+
+# the PerFrame block of a frame traced at renderSize, reprojecting from the
+# Reprojection of Renderer.py when one is given. lightCount is the number of
+# emissive spheres in the light buffer. GLSL reads a mat4 column by column
+# while a glm matrix as a numpy array is row by row, so they go in transposed
+def PackPerFrame(camera: Camera, seed: int, objectCount: int, frameIndex: int, renderSize: tuple,
+                 reprojection=None, lightCount: int = 0) -> np.ndarray:
+    block = np.zeros(1, dtype=PER_FRAME)
+    block["renderSize"], block["lightCount"] = renderSize, lightCount
+
+    block["inverseView"] = np.array(camera.InverseView, dtype=np.float32).T
+    block["inverseProjection"] = np.array(camera.InverseProjection, dtype=np.float32).T
+    block["cameraPosition"] = camera.position.to_list()
+    block["seed"], block["objectCount"], block["frameIndex"] = seed, objectCount, frameIndex
+
+    if reprojection is not None:
+        block["reproject"], block["maxHistory"] = 1, reprojection.maxHistory
+        block["previousViewProjection"] = np.array(reprojection.viewProjection, dtype=np.float32).T
+        block["previousPosition"] = reprojection.position
+        block["depthTolerance"], block["normalTolerance"] = reprojection.depthTolerance, reprojection.normalTolerance
+
+    return block
+
+
+# glGetUniformLocation once per name of a program
+class UniformLocations:
+    def __init__(self, program, gl=GL):
+        self.program, self.gl = program, gl
+        self.locations = {}
+
+    def __getitem__(self, name: str) -> int:
+        if name not in self.locations:
+            self.locations[name] = self.gl.glGetUniformLocation(self.program, name)
+
+        return self.locations[name]
+
+
+# a uniform buffer of frames blocks, mapped once and written in turn. each
+# block is fenced after the commands that read it and only written again once
+# the fence has passed, so the CPU can be frames - 1 frames ahead of the GPU
+# before it waits
+class UniformRing:
+    def __init__(self, blockSize: int, frames: int = 3, gl=GL):
+        self.gl = gl
+        self.blockSize, self.frames = blockSize, frames
+
+        alignment = int(gl.glGetIntegerv(gl.GL_UNIFORM_BUFFER_OFFSET_ALIGNMENT))
+        self.stride = -(-blockSize // alignment) * alignment
+
+        flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT
+
+        self.bufferID = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.bufferID)
+        gl.glBufferStorage(gl.GL_UNIFORM_BUFFER, self.stride * frames, None, flags)
+        self.pointer = gl.glMapBufferRange(gl.GL_UNIFORM_BUFFER, 0, self.stride * frames, flags)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+
+        self.fences = [None] * frames
+        self.slot = 0
+
+        # Writes that found their block still being read
+        self.waits = 0
+
+    # copies data into the next block and binds it to unit
+    def Write(self, data: np.ndarray, unit: int):
+        gl = self.gl
+
+        if data.nbytes > self.blockSize:
+            raise ValueError(f"{data.nbytes} bytes do not fit a block of {self.blockSize}")
+
+        self._Wait(self.slot)
+
+        offset = self.slot * self.stride
+        ctypes.memmove(self.pointer + offset, np.ascontiguousarray(data).ctypes.data, data.nbytes)
+
+        gl.glBindBufferRange(gl.GL_UNIFORM_BUFFER, unit, self.bufferID, offset, self.blockSize)
+
+    # after the commands that read the block last written, moves on to the next
+    def Fence(self):
+        self.fences[self.slot] = self.gl.glFenceSync(self.gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self.slot = (self.slot + 1) % self.frames
+
+    def _Wait(self, slot: int):
+        gl, fence = self.gl, self.fences[slot]
+
+        if fence is None:
+            return
+
+        status = gl.glClientWaitSync(fence, 0, 0)
+
+        if status == gl.GL_TIMEOUT_EXPIRED:
+            self.waits += 1
+
+            while status == gl.GL_TIMEOUT_EXPIRED:
+                status = gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 1000000)
+
+        if status == gl.GL_WAIT_FAILED:
+            raise RuntimeError("waiting on a uniform block fence failed")
+
+        gl.glDeleteSync(fence)
+        self.fences[slot] = None
+
+    def Destroy(self):
+        gl = self.gl
+
+        for slot in range(self.frames):
+            self._Wait(slot)
+
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, self.bufferID)
+        gl.glUnmapBuffer(gl.GL_UNIFORM_BUFFER)
+        gl.glBindBuffer(gl.GL_UNIFORM_BUFFER, 0)
+
+        gl.glDeleteBuffers(1, [self.bufferID])
+
+
+# two triangles over the screen with texture coordinates, made once
+class FullscreenQuad:
+    def __init__(self, gl=GL):
+        self.gl = gl
+
+        vertices = np.array([
+            -1.0, -1.0, 0.0, 0.0,
+             1.0, -1.0, 1.0, 0.0,
+             1.0,  1.0, 1.0, 1.0,
+            -1.0,  1.0, 0.0, 1.0
+        ], dtype=np.float32)
+
+        indices = np.array([0, 1, 2, 0, 2, 3], dtype=np.uint32)
+
+        self.vao = gl.glGenVertexArrays(1)
+        gl.glBindVertexArray(self.vao)
+
+        self.vbo = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ARRAY_BUFFER, self.vbo)
+        gl.glBufferData(gl.GL_ARRAY_BUFFER, vertices.nbytes, vertices, gl.GL_STATIC_DRAW)
+
+        gl.glVertexAttribPointer(0, 2, gl.GL_FLOAT, gl.GL_FALSE, 4 * 4, ctypes.c_void_p(0))
+        gl.glEnableVertexAttribArray(0)
+
+        gl.glVertexAttribPointer(1, 2, gl.GL_FLOAT, gl.GL_FALSE, 4 * 4, ctypes.c_void_p(2 * 4))
+        gl.glEnableVertexAttribArray(1)
+
+        self.ebo = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_ELEMENT_ARRAY_BUFFER, self.ebo)
+        gl.glBufferData(gl.GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, gl.GL_STATIC_DRAW)
+
+        gl.glBindVertexArray(0)
+
+    # the texture image through rasterProgram, whose sampler is Image. scale
+    # is the part of it, from the bottom left, that covers the screen
+    def Draw(self, rasterProgram, image, locations: UniformLocations, scale: tuple = (1.0, 1.0)):
+        gl = self.gl
+
+        gl.glUseProgram(rasterProgram)
+        gl.glBindTextureUnit(0, image)
+        gl.glUniform1i(locations["Image"], 0)
+        gl.glUniform2f(locations["ImageScale"], *scale)
+
+        gl.glBindVertexArray(self.vao)
+        gl.glDrawElements(gl.GL_TRIANGLES, 6, gl.GL_UNSIGNED_INT, None)
+        gl.glBindVertexArray(0)
+
+    def Destroy(self):
+        self.gl.glDeleteBuffers(2, [self.vbo, self.ebo])
+        self.gl.glDeleteVertexArrays(1, [self.vao])
+
+
+# everything a frame needs from GL that outlives it. a frame writes its
+# PerFrame block, dispatches, calls EndFrame and draws the image
+class FrameResources:
+    def __init__(self, frames: int = 3, gl=GL):
+        self.gl = gl
+
+        self.quad = FullscreenQuad(gl)
+        self.perFrame = UniformRing(PER_FRAME.itemsize, frames, gl)
+        self.locations = {}
+
+    def Locations(self, program) -> UniformLocations:
+        if program not in self.locations:
+            self.locations[program] = UniformLocations(program, self.gl)
+
+        return self.locations[program]
+
+    def WritePerFrame(self, block: np.ndarray, unit: int = 1):
+        self.perFrame.Write(block, unit)
+
+    # after the dispatch that reads this frame's PerFrame block
+    def EndFrame(self):
+        self.perFrame.Fence()
+
+    def DrawImage(self, rasterProgram, image, scale: tuple = (1.0, 1.0)):
+        self.quad.Draw(rasterProgram, image, self.Locations(rasterProgram), scale)
+
+    def Destroy(self):
+        self.quad.Destroy()
+        self.perFrame.Destroy()
+
+
+# a stand-in for OpenGL.GL that needs no context. it counts every call by name
+# and keeps the objects that are alive, the constants are the real ones. a
+# fence passes once latency more fences have been made after it, like a GPU
+# that many frames behind
+class RecordingGL:
+    def __init__(self, latency: int = 0, alignment: int = 256):
+        self.latency, self.alignment = latency, alignment
+
+        self.calls = collections.Counter()
+        self.live = {"buffers": set(), "vertexArrays": set(), "syncs": set()}
+
+        self.nextName = 1
+        self.fenceCount = 0
+        self.mappings = {}
+
+    def __getattr__(self, name: str):
+        if name.startswith("GL_"):
+            return getattr(GL, name)
+
+        if not name.startswith("gl"):
+            raise AttributeError(name)
+
+        def Record(*args):
+            self.calls[name] += 1
+
+        return Record
+
+    def LiveCounts(self) -> dict:
+        return {kind: len(names) for kind, names in self.live.items()}
+
+    def _Generate(self, call: str, kind: str) -> int:
+        self.calls[call] += 1
+
+        name, self.nextName = self.nextName, self.nextName + 1
+        self.live[kind].add(name)
+
+        return name
+
+    def _Delete(self, call: str, kind: str, names):
+        self.calls[call] += 1
+        self.live[kind].difference_update(int(name) for name in names)
+
+    def glGenBuffers(self, count: int) -> int:
+        return self._Generate("glGenBuffers", "buffers")
+
+    def glDeleteBuffers(self, count: int, names):
+        self._Delete("glDeleteBuffers", "buffers", names)
+
+    def glGenVertexArrays(self, count: int) -> int:
+        return self._Generate("glGenVertexArrays", "vertexArrays")
+
+    def glDeleteVertexArrays(self, count: int, names):
+        self._Delete("glDeleteVertexArrays", "vertexArrays", names)
+
+    def glFenceSync(self, condition: int, flags: int) -> int:
+        self.calls["glFenceSync"] += 1
+        self.fenceCount += 1
+        self.live["syncs"].add(self.fenceCount)
+
+        return self.fenceCount
+
+    def glDeleteSync(self, fence: int):
+        self.calls["glDeleteSync"] += 1
+        self.live["syncs"].discard(fence)
+
+    def glClientWaitSync(self, fence: int, flags: int, timeout: int) -> int:
+        self.calls["glClientWaitSync"] += 1
+
+        if self.fenceCount - fence >= self.latency:
+            return GL.GL_ALREADY_SIGNALED
+
+        if timeout == 0:
+            return GL.GL_TIMEOUT_EXPIRED
+
+        # the wait lets the GPU catch up
+        self.fenceCount = fence + self.latency
+        return GL.GL_CONDITION_SATISFIED
+
+    def glGetIntegerv(self, name: int) -> int:
+        self.calls["glGetIntegerv"] += 1
+        return self.alignment
+
+    def glMapBufferRange(self, target: int, offset: int, size: int, access: int) -> int:
+        self.calls["glMapBufferRange"] += 1
+
+        memory = ctypes.create_string_buffer(size)
+        self.mappings[ctypes.addressof(memory)] = memory
+
+        return ctypes.addressof(memory)
+
+    def glGetUniformLocation(self, program, name: str) -> int:
+        self.calls["glGetUniformLocation"] += 1
+        return hash((program, name)) % 1024
+
+
+# the GL side of one frame of Application.Compute and Run. the textures and
+# storage buffers are bound by the caller once
+def RunFrame(resources: FrameResources, computeProgram, rasterProgram, image, block: np.ndarray,
+             groups: tuple, scale: tuple = (1.0, 1.0)):
+    gl = resources.gl
+    locations = resources.Locations(computeProgram)
+
+    gl.glUseProgram(computeProgram)
+
+    gl.glUniform1i(locations["OutImage"], 0)
+    gl.glUniform1i(locations["Accumulation"], 1)
+    gl.glUniform1i(locations["Seeds"], 2)
+
+    resources.WritePerFrame(block)
+
+    gl.glDispatchCompute(*groups, 1)
+    gl.glMemoryBarrier(gl.GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
+
+    resources.EndFrame()
+
+    resources.DrawImage(rasterProgram, image, scale)
+
+# frames of RunFrame against RecordingGL. until every block of the ring has
+# been fenced once frames may make objects, after that every frame has to make
+# and look up nothing and leave the live counts as they were
+def CheckRecorded(frames: int, latency: int) -> int:
+    gl = RecordingGL(latency)
+    camera = Camera(90, 4 / 3, 0.1, 100.0)
+
+    resources = FrameResources(gl=gl)
+    warmup, failures = min(resources.perFrame.frames, frames), 0
+
+    for frameIndex in range(1, frames + 1):
+        RunFrame(resources, 1, 2, 3, PackPerFrame(camera, 0, 10, frameIndex, (800, 600)), (50, 38))
+
+        if frameIndex == warmup:
+            firstCalls, firstLive = gl.calls.copy(), gl.LiveCounts()
+
+    perFrame = {name: (count - firstCalls[name]) / max(frames - warmup, 1) for name, count in gl.calls.items()}
+    made = sum(perFrame.get(name, 0) for name in ("glGenBuffers", "glGenVertexArrays", "glGetUniformLocation"))
+
+    print(f"recording GL, {frames} frames, GPU {latency} frames behind, {resources.perFrame.waits} waits")
+    print(f"  live after frame {warmup}: {firstLive}, after frame {frames}: {gl.LiveCounts()}")
+    print("  calls per frame: " + ", ".join(f"{name} {count:g}" for name, count in sorted(perFrame.items()) if count))
+
+    if gl.LiveCounts() != firstLive or made:
+        print(f"  objects were made after frame {warmup}")
+        failures += 1
+
+    resources.Destroy()
+
+    if any(gl.LiveCounts().values()):
+        print(f"  {gl.LiveCounts()} left after Destroy")
+        failures += 1
+
+    return failures
+
+
+# names below probe that glIs* says are objects, the names Mesa hands out
+# count up so this sees everything made so far
+def LiveObjects(probe: int) -> dict:
+    return {
+        "buffers": sum(bool(GL.glIsBuffer(name)) for name in range(1, probe)),
+        "vertexArrays": sum(bool(GL.glIsVertexArray(name)) for name in range(1, probe))
+    }
+
+# RunFrame on a headless context: the image of the first frames has to match
+# Renderer, which reads the camera from glm directly, and the live objects
+# have to stay as they were after the first frame
+def CheckOnGPU(frames: int, width: int, height: int) -> int:
+    from Benchmark import UniformScene
+    from BVH import BVH
+    from GPUBVH import CreateHeadlessContext, FlattenForShader
+    from Graphics import CreateTexture, GraphicsBuffer, ReadTexture
+    from Objects import SphereSet
+    from Renderer import Renderer
+    from ShaderCompiler import ShaderCompiler
+    from TemporalReprojection import TemporalHistory
+
+    CreateHeadlessContext()
+
+    shaders = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Shaders")
+    computeProgram = ShaderCompiler.Compile((os.path.join(shaders, "Launch.glsl"), GL.GL_COMPUTE_SHADER))
+    rasterProgram = ShaderCompiler.Compile((os.path.join(shaders, "Fragment.glsl"), GL.GL_FRAGMENT_SHADER),
+                                           (os.path.join(shaders, "Vertex.glsl"), GL.GL_VERTEX_SHADER))
+
+    # shrunk to within about 20 units of the camera, farther hits are not
+    # trusted in float32, see GPUBVH.CompareHits
+    spheres = SphereSet.FromObjects(UniformScene(2000))
+    spheres.center[...] *= 0.1
+    spheres.radius[...] *= 0.3
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    nodes, primitiveIndices = FlattenForShader(bvh)
+    buffers = [GraphicsBuffer(spheres.data), GraphicsBuffer(nodes.view(np.float32)), GraphicsBuffer(primitiveIndices)]
+
+    for unit, buffer in zip((0, 2, 3), buffers):
+        buffer.BindUnit(unit)
+
+    seeds = np.random.default_rng(0).integers(0, 0xFFFFFFFF, (height, width), dtype=np.uint32, endpoint=True)
+
+    image, accumulation = CreateTexture(width, height), CreateTexture(width, height)
+    seedTexture = CreateTexture(width, height, seeds, GL.GL_R32UI, GL.GL_RED_INTEGER, GL.GL_UNSIGNED_INT)
+
+    GL.glBindImageTexture(0, image, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(1, accumulation, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(2, seedTexture, 0, False, 0, GL.GL_READ_WRITE, GL.GL_R32UI)
+
+    history = TemporalHistory(width, height)
+    history.BindImages()
+
+    # there is no window to draw to
+    target = CreateTexture(width, height)
+    framebuffer = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+    GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_TEXTURE_2D, target, 0)
+    GL.glViewport(0, 0, width, height)
+
+    # looking away from the axes so a transposed view matrix shows
+    camera = Camera(90, width / height, 0.1, 100.0)
+    camera.forward = glm.normalize(glm.vec3(0.4, -0.3, -1))
+
+    resources = FrameResources()
+    groups = (-(-width // 16), -(-height // 16))
+    compared, failures = 4, 0
+
+    start = time.perf_counter()
+
+    for frameIndex in range(1, frames + 1):
+        block = PackPerFrame(camera, 0, len(spheres), frameIndex, (width, height))
+        RunFrame(resources, computeProgram, rasterProgram, image, block, groups)
+
+        if frameIndex == 1:
+            GL.glFinish()
+            probe = int(GL.glGenBuffers(1)) + 64
+            GL.glDeleteBuffers(1, [probe - 64])
+            firstLive = LiveObjects(probe)
+
+        if frameIndex == compared:
+            gpuImage = ReadTexture(image, width, height)[..., :3]
+
+    GL.glFinish()
+    elapsed = time.perf_counter() - start
+
+    live = LiveObjects(probe)
+
+    renderer = Renderer.FromArrays(bvh, spheres.colour, spheres.emission, camera,
+                                   np.zeros((height, width, 4), dtype=np.float32), seeds.copy())
+    renderer.Render(compared)
+
+    differs = np.abs(gpuImage - renderer.Image[..., :3]).max(axis=-1) > 1e-3
+    differing = float(np.mean(differs))
+
+    print(f"{GL.glGetString(GL.GL_RENDERER).decode()}, {frames} frames of {width}x{height} in {elapsed:.2f}s, "
+          f"{resources.perFrame.waits} waits")
+    print(f"  live after frame 1: {firstLive}, after frame {frames}: {live}")
+    print(f"  {differing:.2%} of pixels differ from Renderer after {compared} frames")
+
+    if live != firstLive:
+        print("  objects were made after the first frame")
+        failures += 1
+
+    # grazing hits can still flip and send a path elsewhere, more often since
+    # bounces are sampled through sin and cos, which the GPU only gets to
+    # within a few ulps
+    if differing > 0.025:
+        failures += 1
+
+    resources.Destroy()
+
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check that the frame loop reuses its GL objects")
+    parser.add_argument("--frames", type=int, default=10000)
+    parser.add_argument("--latency", type=int, default=2, help="frames the recorded GPU runs behind")
+    parser.add_argument("--gpu", action="store_true", help="also run the frames on a headless OpenGL context")
+    parser.add_argument("--width", type=int, default=64)
+    parser.add_argument("--height", type=int, default=48)
+    args = parser.parse_args()
+
+    failures = CheckRecorded(args.frames, args.latency)
+
+    if args.gpu:
+        failures += CheckOnGPU(args.frames, args.width, args.height)
+
+    sys.exit(1 if failures else 0)
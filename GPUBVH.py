@@ -0,0 +1,267 @@
+import argparse
+import os
+import sys
+import time
+
+import glm
+import numpy as np
+
+from BVH import *
+from Benchmark import *
+
+# the flattened BVH as the compute shader sees it. TraceFlattened is a port of
+# TraceBVH in Shaders/BVH.glsl (float32 throughout) that checks the layout
+# from BVH.Flatten without a GPU, TraceRaysOnGPU runs the real shader through
+# Shaders/TraceRays.glsl on a headless context, which Mesa's llvmpipe provides
+# in CI:
+#
+#   EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python GPUBVH.py 2000 --gpu
+
+# BVH_STACK_SIZE in Shaders/BVH.glsl
+SHADER_STACK_SIZE = 64
+
+FLT_MAX = np.float32(3.4028235e+38)
+
+
+# BVH.Flatten for upload, refusing a tree the shader's stack cannot walk. the
+# stack never holds more than depth + 1 nodes
+def FlattenForShader(bvh: BVH):
+    nodes, primitiveIndices, depth = bvh.Flatten()
+
+    if depth + 1 > SHADER_STACK_SIZE:
+        raise ValueError(f"BVH depth {depth} is too deep for the shader's stack of {SHADER_STACK_SIZE}")
+
+    return nodes, primitiveIndices
+
+def RayBoxEntry(origin: np.ndarray, reciprocal: np.ndarray, minn: np.ndarray, maxx: np.ndarray) -> np.float32:
+    t0 = (minn - origin) * reciprocal
+    t1 = (maxx - origin) * reciprocal
+
+    lower = np.minimum(t0, t1)
+    upper = np.maximum(t0, t1)
+
+    tmin = max(max(lower[0], lower[1]), lower[2])
+    tmax = min(min(upper[0], upper[1]), upper[2])
+
+    if tmax < tmin or tmax < 0:
+        return FLT_MAX
+
+    return max(tmin, np.float32(0))
+
+def Dot(u: np.ndarray, v: np.ndarray) -> np.ndarray:
+    return u[..., 0] * v[..., 0] + u[..., 1] * v[..., 1] + u[..., 2] * v[..., 2]
+
+# RaySphereTest of Ray.glsl against one sphere row or an array of them, the
+# hit distances with inf for a miss
+def RaySphereTest(origin: np.ndarray, direction: np.ndarray, sphere: np.ndarray) -> np.ndarray:
+    oc = origin - sphere[..., 0:3]
+
+    a = Dot(direction, direction)
+    b = np.float32(2) * Dot(direction, oc)
+    c = Dot(oc, oc) - sphere[..., 6] * sphere[..., 6]
+
+    discriminant = (b * b) - (np.float32(4) * a * c)
+    root = np.sqrt(np.maximum(discriminant, np.float32(0)))
+
+    root1 = (-b + root) / (np.float32(2) * a)
+    root2 = (-b - root) / (np.float32(2) * a)
+
+    distance = np.where((root1 >= 0) & (root2 >= 0), np.minimum(root1, root2), np.maximum(root1, root2))
+
+    return np.where((discriminant < 0) | ((root1 < 0) & (root2 < 0)), np.float32(np.inf), distance)
+
+# TraceBVH for one ray over the arrays BVH.Flatten returns and the sphere
+# rows of SphereSet.data, returns (distance, sphere index) or (inf, -1)
+def TraceFlattened(nodes: np.ndarray, primitiveIndices: np.ndarray, spheres: np.ndarray, origin, direction):
+    origin = np.asarray(origin, dtype=np.float32)
+    direction = np.asarray(direction, dtype=np.float32)
+
+    safe = np.where(direction == 0, np.float32(2.220446e-16), direction)
+    reciprocal = np.float32(1) / safe
+
+    distance, sphereIndex = FLT_MAX, -1
+    stack = [(0, RayBoxEntry(origin, reciprocal, nodes["min"][0], nodes["max"][0]))]
+
+    while stack:
+        nodeIndex, entry = stack.pop()
+
+        if entry >= distance:
+            continue
+
+        first, count = int(nodes["leftFirst"][nodeIndex]), int(nodes["count"][nodeIndex])
+
+        if count > 0:
+            for index in primitiveIndices[first:first + count].tolist():
+                hit = RaySphereTest(origin, direction, spheres[index])
+
+                if hit < distance:
+                    distance, sphereIndex = hit, index
+
+            continue
+
+        if first < 0:
+            continue
+
+        near, far = first, first + 1
+
+        nearEntry = RayBoxEntry(origin, reciprocal, nodes["min"][near], nodes["max"][near])
+        farEntry = RayBoxEntry(origin, reciprocal, nodes["min"][far], nodes["max"][far])
+
+        if farEntry < nearEntry:
+            near, far = far, near
+            nearEntry, farEntry = farEntry, nearEntry
+
+        for child, childEntry in ((far, farEntry), (near, nearEntry)):
+            if childEntry < distance:
+                stack.append((child, childEntry))
+
+    if sphereIndex == -1:
+        return float("inf"), -1
+
+    return float(distance), sphereIndex
+
+
+# makes a surfaceless OpenGL 4.5 context current, no window or display needed
+def CreateHeadlessContext():
+    os.environ.setdefault("PYOPENGL_PLATFORM", "egl")
+    os.environ.setdefault("EGL_PLATFORM", "surfaceless")
+
+    import ctypes
+    from OpenGL import EGL
+
+    display = EGL.eglGetDisplay(EGL.EGL_DEFAULT_DISPLAY)
+    major, minor = EGL.EGLint(), EGL.EGLint()
+
+    if not EGL.eglInitialize(display, ctypes.pointer(major), ctypes.pointer(minor)):
+        raise RuntimeError("could not initialise EGL")
+
+    EGL.eglBindAPI(EGL.EGL_OPENGL_API)
+
+    attributes = (EGL.EGLint * 7)(EGL.EGL_CONTEXT_MAJOR_VERSION, 4, EGL.EGL_CONTEXT_MINOR_VERSION, 5,
+                                  EGL.EGL_CONTEXT_OPENGL_PROFILE_MASK, EGL.EGL_CONTEXT_OPENGL_CORE_PROFILE_BIT,
+                                  EGL.EGL_NONE)
+
+    context = EGL.eglCreateContext(display, EGL.EGLConfig(), EGL.EGL_NO_CONTEXT, attributes)
+
+    if not context or not EGL.eglMakeCurrent(display, EGL.EGL_NO_SURFACE, EGL.EGL_NO_SURFACE, context):
+        raise RuntimeError("could not create an OpenGL 4.5 context")
+
+    return display, context
+
+# closest hits of every ray from Shaders/TraceRays.glsl, needs a current
+# context. returns distances (inf on a miss) and sphere indices (-1 on a miss)
+def TraceRaysOnGPU(nodes: np.ndarray, primitiveIndices: np.ndarray, spheres: np.ndarray,
+                   origins: np.ndarray, directions: np.ndarray):
+    from OpenGL.GL import GL_COMPUTE_SHADER, GL_SHADER_STORAGE_BUFFER, GL_SHADER_STORAGE_BARRIER_BIT, GL_DYNAMIC_READ
+    from OpenGL.GL import glUseProgram, glUniform1i, glGetUniformLocation, glDispatchCompute, glMemoryBarrier
+    from OpenGL.GL import glBindBuffer, glGetBufferSubData, glDeleteProgram
+
+    from Graphics import GraphicsBuffer
+    from ShaderCompiler import ShaderCompiler
+
+    count = len(origins)
+
+    rays = np.zeros((count, 2, 4), dtype=np.float32)
+    rays[:, 0, :3], rays[:, 1, :3] = origins, directions
+
+    buffers = [
+        GraphicsBuffer(np.ascontiguousarray(spheres, dtype=np.float32)),
+        GraphicsBuffer(nodes.view(np.float32)),
+        GraphicsBuffer(np.ascontiguousarray(primitiveIndices, dtype=np.int32)),
+        GraphicsBuffer(rays),
+        GraphicsBuffer(np.zeros((count, 2), dtype=np.float32), GL_DYNAMIC_READ)
+    ]
+
+    for unit, buffer in zip((0, 2, 3, 4, 5), buffers):
+        buffer.BindUnit(unit)
+
+    program = ShaderCompiler.Compile((os.path.join(os.path.dirname(os.path.abspath(__file__)), "Shaders/TraceRays.glsl"), GL_COMPUTE_SHADER))
+
+    glUseProgram(program)
+    glUniform1i(glGetUniformLocation(program, "RayCount"), count)
+
+    glDispatchCompute((count + 63) // 64, 1, 1)
+    glMemoryBarrier(GL_SHADER_STORAGE_BARRIER_BIT)
+
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, buffers[-1].bufferID)
+    hits = np.frombuffer(glGetBufferSubData(GL_SHADER_STORAGE_BUFFER, 0, count * 8), dtype=np.float32).reshape(count, 2)
+    glBindBuffer(GL_SHADER_STORAGE_BUFFER, 0)
+
+    glDeleteProgram(program)
+
+    distances = hits[:, 0].astype(np.float64)
+    indices = hits[:, 1].view(np.int32).copy()
+    distances[indices == -1] = np.inf
+
+    return distances, indices
+
+
+# the closest hits the shader found before it had a BVH, RaySphereTest
+# against every sphere in order. the traversal has to agree with it
+def SphereLoopHits(spheres: np.ndarray, origins: np.ndarray, directions: np.ndarray):
+    distances, indices = [], []
+
+    for origin, direction in zip(origins, directions):
+        hits = RaySphereTest(origin, direction, spheres)
+        index = int(np.argmin(hits)) if len(hits) else -1
+
+        if index == -1 or hits[index] == np.inf:
+            distances.append(float("inf"))
+            indices.append(-1)
+        else:
+            distances.append(float(hits[index]))
+            indices.append(index)
+
+    return np.array(distances), np.array(indices)
+
+# rays that hit another sphere than expected at another distance. the GPU may
+# fuse multiplies, which moves distances a little and can flip a grazing hit.
+# RaySphereTest cancels badly far from the camera, a ray has to start within
+# a few hundred units of its hit for the float32 quadratic to be trusted
+def CompareHits(expected: tuple, hits: tuple, tolerance: float = 1e-3) -> int:
+    expectedDistances, expectedIndices = expected
+    distances, indices = hits
+
+    differs = ~np.isclose(distances, expectedDistances, rtol=tolerance, atol=tolerance)
+    return int(np.sum(differs & (indices != expectedIndices)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check the flattened BVH and the shader traversal against a loop over every sphere")
+    parser.add_argument("count", type=int, nargs="?", default=2000, help="spheres in the scene")
+    parser.add_argument("--rays", type=int, default=1000)
+    parser.add_argument("--scene", default="uniform", choices=SCENES.keys())
+    parser.add_argument("--gpu", action="store_true", help="also trace on a headless OpenGL context")
+    args = parser.parse_args()
+
+    spheres = SphereSet.FromObjects(SCENES[args.scene](args.count))
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    nodes, primitiveIndices, depth = bvh.Flatten()
+    print(f"{len(nodes)} nodes of {GPU_NODE.itemsize} bytes, {len(primitiveIndices)} primitive indices, depth {depth}")
+
+    origins, directions = RandomRays(list(spheres), args.rays)
+    directions = (directions / np.linalg.norm(directions, axis=1, keepdims=True)).astype(np.float32)
+
+    expected = SphereLoopHits(spheres.data, origins, directions)
+    failures = 0
+
+    start = time.perf_counter()
+    ported = np.array([TraceFlattened(nodes, primitiveIndices, spheres.data, o, d) for o, d in zip(origins, directions)])
+    mismatches = CompareHits(expected, (ported[:, 0], ported[:, 1].astype(int)))
+    failures += mismatches
+
+    print(f"python port: {mismatches} of {args.rays} rays differ ({time.perf_counter() - start:.2f}s)")
+
+    if args.gpu:
+        CreateHeadlessContext()
+
+        start = time.perf_counter()
+        mismatches = CompareHits(expected, TraceRaysOnGPU(nodes, primitiveIndices, spheres.data, origins, directions))
+        failures += mismatches
+
+        print(f"shader: {mismatches} of {args.rays} rays differ ({time.perf_counter() - start:.2f}s)")
+
+    sys.exit(1 if failures else 0)
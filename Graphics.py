@@ -20,6 +20,21 @@ def DestroyTexture(textureID):
     glDeleteTextures(1, [textureID])
 
 
+# reads a whole texture back as a (height, width, channels) array, after any
+# image stores from compute shaders have landed
+def ReadTexture(textureID, width, height, channels=4, fmt=GL_RGBA, dtype=GL_FLOAT, npType=np.float32):
+    glMemoryBarrier(GL_TEXTURE_UPDATE_BARRIER_BIT)
+    glBindTexture(GL_TEXTURE_2D, textureID)
+
+    data = glGetTexImage(GL_TEXTURE_2D, 0, fmt, dtype)
+    return np.frombuffer(data, dtype=npType).reshape(height, width, channels)
+
+
+def WriteTexture(textureID, width, height, data, fmt=GL_RGBA, dtype=GL_FLOAT):
+    glBindTexture(GL_TEXTURE_2D, textureID)
+    glTexSubImage2D(GL_TEXTURE_2D, 0, 0, 0, width, height, fmt, dtype, np.ascontiguousarray(data))
+
+
 class GraphicsBuffer:
     def __init__(self, data=None, usage=GL_STATIC_DRAW, bufferType=GL_SHADER_STORAGE_BUFFER):
         if data is not None:
@@ -45,43 +60,3 @@ class GraphicsBuffer:
     def __del__(self):
         glDeleteBuffers(1, [self.bufferID])
 
-
-def DrawImage(rasterProgram, image):
-    vertices = np.array([
-        -1.0, -1.0, 0.0, 0.0,  
-         1.0, -1.0, 1.0, 0.0,  
-         1.0,  1.0, 1.0, 1.0,  
-        -1.0,  1.0, 0.0, 1.0   
-    ], dtype=np.float32)
-
-    indices = np.array([
-        0, 1, 2,  # First triangle
-        0, 2, 3   # Second triangle
-    ], dtype=np.uint32)
-
-    vao = glGenVertexArrays(1)
-    glBindVertexArray(vao)
-
-    vbo = glGenBuffers(1)
-    glBindBuffer(GL_ARRAY_BUFFER, vbo)
-    glBufferData(GL_ARRAY_BUFFER, vertices.nbytes, vertices, GL_STATIC_DRAW)
-
-    glVertexAttribPointer(0, 2, GL_FLOAT, GL_FALSE, 4 * 4, ctypes.c_void_p(0))
-    glEnableVertexAttribArray(0)
-
-    glVertexAttribPointer(1, 2, GL_FLOAT, GL_FALSE, 4 * 4, ctypes.c_void_p(2 * 4))
-    glEnableVertexAttribArray(1)
-
-    ebo = glGenBuffers(1)
-    glBindBuffer(GL_ELEMENT_ARRAY_BUFFER, ebo)
-    glBufferData(GL_ELEMENT_ARRAY_BUFFER, indices.nbytes, indices, GL_STATIC_DRAW)
-
-    glUseProgram(rasterProgram)
-
-    glBindTextureUnit(0, image)
-
-    glUniform1i(glGetUniformLocation(rasterProgram, "Image"), 0)
-
-    glDrawElements(GL_TRIANGLES, 6, GL_UNSIGNED_INT, None)
-
-    glBindVertexArray(0)
\ No newline at end of file
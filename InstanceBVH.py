@@ -0,0 +1,349 @@
+import argparse
+import sys
+import time
+
+import glm
+import numpy as np
+
+from BVH import *
+from BVH import _AddStatistics
+
+# a two-level acceleration structure for scenes that repeat the same clusters
+# of spheres. every unique cluster gets a bottom level BVH, built once, and an
+# instance places a cluster in the world with a 4x4 affine transform. the top
+# level BVH is built over the world boxes of the instances, so build time and
+# memory grow with the unique spheres plus a box and two matrices per
+# instance, not with the spheres the instances add up to.
+#
+# TraceRays takes rays in world space into the object space of every instance
+# whose box they enter and traces its cluster there. the object space
+# direction is not normalised by the transform, so distances are scaled back
+# by its length. hits are indexed as in Flatten, the scene the instances stand
+# for written out sphere by sphere.
+
+
+# the world boxes around boxes (n, 3) taken through affine transforms
+# (n, 4, 4), from their 8 corners. rounded outwards to float32 so they always
+# hold what the rays find in object space
+def TransformBounds(transforms: np.ndarray, minn: np.ndarray, maxx: np.ndarray):
+    corners = np.array([[x, y, z] for x in (0, 1) for y in (0, 1) for z in (0, 1)], dtype=bool)
+    points = np.where(corners[None], maxx[:, None].astype(np.float64), minn[:, None].astype(np.float64))
+
+    world = np.einsum("nij,nkj->nki", transforms[:, :3, :3], points) + transforms[:, None, :3, 3]
+
+    worldMin = np.nextafter(world.min(axis=1).astype(np.float32), np.float32(-np.inf))
+    worldMax = np.nextafter(world.max(axis=1).astype(np.float32), np.float32(np.inf))
+
+    return worldMin, worldMax
+
+
+class InstanceBVH:
+    def __init__(self):
+        self.clusters = []
+        self.clusterSpheres = []
+
+        self.instanceCluster = np.zeros(0, dtype=np.int32)
+        self.objectToWorld = np.zeros((0, 4, 4))
+        self.worldToObject = np.zeros((0, 4, 4))
+
+        self.top = BVH()
+        self.buildStatistics = {}
+        self.clusterBuildTime = 0.0
+
+    @property
+    def instanceCount(self) -> int:
+        return len(self.instanceCluster)
+
+    # builds the bottom level BVH of a cluster, a list of spheres or a
+    # SphereSet around the cluster's own origin. returns its index
+    def AddCluster(self, spheres) -> int:
+        if not isinstance(spheres, SphereSet):
+            spheres = SphereSet.FromObjects(spheres)
+
+        if not len(spheres):
+            raise ValueError("a cluster needs at least one sphere")
+
+        start = time.perf_counter()
+
+        bvh = BVH()
+        bvh.Build(spheres)
+
+        self.clusterBuildTime += time.perf_counter() - start
+
+        self.clusters.append(bvh)
+        self.clusterSpheres.append(spheres)
+
+        return len(self.clusters) - 1
+
+    # places clusters (n) with transforms, glm.mat4s or (n, 4, 4) arrays
+    # that take object space points to world space. returns the instance
+    # indices, Build has to be called before tracing them
+    def AddInstances(self, clusters, transforms) -> np.ndarray:
+        clusters = np.atleast_1d(np.asarray(clusters, dtype=np.int32))
+        transforms = np.array(transforms, dtype=np.float64).reshape(-1, 4, 4)
+
+        if len(clusters) != len(transforms):
+            raise ValueError(f"{len(clusters)} clusters for {len(transforms)} transforms")
+
+        if ((clusters < 0) | (clusters >= len(self.clusters))).any():
+            raise ValueError("instance of a cluster that was never added")
+
+        if (np.abs(np.linalg.det(transforms[:, :3, :3])) < 1e-12).any():
+            raise ValueError("instance transforms have to be invertible")
+
+        first = self.instanceCount
+
+        self.instanceCluster = np.concatenate((self.instanceCluster, clusters))
+        self.objectToWorld = np.concatenate((self.objectToWorld, transforms))
+        self.worldToObject = np.concatenate((self.worldToObject, np.linalg.inv(transforms)))
+
+        return np.arange(first, self.instanceCount)
+
+    def AddInstance(self, cluster: int, transform) -> int:
+        return int(self.AddInstances([cluster], [np.array(transform, dtype=np.float64)])[0])
+
+    # the top level over the world boxes of every instance
+    def Build(self, method: str = "sah"):
+        start = time.perf_counter()
+
+        self.top = BVH()
+
+        if self.instanceCount:
+            roots = [(cluster.nodeMin[0], cluster.nodeMax[0]) for cluster in self.clusters]
+            minn = np.array([roots[c][0] for c in self.instanceCluster.tolist()])
+            maxx = np.array([roots[c][1] for c in self.instanceCluster.tolist()])
+
+            worldMin, worldMax = TransformBounds(self.objectToWorld, minn, maxx)
+            boxes = [AABB(glm.vec3(*a), glm.vec3(*b)) for a, b in zip(worldMin.tolist(), worldMax.tolist())]
+
+            self.top.Build(boxes, method)
+
+        self.buildStatistics = {
+            "clusters": len(self.clusters),
+            "instances": self.instanceCount,
+            "spheres": int(sum(len(spheres) for spheres in self.clusterSpheres)),
+            "instancedSpheres": int(self.SphereOffsets()[-1]),
+            "clusterBuildTime": self.clusterBuildTime,
+            "topBuildTime": time.perf_counter() - start
+        }
+
+    # where the spheres of every instance start in Flatten, and their total
+    def SphereOffsets(self) -> np.ndarray:
+        sizes = np.array([len(spheres) for spheres in self.clusterSpheres], dtype=np.int64)
+        return np.concatenate(([0], np.cumsum(sizes[self.instanceCluster]))).astype(np.int64)
+
+    # the instanced scene as one SphereSet in world space, the spheres of
+    # instance 0 first. a sphere only stays one under rotations, uniform
+    # scales and translations, any other transform is refused
+    def Flatten(self) -> SphereSet:
+        linear = self.objectToWorld[:, :3, :3]
+        gram = np.einsum("nji,njk->nik", linear, linear)
+        scales = np.sqrt(gram[:, 0, 0])
+
+        if not np.allclose(gram, scales[:, None, None] ** 2 * np.eye(3), rtol=1e-5, atol=1e-9):
+            raise ValueError("only instances with a rotation, uniform scale and translation flatten to spheres")
+
+        offsets = self.SphereOffsets()
+        data = np.empty((offsets[-1], 8), dtype=np.float32)
+
+        for cluster, spheres in enumerate(self.clusterSpheres):
+            instances = np.flatnonzero(self.instanceCluster == cluster)
+
+            if not len(instances):
+                continue
+
+            rows = np.broadcast_to(spheres.data, (len(instances),) + spheres.data.shape).copy()
+            rows[:, :, 0:3] = (np.einsum("nij,mj->nmi", linear[instances], spheres.center.astype(np.float64))
+                               + self.objectToWorld[instances, None, :3, 3])
+            rows[:, :, 6] *= scales[instances, None]
+
+            for instance, block in zip(instances.tolist(), rows):
+                data[offsets[instance]:offsets[instance + 1]] = block
+
+        return SphereSet(data)
+
+    # closest hits of world space rays, the distances (inf on a miss) and
+    # the index of the sphere in Flatten (-1 on a miss), like BVH.TraceRays.
+    # every ray lists the instance boxes it enters, then traces them in rounds
+    # by their entry, nearest first, skipping those behind its closest hit.
+    # a round traces each cluster once for all of its instances
+    def TraceRays(self, origins, directions, batchSize: int = 65536, statistics=None):
+        origins = np.asarray(origins, dtype=np.float32).reshape(-1, 3)
+        directions = NormalizeDirections(directions)
+        reciprocals = ReciprocalDirections(directions)
+
+        distances = np.full(len(origins), np.inf)
+        indices = np.full(len(origins), -1, dtype=np.int64)
+
+        counts = {"rays": len(origins), "nodesVisited": 0, "nodesPruned": 0, "primitiveTests": 0, "instanceTests": 0}
+
+        if self.top.primitiveIndexCount:
+            offsets = self.SphereOffsets()
+
+            for start in range(0, len(origins), batchSize):
+                rays = np.arange(start, min(start + batchSize, len(origins)))
+                pairs = self._InstancePairs(rays, origins, reciprocals, counts)
+
+                self._TraceInstances(pairs, origins, directions, distances, indices, offsets, counts)
+
+        _AddStatistics(statistics, counts)
+
+        return distances, indices
+
+    # (ray, instance, entry) for every instance leaf box a ray enters, the
+    # entry of the leaf box is a lower bound for any hit inside the instance
+    def _InstancePairs(self, rays, origins, reciprocals, counts):
+        top = self.top
+        nodes = np.zeros(len(rays), dtype=np.int32)
+        pairs = []
+
+        while len(rays):
+            hit, tmin, _ = RayBoxIntersections(origins[rays], reciprocals[rays], top.nodeMin[nodes], top.nodeMax[nodes])
+            rays, nodes, tmin = rays[hit], nodes[hit], np.maximum(tmin[hit], 0)
+
+            counts["nodesVisited"] += len(nodes)
+
+            leaf = top.leftChild[nodes] < 0
+            leafNodes = nodes[leaf]
+            leafCounts = top.primitiveCount[leafNodes]
+
+            pairRays = np.repeat(rays[leaf], leafCounts)
+            firsts = np.repeat(top.primitiveOffset[leafNodes] - np.cumsum(leafCounts) + leafCounts, leafCounts)
+
+            pairs.append((pairRays, top.primitiveIndices[firsts + np.arange(len(pairRays))],
+                          np.repeat(tmin[leaf], leafCounts)))
+
+            inner = ~leaf
+            rays = np.repeat(rays[inner], 2)
+            nodes = np.stack((top.leftChild[nodes[inner]], top.rightChild[nodes[inner]]), axis=1).ravel()
+
+        return tuple(np.concatenate(column) for column in zip(*pairs))
+
+    # rounds take the pairs of ranks [0, 1), [1, 3), [3, 7)... of every ray,
+    # so a ray that enters many instance boxes costs few rounds
+    def _TraceInstances(self, pairs, origins, directions, distances, indices, offsets, counts):
+        pairRays, pairInstances, pairEntries = pairs
+
+        if not len(pairRays):
+            return
+
+        # rank of every pair among those of its ray, nearest entry first
+        order = np.lexsort((pairEntries, pairRays))
+        pairRays, pairInstances, pairEntries = pairRays[order], pairInstances[order], pairEntries[order]
+
+        starts = np.flatnonzero(np.r_[True, pairRays[1:] != pairRays[:-1]])
+        rank = np.arange(len(pairRays)) - np.repeat(starts, np.diff(np.r_[starts, len(pairRays)]))
+
+        order = np.argsort(rank, kind="stable")
+        limits = 2 ** np.arange(int(rank.max() + 1).bit_length() + 1) - 1
+        bounds = np.searchsorted(rank[order], limits)
+
+        for first, last in zip(bounds[:-1], bounds[1:]):
+            roundPairs = order[first:last]
+            rays, instances = pairRays[roundPairs], pairInstances[roundPairs]
+
+            closer = pairEntries[roundPairs] <= distances[rays]
+            counts["nodesPruned"] += int(np.count_nonzero(~closer))
+            rays, instances = rays[closer], instances[closer]
+
+            clusters = self.instanceCluster[instances]
+            hits = [self._TraceCluster(cluster, rays[clusters == cluster], instances[clusters == cluster],
+                                       origins, directions, offsets, counts) for cluster in np.unique(clusters).tolist()]
+
+            if not hits:
+                continue
+
+            hitRays, hitDistances, hitIndices = (np.concatenate(column) for column in zip(*hits))
+
+            # closest hit per ray of the round
+            hitOrder = np.lexsort((hitDistances, hitRays))
+            hitRays, hitDistances, hitIndices = hitRays[hitOrder], hitDistances[hitOrder], hitIndices[hitOrder]
+
+            firstHit = np.ones(len(hitRays), dtype=bool)
+            firstHit[1:] = hitRays[1:] != hitRays[:-1]
+            hitRays, hitDistances, hitIndices = hitRays[firstHit], hitDistances[firstHit], hitIndices[firstHit]
+
+            closer = hitDistances < distances[hitRays]
+            distances[hitRays[closer]] = hitDistances[closer]
+            indices[hitRays[closer]] = hitIndices[closer]
+
+    # traces the rays through one cluster in the object space of their
+    # instances, returns the rays that hit with their world distances and
+    # indices in Flatten
+    def _TraceCluster(self, cluster, rays, instances, origins, directions, offsets, counts):
+        worldToObject = self.worldToObject[instances]
+
+        objectOrigins = np.einsum("nij,nj->ni", worldToObject[:, :3, :3], origins[rays].astype(np.float64)) + worldToObject[:, :3, 3]
+        objectDirections = np.einsum("nij,nj->ni", worldToObject[:, :3, :3], directions[rays].astype(np.float64))
+
+        # world distance per unit of the normalised object space direction
+        scale = np.sqrt((objectDirections * objectDirections).sum(axis=1))
+
+        bottom = {}
+        objectDistances, spheres = self.clusters[cluster].TraceRays(objectOrigins.astype(np.float32),
+                                                                    objectDirections.astype(np.float32), statistics=bottom)
+
+        counts["instanceTests"] += len(rays)
+
+        for key in ("nodesVisited", "nodesPruned", "primitiveTests"):
+            counts[key] += bottom.get(key, 0)
+
+        hit = spheres >= 0
+
+        return rays[hit], objectDistances[hit] / scale[hit], offsets[instances[hit]] + spheres[hit]
+
+    # the node arrays of both levels, the clusters' spheres and the instance
+    # transforms
+    @property
+    def MemoryUsage(self) -> int:
+        usage = sum(cluster.MemoryUsage + spheres.data.nbytes for cluster, spheres in zip(self.clusters, self.clusterSpheres))
+        usage += self.top.MemoryUsage
+
+        return usage + self.instanceCluster.nbytes + self.objectToWorld.nbytes + self.worldToObject.nbytes
+
+
+# a random rotation, uniform scale within scales and translation within
+# [minn, maxx], as a 4x4 matrix
+def RandomSimilarity(rng, minn, maxx, scales=(0.5, 2.0)) -> np.ndarray:
+    q, r = np.linalg.qr(rng.normal(size=(3, 3)))
+    rotation = q * np.sign(np.diag(r))
+
+    if np.linalg.det(rotation) < 0:
+        rotation[:, 0] = -rotation[:, 0]
+
+    transform = np.eye(4)
+    transform[:3, :3] = rotation * rng.uniform(*scales)
+    transform[:3, 3] = rng.uniform(minn, maxx)
+
+    return transform
+
+
+if __name__ == "__main__":
+    from Benchmark import InstancedScene, RandomRays, SCENES
+    from GPUBVH import CompareHits
+
+    parser = argparse.ArgumentParser(description="check a two-level BVH against a flat BVH over the same spheres")
+    parser.add_argument("count", type=int, nargs="?", default=20000, help="spheres in the flattened scene")
+    parser.add_argument("--cluster-size", type=int, default=100)
+    parser.add_argument("--clusters", type=int, default=8)
+    parser.add_argument("--rays", type=int, default=2000)
+    args = parser.parse_args()
+
+    instanced = InstancedScene(SCENES["uniform"](args.clusters * args.cluster_size), args.cluster_size,
+                               args.count // args.cluster_size)
+
+    spheres = instanced.Flatten()
+    flat = BVH()
+    flat.Build(spheres)
+
+    stats = instanced.buildStatistics
+    print(f"{stats['clusters']} clusters, {stats['instances']} instances, {stats['instancedSpheres']} spheres")
+
+    origins, directions = RandomRays(list(spheres), args.rays)
+
+    mismatches = CompareHits(flat.TraceRays(origins, directions), instanced.TraceRays(origins, directions))
+    print(f"{mismatches} of {args.rays} rays differ from the flat BVH")
+
+    # the float32 quadratic cancels far from the ray origin, in either tree,
+    # so a grazing hit may flip now and then. more than that is a bug
+    sys.exit(1 if mismatches > args.rays // 500 else 0)
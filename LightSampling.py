@@ -0,0 +1,181 @@
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+import OpenGL.GL as GL
+
+from BVH import *
+from Renderer import *
+from TemporalReprojection import MakeCamera, NearbySpheres, RMSE
+
+# how a diffuse bounce picks its next direction. "uniform" spreads them over
+# the hemisphere and weights each by its cosine, "cosine" samples in
+# proportion to the cosine so no weight is left, "lights" also samples the
+# emissive spheres directly at every bounce and combines both by the power
+# heuristic. all three converge to the same image, run on its own this
+# measures how fast each gets there in a scene lit by a few small lights:
+#
+#   python LightSampling.py
+#   PYOPENGL_PLATFORM=egl EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python LightSampling.py --gpu
+
+
+# NearbySpheres with lights small and bright enough that a bounce rarely
+# finds them, placed in front of the camera MakeCamera makes
+def LitSpheres(count: int, lightCount: int, radius: float, emission: float, seed: int = 1) -> SphereSet:
+    spheres = NearbySpheres(count)
+    rng = np.random.default_rng(seed)
+
+    lights = np.zeros((lightCount, 8), dtype=np.float32)
+    lights[:, 0:3] = rng.uniform((-4, -4, -8), (8, 4, 2), (lightCount, 3))
+    lights[:, 3:6] = 1.0
+    lights[:, 6] = radius
+    lights[:, 7] = emission
+
+    return SphereSet(np.concatenate((spheres.data, lights)))
+
+def MakeSampledRenderer(bvh: BVH, spheres: SphereSet, camera, width: int, height: int, sampling: str,
+                        seed: int = 0) -> Renderer:
+    seeds = np.random.default_rng(seed).integers(0, 0xFFFFFFFF, (height, width), dtype=np.uint32, endpoint=True)
+
+    renderer = Renderer.FromArrays(bvh, spheres.colour, spheres.emission, camera,
+                                   np.zeros((height, width, 4), dtype=np.float32), seeds)
+    renderer.sampling = sampling
+
+    return renderer
+
+
+# the error of each sampling against a converged image of the lights sampling
+# from other seeds after 1, 2, 4 ... samples. lights has to end below cosine
+# and cosine below uniform
+def BenchmarkSampling(bvh, spheres, width: int, height: int, samples: int, referenceSamples: int) -> int:
+    camera = MakeCamera(width, height, (0, 0, 5))
+
+    reference = MakeSampledRenderer(bvh, spheres, camera, width, height, "lights", seed=1)
+    reference.Render(referenceSamples)
+    reference = reference.Image
+
+    counts = [1 << power for power in range(samples.bit_length()) if 1 << power <= samples]
+    errors, times = {}, {}
+
+    for sampling in SAMPLING:
+        renderer = MakeSampledRenderer(bvh, spheres, camera, width, height, sampling)
+        errors[sampling] = []
+
+        start = time.perf_counter()
+
+        for count in counts:
+            renderer.Render(count - renderer.frameIndex)
+            errors[sampling].append(RMSE(renderer.Image, reference))
+
+        times[sampling] = (time.perf_counter() - start) / counts[-1]
+
+    print(f"{width}x{height}, {len(spheres)} spheres of which {int(np.count_nonzero(spheres.emission > 0))} lights, "
+          f"reference of {referenceSamples} samples")
+    print(f"{'samples':>8} " + " ".join(f"{sampling:>9}" for sampling in SAMPLING))
+
+    for i, count in enumerate(counts):
+        print(f"{count:>8} " + " ".join(f"{errors[sampling][i]:>9.4f}" for sampling in SAMPLING))
+
+    print(f"{'s/frame':>8} " + " ".join(f"{times[sampling]:>9.3f}" for sampling in SAMPLING))
+
+    # the samples the others need for the error lights has after one
+    for sampling in ("uniform", "cosine"):
+        matched = next((count for count, error in zip(counts, errors[sampling]) if error <= errors["lights"][0]), None)
+        print(f"  {sampling} needs {matched or f'more than {counts[-1]}'} samples for the error of 1 lights sample")
+
+    final = {sampling: errors[sampling][-1] for sampling in SAMPLING}
+
+    return 0 if final["lights"] < final["cosine"] < final["uniform"] else 1
+
+
+# Launch.glsl with the light indices bound has to leave about the image
+# Renderer does
+def CheckOnGPU(bvh, spheres, width: int, height: int, frames: int) -> int:
+    from FrameResources import FrameResources, PackPerFrame, RunFrame
+    from GPUBVH import CreateHeadlessContext, FlattenForShader
+    from Graphics import CreateTexture, GraphicsBuffer, ReadTexture
+    from ShaderCompiler import ShaderCompiler
+    from TemporalReprojection import TemporalHistory
+
+    CreateHeadlessContext()
+
+    shaders = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Shaders")
+    computeProgram = ShaderCompiler.Compile((os.path.join(shaders, "Launch.glsl"), GL.GL_COMPUTE_SHADER))
+    rasterProgram = ShaderCompiler.Compile((os.path.join(shaders, "Fragment.glsl"), GL.GL_FRAGMENT_SHADER),
+                                           (os.path.join(shaders, "Vertex.glsl"), GL.GL_VERTEX_SHADER))
+
+    camera = MakeCamera(width, height, (0, 0, 5))
+    renderer = MakeSampledRenderer(bvh, spheres, camera, width, height, "lights")
+
+    nodes, primitiveIndices = FlattenForShader(bvh)
+    buffers = [GraphicsBuffer(spheres.data), GraphicsBuffer(nodes.view(np.float32)), GraphicsBuffer(primitiveIndices),
+               GraphicsBuffer(renderer.lights)]
+
+    for unit, buffer in zip((0, 2, 3, 4), buffers):
+        buffer.BindUnit(unit)
+
+    image, accumulation = CreateTexture(width, height), CreateTexture(width, height)
+    seedTexture = CreateTexture(width, height, renderer.seeds, GL.GL_R32UI, GL.GL_RED_INTEGER, GL.GL_UNSIGNED_INT)
+    history = TemporalHistory(width, height)
+
+    GL.glBindImageTexture(0, image, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(1, accumulation, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(2, seedTexture, 0, False, 0, GL.GL_READ_WRITE, GL.GL_R32UI)
+    history.BindImages()
+
+    target = CreateTexture(width, height)
+    framebuffer = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+    GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_TEXTURE_2D, target, 0)
+    GL.glViewport(0, 0, width, height)
+
+    resources = FrameResources()
+    groups = (-(-width // 16), -(-height // 16))
+
+    for frameIndex in range(1, frames + 1):
+        block = PackPerFrame(camera, 0, len(spheres), frameIndex, (width, height), lightCount=len(renderer.lights))
+        RunFrame(resources, computeProgram, rasterProgram, image, block, groups)
+
+    GL.glFinish()
+    gpuImage = ReadTexture(image, width, height)[..., :3]
+
+    renderer.Render(frames)
+
+    differing = float(np.mean(np.abs(gpuImage - renderer.Image[..., :3]).max(axis=-1) > 1e-3))
+
+    print(f"{GL.glGetString(GL.GL_RENDERER).decode()}, {frames} frames sampling {len(renderer.lights)} lights: "
+          f"{differing:.2%} of pixels differ from Renderer")
+
+    history.Destroy()
+    resources.Destroy()
+
+    # grazing hits that GPU trig sends elsewhere, as in FrameResources.CheckOnGPU
+    return 0 if differing <= 0.025 else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="compare how fast uniform, cosine and light sampling converge")
+    parser.add_argument("--count", type=int, default=2000, help="spheres in the scene besides the lights")
+    parser.add_argument("--lights", type=int, default=6, help="emissive spheres")
+    parser.add_argument("--radius", type=float, default=0.15, help="radius of the lights")
+    parser.add_argument("--emission", type=float, default=30.0, help="emission of the lights")
+    parser.add_argument("--width", type=int, default=96)
+    parser.add_argument("--height", type=int, default=72)
+    parser.add_argument("--samples", type=int, default=64, help="most samples to measure the error after")
+    parser.add_argument("--reference", type=int, default=512, help="samples of the converged image")
+    parser.add_argument("--gpu", action="store_true", help="also compare the shader on a headless context")
+    args = parser.parse_args()
+
+    spheres = LitSpheres(args.count, args.lights, args.radius, args.emission)
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    failures = BenchmarkSampling(bvh, spheres, args.width, args.height, args.samples, args.reference)
+
+    if args.gpu:
+        failures += CheckOnGPU(bvh, spheres, args.width, args.height, 4)
+
+    sys.exit(1 if failures else 0)
@@ -1,9 +1,9 @@
+import os
 import random
 import time
 import pygame
 from OpenGL.GL import *
 import numpy as np
-import yaml
 
 import math
 
@@ -11,54 +11,96 @@ from Graphics import *
 from ShaderCompiler import *
 from Objects import *
 from Camera import *
+from Scene import *
+from Checkpoint import *
+from BVH import *
+from FrameResources import *
+from SceneEdits import LiveScene, SceneBuffers
+from Renderer import Reprojection
+from TemporalReprojection import TemporalHistory
+from DynamicResolution import ResolutionController
 
 class Application:
-    def __init__(self, width: int, height: int, save: str =None):
+    def __init__(self, width: int, height: int, save: str =None, checkpoint: str =None, checkpointInterval: float =60.0,
+                 reproject: bool =True, targetFrameTime: float =None, resolutionLog: str =None):
         pygame.init()
 
         self.window = pygame.display.set_mode((width, height), pygame.OPENGL | pygame.DOUBLEBUF | pygame.RESIZABLE)
         self.save = save
+        self.reproject = reproject
+
+        # with a target frame time the moving camera renders at a scale that
+        # makes it, the decisions go to resolutionLog on Shutdown
+        self.resolution = ResolutionController(targetFrameTime) if targetFrameTime else None
+        self.resolutionLog = resolutionLog
+        self.renderSize = (width, height)
 
         self.shaderProgram = ShaderCompiler.Compile(("Shaders/Launch.glsl", GL_COMPUTE_SHADER))
         self.rasterProgram = ShaderCompiler.Compile(("Shaders/Fragment.glsl", GL_FRAGMENT_SHADER), ("Shaders/Vertex.glsl", GL_VERTEX_SHADER)) 
 
+        self.frameResources = FrameResources()
+
         self.image = CreateTexture(width, height)
         self.accumulation = CreateTexture(width, height)
+        self.history = TemporalHistory(width, height)
 
-        data = np.random.randint(0, np.iinfo(np.uint32).max, (width, height, 1), dtype=np.uint32)
-        self.randomNumbers = CreateTexture(width, height, data, GL_R32UI, GL_RED_INTEGER, GL_UNSIGNED_INT)
-        self.objects = []
+        self.randomNumbers = self.CreateSeeds(width, height)
+        self.scene = SphereSet()
 
         self.camera = Camera(90, width / height, 0.1, 100.0)
 
-        try:
-            with open(save, "r") as file:
-                data = yaml.safe_load(file)
-
-                self.objects = [
-                    Sphere(
-                        glm.vec3(obj["Properties"]["Center"]), 
-                        obj["Properties"]["Radius"], 
-                        glm.vec3(obj["Properties"]["Colour"]), 
-                        obj["Properties"]["Emission"]
-                    ) 
-                    for obj in data
-                ]
-        except:
-            pass 
-
-        self.rawData = np.array([o.Data for o in self.objects], dtype=np.float32)
-        self.dataBuffer = GraphicsBuffer(self.rawData)
+        # a save.yaml from before the binary format is imported the first time
+        if save:
+            legacy = os.path.splitext(save)[0] + ".yaml"
+
+            if not os.path.exists(save) and os.path.exists(legacy):
+                ImportYAML(legacy, save)
+
+            try:
+                self.scene = SphereSet.FromColumns(LoadSceneColumns(save))
+            except FileNotFoundError:
+                pass
+
+        # edits go through liveScene, sceneBuffers uploads what they changed
+        # at the start of the next frame
+        self.liveScene = LiveScene(self.scene)
+        self.sceneBuffers = SceneBuffers(self.liveScene)
+        self.bvh = self.liveScene.bvh
+
+        self.frameIndex = 1
+
+        # the camera comes back from the checkpoint, the accumulation and seeds
+        # only when the scene, camera and window size hash the same
+        self.checkpointPath, self.checkpointInterval = checkpoint, checkpointInterval
+        self.checkpoint = None
+
+        if checkpoint:
+            stored = Checkpoint.StoredCamera(checkpoint)
+
+            if stored is not None:
+                self.camera.position, self.camera.forward = stored.position, stored.forward
+
+            self.checkpoint = Checkpoint(checkpoint, self.liveScene.Columns(), self.camera, width, height, checkpointInterval)
+
+            if self.checkpoint.resumed:
+                WriteTexture(self.accumulation, width, height, self.checkpoint.accumulation)
+                WriteTexture(self.randomNumbers, width, height, self.checkpoint.seeds, GL_RED_INTEGER, GL_UNSIGNED_INT)
+
+                self.frameIndex = self.checkpoint.frameIndex + 1
         
 
     def Run(self):
         running = True 
-        frameIndex = 1
-        delta = 0
+        delta = None
 
         while running:
             start = time.time()
 
+            # a camera that moves this frame reprojects from where it was,
+            # anything else that starts the image over clears it
+            previous = Reprojection(self.camera) if self.reproject else None
+            reprojection = None
+
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     running = False
@@ -66,89 +108,130 @@ class Application:
                 if event.type == pygame.WINDOWRESIZED:
                     DestroyTexture(self.image)
                     DestroyTexture(self.accumulation)
+                    DestroyTexture(self.randomNumbers)
+                    self.history.Destroy()
 
                     self.image = CreateTexture(self.window.get_width(), self.window.get_height())
                     self.accumulation = CreateTexture(self.window.get_width(), self.window.get_height())
+                    self.randomNumbers = self.CreateSeeds(self.window.get_width(), self.window.get_height())
+                    self.history = TemporalHistory(self.window.get_width(), self.window.get_height())
 
                     self.camera = Camera(90, self.window.get_width() / self.window.get_height(), 0.1, 100.0)
 
-                    frameIndex = 1
+                    self.frameIndex = 1
+                    previous = None
+
+            moving = self.camera.Update(delta or 0)
+
+            if moving:
+                self.frameIndex = 1
+                reprojection = previous
+
+            if self.resolution is not None:
+                self.resolution.Update(delta, moving)
+                renderSize = self.resolution.Size(self.window.get_width(), self.window.get_height())
+            else:
+                renderSize = (self.window.get_width(), self.window.get_height())
 
-            if self.camera.Update(delta):
-                frameIndex = 1
+            # the history was traced at another size
+            if renderSize != self.renderSize:
+                self.renderSize = renderSize
+                self.frameIndex = 1
+                reprojection = None
 
-            self.Compute(frameIndex)
+            if self.sceneBuffers.Upload():
+                self.frameIndex = 1
+                reprojection = None
+
+            self.Compute(self.frameIndex, reprojection)
             
-            DrawImage(self.rasterProgram, self.image)
+            scale = (self.renderSize[0] / self.window.get_width(), self.renderSize[1] / self.window.get_height())
+            self.frameResources.DrawImage(self.rasterProgram, self.image, scale)
 
             pygame.display.flip()
             end = time.time()
             
             delta = end - start
-            frameIndex += 1
 
-    def Compute(self, frameIndex):
+            if self.checkpoint is not None and self.FullSize():
+                self.checkpoint.SaveIfDue(self.ReadAccumulation, self.frameIndex)
+
+            self.frameIndex += 1
+
+    # the texture of per pixel seeds the shader advances every frame
+    def CreateSeeds(self, width: int, height: int):
+        data = np.random.randint(0, np.iinfo(np.uint32).max, (height, width, 1), dtype=np.uint32)
+        return CreateTexture(width, height, data, GL_R32UI, GL_RED_INTEGER, GL_UNSIGNED_INT)
+
+    def Compute(self, frameIndex, reprojection: Reprojection =None):
+        if reprojection is not None:
+            self.history.Save(self.accumulation)
+
         glUseProgram(self.shaderProgram)
 
-        self.dataBuffer.BindUnit(0)
+        self.sceneBuffers.BindUnits()
 
         glBindImageTexture(0, self.image, 0, False, 0, GL_READ_WRITE, GL_RGBA32F)
         glBindImageTexture(1, self.accumulation, 0, False, 0, GL_READ_WRITE, GL_RGBA32F)
         glBindImageTexture(2, self.randomNumbers, 0, False, 0, GL_READ_WRITE, GL_R32UI)
+        self.history.BindImages()
 
-        glUniform1i(glGetUniformLocation(self.shaderProgram, "OutImage"), 0)
-        glUniform1i(glGetUniformLocation(self.shaderProgram, "Accumulation"), 1)
-        glUniform1i(glGetUniformLocation(self.shaderProgram, "Seeds"), 2)
-
-        iView = self.camera.InverseView
-        iProjection = self.camera.InverseProjection
-
-        perFrameData = np.array([
-            *np.array(iView).flatten(),            
-            *np.array(iProjection).flatten(),      
-            self.camera.position.x, 
-            self.camera.position.y, 
-            self.camera.position.z,             
-            random.randint(0, 10000000),          
-            len(self.objects),                   
-            frameIndex                            
-        ], dtype=np.float32) 
-        
-        perFrameBuffer = GraphicsBuffer(perFrameData, bufferType=GL_UNIFORM_BUFFER)
-        perFrameBuffer.BindUnit(1)
+        locations = self.frameResources.Locations(self.shaderProgram)
 
+        glUniform1i(locations["OutImage"], 0)
+        glUniform1i(locations["Accumulation"], 1)
+        glUniform1i(locations["Seeds"], 2)
 
+        self.frameResources.WritePerFrame(PackPerFrame(self.camera, random.randint(0, 10000000), len(self.scene), frameIndex,
+                                                       self.renderSize, reprojection, self.sceneBuffers.lightCount))
 
-        glDispatchCompute(math.ceil(self.window.get_width() / 16), math.ceil(self.window.get_height() / 16), 1)
+        glDispatchCompute(math.ceil(self.renderSize[0] / 16), math.ceil(self.renderSize[1] / 16), 1)
         glMemoryBarrier(GL_SHADER_IMAGE_ACCESS_BARRIER_BIT)
 
-         
+        self.frameResources.EndFrame()
+
+    # a scaled down accumulation is not the image to resume
+    def FullSize(self) -> bool:
+        return self.renderSize == (self.window.get_width(), self.window.get_height())
+
+    # the accumulation and seed textures, restarting the checkpoint when the
+    # camera or window changed since it was made
+    def ReadAccumulation(self):
+        width, height = self.window.get_width(), self.window.get_height()
+
+        if self.checkpoint.cameraHash != CameraHash(self.camera, width, height):
+            self.checkpoint.Close()
+            self.checkpoint = Checkpoint(self.checkpointPath, self.liveScene.Columns(), self.camera, width, height, self.checkpointInterval)
+
+        accumulation = ReadTexture(self.accumulation, width, height)
+        seeds = ReadTexture(self.randomNumbers, width, height, 1, GL_RED_INTEGER, GL_UNSIGNED_INT, np.uint32)
+
+        return accumulation, seeds[..., 0]
 
     def Shutdown(self):
+        if self.checkpoint is not None:
+            if self.FullSize():
+                self.checkpoint.Save(*self.ReadAccumulation(), self.frameIndex - 1)
+
+            self.checkpoint.Close()
+
         DestroyTexture(self.image)
         DestroyTexture(self.accumulation)
         DestroyTexture(self.randomNumbers)
+        self.history.Destroy()
+
+        self.frameResources.Destroy()
+        self.sceneBuffers.Destroy()
+
+        SaveSceneColumns(self.save, self.liveScene.Columns())
 
-        with open(self.save, "w") as file:
-            l = [ 
-                    {  
-                        "Properties": {
-                            "Center": o.center.to_list(),
-                            "Colour": o.colour.to_list(),
-                            "Radius": o.radius,
-                            "Emission": o.emission
-                        }
-                    } 
-
-                    for o in self.objects
-                ]
-
-            yaml.dump(l, file)
+        if self.resolution is not None and self.resolutionLog:
+            self.resolution.WriteLog(self.resolutionLog)
         
         pygame.quit()
 
 
 if __name__ == "__main__":
-    app = Application(800, 600, "save.yaml")
+    app = Application(800, 600, "save.scene", "save.checkpoint")
     app.Run()
     app.Shutdown()
\ No newline at end of file
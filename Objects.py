@@ -4,6 +4,8 @@ import os
 import numpy as np 
 import glm
 
+INFINITY = float('inf')
+
 
 class Sphere:
     def __init__(self, center: glm.vec3, radius: float, colour: glm.vec3, emission: float):
@@ -21,42 +23,186 @@ class Sphere:
     def Data(self):
         return np.concatenate([self.center.to_list(), self.colour.to_list(), np.array([self.radius]), np.array([self.emission])])
 
+# one sphere of a SphereSet. it reads and writes the set's row, so it can go
+# anywhere a Sphere is expected
+class SphereView(Sphere):
+    def __init__(self, spheres: "SphereSet", index: int):
+        self.spheres = spheres
+        self.index = index
+
+    @property
+    def center(self) -> glm.vec3:
+        return glm.vec3(*self.spheres.data[self.index, 0:3].tolist())
+
+    @center.setter
+    def center(self, value: glm.vec3):
+        self.spheres.data[self.index, 0:3] = value.to_list()
+
+    @property
+    def colour(self) -> glm.vec3:
+        return glm.vec3(*self.spheres.data[self.index, 3:6].tolist())
+
+    @colour.setter
+    def colour(self, value: glm.vec3):
+        self.spheres.data[self.index, 3:6] = value.to_list()
+
+    @property
+    def radius(self) -> float:
+        return float(self.spheres.data[self.index, 6])
+
+    @radius.setter
+    def radius(self, value: float):
+        self.spheres.data[self.index, 6] = value
+
+    @property
+    def emission(self) -> float:
+        return float(self.spheres.data[self.index, 7])
+
+    @emission.setter
+    def emission(self, value: float):
+        self.spheres.data[self.index, 7] = value
+
+    @property
+    def Data(self):
+        return self.spheres.data[self.index]
+
+
+# spheres as rows of 8 float32, center, colour, radius and emission, the way
+# GetSphere in Launch.glsl reads them. data uploads as it is, the columns and
+# single spheres are views of it
+class SphereSet:
+    def __init__(self, data: np.ndarray = None):
+        self.data = np.zeros((0, 8), dtype=np.float32) if data is None else data
+
+    @classmethod
+    def FromObjects(cls, objects: list) -> "SphereSet":
+        rows = [o.center.to_list() + o.colour.to_list() + [o.radius, o.emission] for o in objects]
+        return cls(np.array(rows, dtype=np.float32).reshape(-1, 8))
+
+    # columns as Scene.LoadSceneColumns returns them
+    @classmethod
+    def FromColumns(cls, columns: dict) -> "SphereSet":
+        data = np.empty((len(columns["radius"]), 8), dtype=np.float32)
+
+        data[:, 0:3] = columns["center"]
+        data[:, 3:6] = columns["colour"]
+        data[:, 6] = columns["radius"]
+        data[:, 7] = columns["emission"]
+
+        return cls(data)
+
+    def __len__(self) -> int:
+        return len(self.data)
+
+    def __getitem__(self, index: int) -> SphereView:
+        if not -len(self.data) <= index < len(self.data):
+            raise IndexError(index)
+
+        return SphereView(self, index % len(self.data))
+
+    def __iter__(self):
+        return (SphereView(self, i) for i in range(len(self.data)))
+
+    @property
+    def center(self) -> np.ndarray:
+        return self.data[:, 0:3]
+
+    @property
+    def colour(self) -> np.ndarray:
+        return self.data[:, 3:6]
+
+    @property
+    def radius(self) -> np.ndarray:
+        return self.data[:, 6]
+
+    @property
+    def emission(self) -> np.ndarray:
+        return self.data[:, 7]
+
+    def Columns(self) -> dict:
+        return {"center": self.center, "colour": self.colour, "radius": self.radius, "emission": self.emission}
+
+    # (minn, maxx) of every sphere, the same float32 values AABB(obj=sphere) gives
+    def Bounds(self):
+        radius = self.radius[:, None]
+        return self.center - radius, self.center + radius
+
+    def Centroids(self) -> np.ndarray:
+        minn, maxx = self.Bounds()
+        return (minn + maxx) / 2
+
+    def BoundingBox(self) -> "AABB":
+        if not len(self.data):
+            return AABB()
+
+        minn, maxx = self.Bounds()
+        return AABB(glm.vec3(*minn.min(axis=0).tolist()), glm.vec3(*maxx.max(axis=0).tolist()))
+
+
+# bounds are value types on the hot paths of Insert and the SAH helpers, so
+# they have slots, a grow method per kind of object and a surface area and
+# centroid that are only recomputed after the box changed
 class AABB:
-    def __init__(self, minn: glm.vec3 = None, maxx: glm.vec3 = None, obj = None):
-        self.minn = glm.vec3(float('inf'))
-        self.maxx = glm.vec3(float('-inf'))
+    __slots__ = ("_minn", "_maxx", "_surfaceArea", "_centroid")
 
-        if minn:
-            self.minn = minn
-        
-        if maxx:
-            self.maxx = maxx
+    def __init__(self, minn: glm.vec3 = None, maxx: glm.vec3 = None, obj = None):
+        self._minn = glm.vec3(INFINITY) if minn is None else glm.vec3(minn)
+        self._maxx = glm.vec3(-INFINITY) if maxx is None else glm.vec3(maxx)
+        self._surfaceArea = None
+        self._centroid = None
 
-        if obj:
+        if obj is not None:
             self.Grow(obj)
-            
-    def Grow(self, obj):
-        if isinstance(obj, AABB):
-            self.minn = glm.min(self.minn, obj.minn)
-            self.maxx = glm.max(self.maxx, obj.maxx)
 
-            return
+    # the bounds and Centroid go in and out as copies, so that editing a vec3
+    # in place (box.minn.x = ...) cannot leave the cached values stale. the
+    # bounds change only through assignment and the Grow methods
+    @property
+    def minn(self) -> glm.vec3:
+        return glm.vec3(self._minn)
 
-        if isinstance(obj, Sphere):
-            minn = obj.center - glm.vec3(obj.radius)
-            maxx = obj.center + glm.vec3(obj.radius)
+    @minn.setter
+    def minn(self, value: glm.vec3):
+        self._minn = glm.vec3(value)
+        self._surfaceArea = self._centroid = None
 
-            self.Grow(AABB(minn, maxx))
+    @property
+    def maxx(self) -> glm.vec3:
+        return glm.vec3(self._maxx)
 
-            return
-        
-        if isinstance(obj, glm.vec3):
-            self.minn = glm.min(self.minn, obj)
-            self.maxx = glm.max(self.maxx, obj)
+    @maxx.setter
+    def maxx(self, value: glm.vec3):
+        self._maxx = glm.vec3(value)
+        self._surfaceArea = self._centroid = None
 
-            return
-        
-        raise ValueError("wot")
+    def GrowBox(self, box: "AABB"):
+        self._minn = glm.min(self._minn, box._minn)
+        self._maxx = glm.max(self._maxx, box._maxx)
+        self._surfaceArea = self._centroid = None
+
+    def GrowPoint(self, point: glm.vec3):
+        self._minn = glm.min(self._minn, point)
+        self._maxx = glm.max(self._maxx, point)
+        self._surfaceArea = self._centroid = None
+
+    def GrowSphere(self, sphere: Sphere):
+        center, radius = sphere.center, sphere.radius
+
+        self._minn = glm.min(self._minn, center - radius)
+        self._maxx = glm.max(self._maxx, center + radius)
+        self._surfaceArea = self._centroid = None
+
+    # for callers that do not know what they hold, the Grow methods above skip
+    # the dispatch
+    def Grow(self, obj):
+        if isinstance(obj, AABB):
+            self.GrowBox(obj)
+        elif isinstance(obj, Sphere):
+            self.GrowSphere(obj)
+        elif isinstance(obj, glm.vec3):
+            self.GrowPoint(obj)
+        else:
+            raise ValueError(f"cannot grow a box by {type(obj).__name__}")
     
     def GrowFromObjects(self, objects, key=lambda x: x):
         for obj in objects:
@@ -66,22 +212,22 @@ class AABB:
     def Contains(self, instance) -> bool:
         if isinstance(instance, glm.vec3):
             return not (
-                instance.x > self.maxx.x or 
-                instance.y > self.maxx.y or 
-                instance.z > self.maxx.z or 
-                instance.x < self.minn.x or 
-                instance.y < self.minn.y or 
-                instance.z < self.minn.z
+                instance.x > self._maxx.x or 
+                instance.y > self._maxx.y or 
+                instance.z > self._maxx.z or 
+                instance.x < self._minn.x or 
+                instance.y < self._minn.y or 
+                instance.z < self._minn.z
             )       
         
         if isinstance(instance, AABB):
             return not (
-                instance.minn.x > self.maxx.x or
-                instance.minn.y > self.maxx.y or
-                instance.minn.z > self.maxx.z or
-                instance.maxx.x < self.minn.x or
-                instance.maxx.y < self.minn.y or
-                instance.maxx.z < self.minn.z
+                instance._minn.x > self._maxx.x or
+                instance._minn.y > self._maxx.y or
+                instance._minn.z > self._maxx.z or
+                instance._maxx.x < self._minn.x or
+                instance._maxx.y < self._minn.y or
+                instance._maxx.z < self._minn.z
             )
 
         return False
@@ -89,7 +235,7 @@ class AABB:
 
     @property    
     def MaxDimension(self):
-        diagonal = self.maxx - self.minn
+        diagonal = self._maxx - self._minn
 
         maximum = max(diagonal)
 
@@ -102,29 +248,39 @@ class AABB:
 
     @property
     def Diagonal(self):
-        return self.maxx - self.minn
+        return self._maxx - self._minn
 
     @property 
     def SurfaceArea(self):
-        if not self.Valid:
-            return 0
+        if self._surfaceArea is None:
+            if not self.Valid:
+                self._surfaceArea = 0
+            else:
+                dx = self._maxx.x - self._minn.x
+                dy = self._maxx.y - self._minn.y
+                dz = self._maxx.z - self._minn.z
+
+                self._surfaceArea = 2 * (dx * dy + dx * dz + dy * dz)
 
-        diagonal = self.maxx - self.minn
-        return 2 * (diagonal.x * diagonal.y + diagonal.x * diagonal.z + diagonal.y * diagonal.z)
+        return self._surfaceArea
     
     @property 
     def Valid(self) -> bool:
-        return self.minn != glm.vec3(float('inf'))
+        minn = self._minn
+        return not (minn.x == INFINITY and minn.y == INFINITY and minn.z == INFINITY)
     
     @property
     def Centroid(self) -> glm.vec3:
-        return (self.minn + self.maxx) / 2
+        if self._centroid is None:
+            self._centroid = (self._minn + self._maxx) / 2
+
+        return glm.vec3(self._centroid)
 
     @property 
     def Volume(self) -> float:
-        diagonal = self.maxx - self.minn
+        diagonal = self._maxx - self._minn
         return prod(diagonal)
 
     @property
     def Data(self) -> np.array:
-        return np.concatenate([np.array(self.minn.to_list()), np.array(self.maxx.to_list())]).flatten()
\ No newline at end of file
+        return np.concatenate([np.array(self._minn.to_list()), np.array(self._maxx.to_list())]).flatten()
\ No newline at end of file
@@ -0,0 +1,358 @@
+import argparse
+import json
+import queue
+import socket
+import struct
+import threading
+import time
+from multiprocessing import Process
+
+import glm
+import numpy as np
+
+from Camera import *
+from Objects import *
+from Renderer import *
+from Scene import *
+
+# a coordinator hands out (tile, sample range) jobs to worker processes over
+# TCP. the scene and camera are sent once per worker. a job carries only the
+# tile's seeds and comes back with the sum of its samples, their count in
+# alpha, and the advanced seeds. the coordinator adds the sums to its
+# accumulation, so the image weighs every job by the samples it traced, and a
+# job whose worker dies is simply sent again. a tile's next job continues the
+# seeds its last one left, so it is only queued once that one returned: tiles
+# render in parallel, the jobs of one tile one after another. every pixel
+# sees the same random numbers as in a single node render, the image is the
+# same up to the float32 rounding of adding partial sums (identical when each
+# tile takes a single job). Render gives up once jobs wait with no worker
+# connected for longer than jobTimeout.
+#
+# messages are a ">II" header and payload length, a JSON header and raw bytes.
+
+
+def SendMessage(connection: socket.socket, header: dict, payload: bytes = b""):
+    data = json.dumps(header).encode()
+    connection.sendall(struct.pack(">II", len(data), len(payload)) + data + payload)
+
+def ReceiveMessage(connection: socket.socket):
+    headerLength, payloadLength = struct.unpack(">II", _ReceiveExactly(connection, 8))
+
+    header = json.loads(_ReceiveExactly(connection, headerLength))
+    payload = _ReceiveExactly(connection, payloadLength)
+
+    return header, payload
+
+def _ReceiveExactly(connection: socket.socket, size: int) -> bytes:
+    data = bytearray()
+
+    while len(data) < size:
+        chunk = connection.recv(size - len(data))
+
+        if not chunk:
+            raise ConnectionError("connection closed")
+
+        data.extend(chunk)
+
+    return bytes(data)
+
+
+# spheres travel as SceneArray rows, float64 so radii and emissions arrive
+# exactly as they were loaded
+def PackSpheres(objects: list) -> bytes:
+    return SceneArray(objects).tobytes()
+
+def UnpackSpheres(payload: bytes) -> list:
+    rows = np.frombuffer(payload, dtype=np.float64).reshape(-1, 8)
+    objects = []
+
+    for i, row in enumerate(rows.tolist()):
+        sphere = Sphere(glm.vec3(row[0:3]), row[6], glm.vec3(row[3:6]), row[7])
+        sphere.index = i
+        objects.append(sphere)
+
+    return objects
+
+def PackCamera(camera: Camera) -> dict:
+    return {
+        "fov": camera.fov,
+        "aspectRatio": camera.aspectRatio,
+        "nearPlane": camera.nearPlane,
+        "farPlane": camera.farPlane,
+        "position": camera.position.to_list(),
+        "forward": camera.forward.to_list()
+    }
+
+def UnpackCamera(data: dict) -> Camera:
+    camera = Camera(data["fov"], data["aspectRatio"], data["nearPlane"], data["farPlane"])
+    camera.position = glm.vec3(data["position"])
+    camera.forward = glm.vec3(data["forward"])
+
+    return camera
+
+
+class RenderFarmCoordinator:
+    def __init__(self, objects: list, camera: Camera, width: int, height: int, tileSize: int = 64,
+                 samplesPerJob: int = None, seed: int = 0, host: str = "127.0.0.1", port: int = 0,
+                 jobTimeout: float = 600.0):
+        accumulation = np.zeros((height, width, 4), dtype=np.float32)
+        seeds = np.random.default_rng(seed).integers(0, 0xFFFFFFFF, (height, width), dtype=np.uint32, endpoint=True)
+
+        # holds the merged buffers, it never traces anything itself
+        self.renderer = Renderer.FromArrays(None, None, None, camera, accumulation, seeds, tileSize)
+
+        self.scene = {
+            "type": "scene",
+            "width": width,
+            "height": height,
+            "seed": seed,
+            "bounceCount": self.renderer.bounceCount,
+            "camera": PackCamera(camera)
+        }
+        self.spheres = PackSpheres(objects)
+
+        self.samplesPerJob = samplesPerJob
+        self.jobTimeout = jobTimeout
+
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+        self.remaining = {}
+        self.nextFrame = {}
+        self.failures = 0
+        self.workerCount = 0
+
+        self.server = socket.create_server((host, port))
+        self.address = self.server.getsockname()
+
+        self.closed = False
+        threading.Thread(target=self._Accept, daemon=True).start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    # adds samples frames to every tile and returns once all of them came back.
+    # raises RuntimeError when no worker was connected for jobTimeout seconds
+    # while jobs were left
+    def Render(self, samples: int):
+        tiles = self.renderer.Tiles
+
+        with self.lock:
+            self.finished.clear()
+
+            for tile in tiles:
+                self.remaining[tuple(tile)] = samples
+                self.nextFrame.setdefault(tuple(tile), self.renderer.frameIndex + 1)
+
+            for tile in tiles:
+                self._QueueNext(tuple(tile))
+
+        idleSince = None
+
+        while not self.finished.wait(0.1):
+            with self.lock:
+                workerCount = self.workerCount
+
+            if workerCount:
+                idleSince = None
+                continue
+
+            idleSince = idleSince or time.perf_counter()
+
+            if time.perf_counter() - idleSince > self.jobTimeout:
+                raise RuntimeError(f"no worker connected for {self.jobTimeout:.0f}s with {len(self.remaining)} tiles left")
+
+        self.renderer.frameIndex += samples
+
+    # each pixel's alpha counts the samples merged into it
+    @property
+    def Image(self) -> np.ndarray:
+        accumulation = self.renderer.accumulation
+        return accumulation / np.maximum(accumulation[..., 3:], 1)
+
+    def SaveImages(self, path: str):
+        self.renderer.SaveImages(path)
+
+    def Close(self):
+        self.closed = True
+        self.finished.set()
+        self.server.close()
+
+    def _QueueNext(self, tile: tuple):
+        remaining = self.remaining[tile]
+
+        if remaining == 0:
+            del self.remaining[tile]
+
+            if not self.remaining:
+                self.finished.set()
+
+            return
+
+        samples = min(remaining, self.samplesPerJob or remaining)
+        self.jobs.put((tile, self.nextFrame[tile], samples))
+
+    def _Accept(self):
+        while not self.closed:
+            try:
+                connection, _ = self.server.accept()
+            except OSError:
+                return
+
+            threading.Thread(target=self._Serve, args=(connection,), daemon=True).start()
+
+    def _Serve(self, connection: socket.socket):
+        job = None
+        counted = False
+
+        try:
+            connection.settimeout(self.jobTimeout)
+
+            ReceiveMessage(connection)
+            SendMessage(connection, self.scene, self.spheres)
+
+            with self.lock:
+                self.workerCount += 1
+                counted = True
+
+            while not self.closed:
+                try:
+                    job = self.jobs.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+
+                tile, firstFrame, samples = job
+                x, y, width, height = tile
+
+                accumulation = self.renderer.accumulation[y:y + height, x:x + width]
+                seeds = self.renderer.seeds[y:y + height, x:x + width]
+
+                SendMessage(connection, {"type": "job", "tile": tile, "firstFrame": firstFrame, "samples": samples},
+                            np.ascontiguousarray(seeds).tobytes())
+
+                header, payload = ReceiveMessage(connection)
+                split = accumulation.nbytes
+
+                # the first frame starts the pixels over, as RenderTile does
+                with self.lock:
+                    if firstFrame == 1:
+                        accumulation[:] = 0
+
+                    accumulation += np.frombuffer(payload[:split], dtype=np.float32).reshape(accumulation.shape)
+                    seeds[:] = np.frombuffer(payload[split:], dtype=np.uint32).reshape(seeds.shape)
+
+                    self.remaining[tile] -= samples
+                    self.nextFrame[tile] += samples
+                    job = None
+
+                    self._QueueNext(tile)
+
+            SendMessage(connection, {"type": "done"})
+
+        except (OSError, ConnectionError, ValueError):
+            # the worker died or hung, its tile goes back in the queue untouched
+            if job is not None:
+                with self.lock:
+                    self.failures += 1
+                    self.jobs.put(job)
+
+        finally:
+            if counted:
+                with self.lock:
+                    self.workerCount -= 1
+
+            connection.close()
+
+
+# failAfter makes the worker drop its connection in the middle of that many
+# jobs, for testing the coordinator's recovery on localhost
+def RunWorker(host: str, port: int, failAfter: int = None):
+    connection = socket.create_connection((host, port))
+    SendMessage(connection, {"type": "hello"})
+
+    scene, payload = ReceiveMessage(connection)
+
+    renderer = Renderer(UnpackSpheres(payload), UnpackCamera(scene["camera"]), scene["width"], scene["height"])
+    renderer.bounceCount = scene["bounceCount"]
+
+    jobsDone = 0
+
+    while True:
+        header, payload = ReceiveMessage(connection)
+
+        if header["type"] == "done":
+            break
+
+        if failAfter is not None and jobsDone == failAfter:
+            connection.close()
+            return
+
+        x, y, width, height = header["tile"]
+
+        accumulation = renderer.accumulation[y:y + height, x:x + width]
+        seeds = renderer.seeds[y:y + height, x:x + width]
+
+        # only this job's samples go back, the coordinator adds them up
+        accumulation[:] = 0
+        seeds[:] = np.frombuffer(payload, dtype=np.uint32).reshape(seeds.shape)
+
+        for frameIndex in range(header["firstFrame"], header["firstFrame"] + header["samples"]):
+            renderer.RenderTile(x, y, width, height, frameIndex)
+
+        SendMessage(connection, {"type": "result", "tile": header["tile"]},
+                    np.ascontiguousarray(accumulation).tobytes() + np.ascontiguousarray(seeds).tobytes())
+
+        jobsDone += 1
+
+    connection.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render a scene across worker processes over TCP")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    coordinator = commands.add_parser("coordinator")
+    coordinator.add_argument("scene", help="scene file in the save.yaml format")
+    coordinator.add_argument("output", help="output path without extension, .pfm and .png are written")
+    coordinator.add_argument("--width", type=int, default=800)
+    coordinator.add_argument("--height", type=int, default=600)
+    coordinator.add_argument("--samples", type=int, default=16)
+    coordinator.add_argument("--samples-per-job", type=int, default=None)
+    coordinator.add_argument("--tile-size", type=int, default=64)
+    coordinator.add_argument("--seed", type=int, default=0)
+    coordinator.add_argument("--host", default="127.0.0.1")
+    coordinator.add_argument("--port", type=int, default=0)
+    coordinator.add_argument("--local-workers", type=int, default=0, help="worker processes to start on this machine")
+    coordinator.add_argument("--job-timeout", type=float, default=600.0,
+                             help="seconds a worker may take for a job, and jobs may wait with no worker connected")
+
+    worker = commands.add_parser("worker")
+    worker.add_argument("host")
+    worker.add_argument("port", type=int)
+
+    args = parser.parse_args()
+
+    if args.command == "worker":
+        RunWorker(args.host, args.port)
+    else:
+        camera = Camera(90, args.width / args.height, 0.1, 100.0)
+
+        with RenderFarmCoordinator(LoadScene(args.scene), camera, args.width, args.height, args.tile_size,
+                                   args.samples_per_job, args.seed, args.host, args.port, args.job_timeout) as farm:
+            print(f"coordinator listening on {farm.address[0]}:{farm.address[1]}")
+
+            workers = [Process(target=RunWorker, args=farm.address) for _ in range(args.local_workers)]
+            for process in workers:
+                process.start()
+
+            start = time.perf_counter()
+            farm.Render(args.samples)
+            print(f"{args.samples} samples in {time.perf_counter() - start:.2f}s, {farm.failures} jobs reassigned")
+
+            farm.SaveImages(args.output)
+
+        for process in workers:
+            process.join()
@@ -0,0 +1,195 @@
+import argparse
+import os
+import time
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+
+from BVH import *
+from Camera import *
+from Renderer import *
+from Scene import *
+
+
+# named numpy arrays living in shared memory blocks. the layout (name -> block
+# name, shape, dtype) is all another process needs to map the same arrays.
+class SharedArrays:
+    def __init__(self):
+        self.blocks = {}
+        self.arrays = {}
+        self.layout = {}
+
+    def Create(self, name: str, array: np.ndarray) -> np.ndarray:
+        array = np.ascontiguousarray(array)
+        block = SharedMemory(create=True, size=max(array.nbytes, 1))
+
+        view = np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)
+        view[...] = array
+
+        self.blocks[name] = block
+        self.arrays[name] = view
+        self.layout[name] = (block.name, array.shape, array.dtype.str)
+
+        return view
+
+    @staticmethod
+    def Attach(layout: dict) -> "SharedArrays":
+        shared = SharedArrays()
+
+        for name, (blockName, shape, dtype) in layout.items():
+            # pool processes share their parent's resource tracker, so attaching
+            # here does not make them owners of the block
+            block = SharedMemory(name=blockName)
+
+            shared.blocks[name] = block
+            shared.arrays[name] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=block.buf)
+            shared.layout[name] = (blockName, shape, dtype)
+
+        return shared
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.arrays[name]
+
+    def Close(self):
+        self.arrays.clear()
+
+        for block in self.blocks.values():
+            block.close()
+
+    def Unlink(self):
+        for block in self.blocks.values():
+            block.unlink()
+
+
+# state of each pool process, set up once by _InitialiseWorker
+_worker = None
+
+def _InitialiseWorker(layout: dict, camera: Camera, tileSize: int, bounceCount: int):
+    global _worker
+
+    shared = SharedArrays.Attach(layout)
+    bvh = BVH.FromArrays(shared.arrays)
+
+    renderer = Renderer.FromArrays(bvh, shared["colours"], shared["emissions"], camera,
+                                   shared["accumulation"], shared["seeds"], tileSize)
+    renderer.bounceCount = bounceCount
+
+    _worker = (shared, renderer)
+
+# renders samples frames of one tile straight into the shared accumulation
+# buffer, only the tile and its timing travel back
+def _RenderTile(task):
+    tile, firstFrame, samples = task
+    _, renderer = _worker
+
+    start = time.perf_counter()
+
+    for frameIndex in range(firstFrame, firstFrame + samples):
+        renderer.RenderTile(*tile, frameIndex)
+
+    return tile, time.perf_counter() - start, os.getpid()
+
+
+# renders a scene with a process pool. the image is cut into tiles that
+# workers take from the pool's queue as they become free, so slow tiles do not
+# hold up the others. pixels never pass through the queue: the accumulation
+# buffer, the seeds, the BVH and the sphere arrays are all shared memory.
+class RenderScheduler:
+    def __init__(self, objects: list, camera: Camera, width: int, height: int,
+                 tileSize: int = 32, workers: int = None, seed: int = 0):
+        renderer = Renderer(objects, camera, width, height, tileSize, seed)
+
+        self.shared = SharedArrays()
+
+        for name, array in renderer.bvh.Arrays().items():
+            self.shared.Create(name, array)
+
+        for name in ("colours", "emissions", "accumulation", "seeds"):
+            self.shared.Create(name, getattr(renderer, name))
+
+        # the coordinator's renderer reads the shared buffers too
+        self.renderer = Renderer.FromArrays(BVH.FromArrays(self.shared.arrays), self.shared["colours"],
+                                            self.shared["emissions"], camera, self.shared["accumulation"],
+                                            self.shared["seeds"], tileSize)
+
+        self.workers = workers or os.cpu_count()
+        self.pool = Pool(self.workers, _InitialiseWorker,
+                         (self.shared.layout, camera, tileSize, self.renderer.bounceCount))
+
+        self.tileTimings = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.Close()
+
+    # adds samples frames to every tile, returns (tile, seconds, worker pid)
+    # for each tile in the order they finished
+    def Render(self, samples: int) -> list:
+        firstFrame = self.renderer.frameIndex + 1
+        tasks = [(tile, firstFrame, samples) for tile in self.renderer.Tiles]
+
+        timings = list(self.pool.imap_unordered(_RenderTile, tasks))
+
+        self.renderer.frameIndex += samples
+        self.tileTimings.extend(timings)
+
+        return timings
+
+    def TimingReport(self) -> str:
+        if not self.tileTimings:
+            return "no tiles rendered"
+
+        seconds = np.array([t for _, t, _ in self.tileTimings])
+        perWorker = {}
+
+        for _, t, pid in self.tileTimings:
+            perWorker[pid] = perWorker.get(pid, 0) + t
+
+        busy = np.array(list(perWorker.values()))
+
+        return (f"{len(seconds)} tiles of {self.renderer.tileSize}px: "
+                f"mean {seconds.mean() * 1000:.1f}ms, min {seconds.min() * 1000:.1f}ms, "
+                f"max {seconds.max() * 1000:.1f}ms. {len(busy)} workers busy "
+                f"{busy.min():.2f}s to {busy.max():.2f}s")
+
+    @property
+    def Image(self) -> np.ndarray:
+        return self.renderer.Image
+
+    def SaveImages(self, path: str):
+        self.renderer.SaveImages(path)
+
+    def Close(self):
+        self.pool.close()
+        self.pool.join()
+
+        self.renderer = None
+        self.shared.Close()
+        self.shared.Unlink()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render a scene on the CPU with a process pool")
+    parser.add_argument("scene", help="scene file in the save.yaml format")
+    parser.add_argument("output", help="output path without extension, .pfm and .png are written")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--samples", type=int, default=16)
+    parser.add_argument("--tile-size", type=int, default=32)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    camera = Camera(90, args.width / args.height, 0.1, 100.0)
+
+    with RenderScheduler(LoadScene(args.scene), camera, args.width, args.height,
+                         args.tile_size, args.workers, args.seed) as scheduler:
+        start = time.perf_counter()
+        scheduler.Render(args.samples)
+        print(f"{args.samples} samples in {time.perf_counter() - start:.2f}s")
+        print(scheduler.TimingReport())
+
+        scheduler.SaveImages(args.output)
@@ -0,0 +1,498 @@
+import argparse
+import struct
+import time
+import zlib
+
+import glm
+import numpy as np
+
+from BVH import *
+from Camera import *
+from Checkpoint import *
+from Scene import *
+from WideBVH import *
+
+# CPU port of Shaders/Launch.glsl. every function and step below follows the
+# shader, in float32, over whole tiles of pixels at once. both trace through a
+# BVH, this one through BVH.TraceRays and the shader through the flattened
+# tree of BVH.Flatten. the image is kept with row 0 at the bottom like the GL
+# texture.
+
+UINT_MAX = np.float32(0xFFFFFFFF)
+FLT_MAX = np.float32(3.4028235e+38)
+PI = np.float32(3.14159265)
+
+# how Renderer picks bounce directions. "uniform" and "cosine" sample the
+# hemisphere with a uniform and a cosine density and only find lights by
+# hitting them, "lights" is what the shader does, cosine bounces plus a
+# sampled emissive sphere at every traced bounce, combined by MIS. all three
+# converge to the same image
+SAMPLING = ("uniform", "cosine", "lights")
+
+# defaults of Reprojection: the most samples a pixel keeps from the previous
+# view, how far the depth of a reprojected hit may be off relative to its
+# distance, and the least cosine between the old and new normal
+MAX_HISTORY = 32.0
+DEPTH_TOLERANCE = 0.02
+NORMAL_TOLERANCE = 0.9
+
+
+def PCGHash(seed: np.ndarray) -> np.ndarray:
+    state = seed * np.uint32(747796405) + np.uint32(2891336453)
+    word = ((state >> ((state >> np.uint32(28)) + np.uint32(4))) ^ state) * np.uint32(277803737)
+    return (word >> np.uint32(22)) ^ word
+
+# the shader's inout seed is returned alongside the value
+def GenFloat(seed: np.ndarray, min: float, max: float):
+    seed = PCGHash(seed)
+    return np.float32(min) + ((seed.astype(np.float32) / UINT_MAX) * np.float32(max - min)), seed
+
+def OrthonormalBasis(n: np.ndarray):
+    signZ = np.where(n[:, 2] >= 0, np.float32(1), np.float32(-1))
+    a = np.float32(-1) / (signZ + n[:, 2])
+    b = n[:, 0] * n[:, 1] * a
+
+    tangent = np.stack((1 + signZ * n[:, 0] * n[:, 0] * a, signZ * b, -signZ * n[:, 0]), axis=-1)
+    bitangent = np.stack((b, signZ + n[:, 1] * n[:, 1] * a, -n[:, 1]), axis=-1)
+
+    return tangent, bitangent
+
+# the unit vectors at polar angles with the given sines and cosines around axis
+def AroundAxis(axis: np.ndarray, sinTheta: np.ndarray, cosTheta: np.ndarray, phi: np.ndarray) -> np.ndarray:
+    tangent, bitangent = OrthonormalBasis(axis)
+
+    return Normalize(tangent * (sinTheta * np.cos(phi))[:, None] + bitangent * (sinTheta * np.sin(phi))[:, None]
+                     + axis * cosTheta[:, None])
+
+def RandomCosineHemisphereVector(normal: np.ndarray, seed: np.ndarray):
+    u1, seed = GenFloat(seed, 0.0, 1.0)
+    u2, seed = GenFloat(seed, 0.0, 1.0)
+
+    return AroundAxis(normal, np.sqrt(u1), np.sqrt(np.maximum(1 - u1, 0)), 2 * PI * u2), seed
+
+# only for comparison, the shader samples by cosine
+def RandomUniformHemisphereVector(normal: np.ndarray, seed: np.ndarray):
+    u1, seed = GenFloat(seed, 0.0, 1.0)
+    u2, seed = GenFloat(seed, 0.0, 1.0)
+
+    return AroundAxis(normal, np.sqrt(np.maximum(1 - u1 * u1, 0)), u1, 2 * PI * u2), seed
+
+def PowerHeuristic(pdf: np.ndarray, otherPdf: np.ndarray) -> np.ndarray:
+    return pdf * pdf / (pdf * pdf + otherPdf * otherPdf)
+
+# ConeSize of Shaders/Lights.glsl, 1 - cos of the half angle of the cones the
+# spheres cover from origins, 0 from inside them
+def ConeSize(origins: np.ndarray, centers: np.ndarray, radii: np.ndarray) -> np.ndarray:
+    toCenter = centers - origins
+    sinSquared = radii * radii / Dot(toCenter, toCenter)
+
+    inside = sinSquared >= 1
+    coneSize = sinSquared / (1 + np.sqrt(np.where(inside, np.float32(0), 1 - sinSquared)))
+
+    return np.where(inside, np.float32(0), coneSize)
+
+def LightPdf(coneSize: np.ndarray, lightCount: int) -> np.ndarray:
+    with np.errstate(divide="ignore"):
+        return np.where(coneSize > 0, np.float32(1) / (np.float32(lightCount) * 2 * PI * coneSize), np.float32(0))
+
+def Dot(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", a, b)
+
+def Normalize(v: np.ndarray) -> np.ndarray:
+    return v / np.sqrt(Dot(v, v))[:, None]
+
+def Transform(matrix: glm.mat4, v: np.ndarray) -> np.ndarray:
+    return v @ np.array(matrix, dtype=np.float32).T
+
+
+# what a frame reprojects the accumulation of the previous view from, taken
+# from the camera before it moved
+class Reprojection:
+    __slots__ = ("viewProjection", "position", "maxHistory", "depthTolerance", "normalTolerance")
+
+    def __init__(self, camera: Camera, maxHistory: float = MAX_HISTORY, depthTolerance: float = DEPTH_TOLERANCE,
+                 normalTolerance: float = NORMAL_TOLERANCE):
+        self.viewProjection = camera.Projection * camera.View
+        self.position = np.array(camera.position.to_list(), dtype=np.float32)
+
+        self.maxHistory, self.depthTolerance, self.normalTolerance = maxHistory, depthTolerance, normalTolerance
+
+# ReprojectHistory of Shaders/Reproject.glsl for pixels whose primary rays
+# start at origin along directions and hit what geometry holds, the normal and
+# the distance, FLT_MAX on a miss. a hit is looked up where the previous view
+# saw its point, a miss where it saw its direction. the pixel found there has
+# to have missed as well, or hit at the same distance from the previous camera
+# with about the same normal, else the pixel starts over from nothing
+def ReprojectHistory(reprojection: Reprojection, history: np.ndarray, historyGeometry: np.ndarray,
+                     origin: np.ndarray, directions: np.ndarray, geometry: np.ndarray) -> np.ndarray:
+    height, width = history.shape[:2]
+    count = len(directions)
+
+    miss = geometry[:, 3] >= FLT_MAX
+    depth = np.where(miss, np.float32(0), geometry[:, 3])
+
+    world = origin + directions * depth[:, None]
+    points = np.concatenate((np.where(miss[:, None], directions, world), (~miss).astype(np.float32)[:, None]), axis=-1)
+
+    clip = Transform(reprojection.viewProjection, points)
+    valid = clip[:, 3] > 0
+
+    w = np.where(valid, clip[:, 3], np.float32(1))
+    pixel = np.floor((clip[:, :2] / w[:, None] * np.float32(0.5) + np.float32(0.5)) * np.array([width, height], np.float32)
+                     + np.float32(0.5))
+
+    valid &= (pixel >= 0).all(axis=-1) & (pixel[:, 0] < width) & (pixel[:, 1] < height)
+
+    found = np.flatnonzero(valid)
+    px, py = pixel[found, 0].astype(np.int32), pixel[found, 1].astype(np.int32)
+
+    previous = historyGeometry[py, px]
+    previousMiss = previous[:, 3] >= FLT_MAX
+
+    distance = np.sqrt(Dot(world[found] - reprojection.position, world[found] - reprojection.position))
+
+    keep = np.where(miss[found], previousMiss,
+                    ~previousMiss & (np.abs(previous[:, 3] - distance) <= np.float32(reprojection.depthTolerance) * distance)
+                    & (Dot(previous[:, :3], geometry[found, :3]) >= np.float32(reprojection.normalTolerance)))
+
+    found, px, py = found[keep], px[keep], py[keep]
+
+    result = np.zeros((count, 4), dtype=np.float32)
+    result[found] = history[py, px]
+
+    samples = result[:, 3]
+    scale = np.where(samples > reprojection.maxHistory, np.float32(reprojection.maxHistory) / np.maximum(samples, 1), 1)
+
+    return result * scale[:, None].astype(np.float32)
+
+
+class Renderer:
+    def __init__(self, objects: list, camera: Camera, width: int, height: int, tileSize: int = 64, seed: int = 0):
+        bvh = BVH()
+        bvh.Build(objects)
+
+        if isinstance(objects, SphereSet):
+            colours, emissions = objects.colour, objects.emission
+        else:
+            colours = np.array([o.colour.to_list() for o in objects], dtype=np.float32).reshape(-1, 3)
+            emissions = np.array([o.emission for o in objects], dtype=np.float32)
+
+        accumulation = np.zeros((height, width, 4), dtype=np.float32)
+        seeds = np.random.default_rng(seed).integers(0, 0xFFFFFFFF, (height, width), dtype=np.uint32, endpoint=True)
+
+        self._Initialise(bvh, colours, emissions, camera, accumulation, seeds, tileSize)
+
+    # a renderer over existing arrays, which it uses in place
+    @classmethod
+    def FromArrays(cls, bvh: BVH, colours: np.ndarray, emissions: np.ndarray, camera: Camera, 
+                   accumulation: np.ndarray, seeds: np.ndarray, tileSize: int = 64) -> "Renderer":
+        renderer = cls.__new__(cls)
+        renderer._Initialise(bvh, colours, emissions, camera, accumulation, seeds, tileSize)
+        
+        return renderer
+
+    def _Initialise(self, bvh, colours, emissions, camera, accumulation, seeds, tileSize):
+        self.bvh = bvh
+        self.colours, self.emissions = colours, emissions
+        self.camera = camera
+
+        self.accumulation, self.seeds = accumulation, seeds
+        self.height, self.width = seeds.shape
+
+        # the normal and distance of each pixel's first hit, what MoveCamera
+        # reprojects from on the next frame
+        self.geometry = np.zeros((self.height, self.width, 4), dtype=np.float32)
+        self.geometry[..., 3] = FLT_MAX
+        self.reprojection = None
+
+        self.tileSize = tileSize
+        self.bounceCount = 3
+        self.frameIndex = 0
+
+        # a renderer that only holds buffers, as RenderFarmCoordinator's, has
+        # no scene to take lights from
+        self.sampling = "lights"
+        self.lights = np.zeros(0, dtype=np.int32) if emissions is None else np.flatnonzero(emissions > 0).astype(np.int32)
+
+    @property
+    def Tiles(self) -> list:
+        return [
+            (x, y, min(self.tileSize, self.width - x), min(self.tileSize, self.height - y))
+            for y in range(0, self.height, self.tileSize)
+            for x in range(0, self.width, self.tileSize)
+        ]
+
+    # OutImage of the shader, the accumulated samples averaged by how many
+    # each pixel has
+    @property
+    def Image(self) -> np.ndarray:
+        return self.accumulation / np.maximum(self.accumulation[..., 3:], 1)
+
+    # checkpoint, if given, is saved whenever its interval has passed
+    def Render(self, samples: int, verbose: bool = False, checkpoint: Checkpoint = None):
+        for _ in range(samples):
+            start = time.perf_counter()
+            self.RenderFrame()
+
+            if verbose:
+                print(f"sample {self.frameIndex} rendered in {time.perf_counter() - start:.2f}s")
+
+            if checkpoint is not None:
+                checkpoint.SaveIfDue(lambda: (self.accumulation, self.seeds), self.frameIndex)
+
+    # continues from a checkpoint made for this scene, camera and size
+    def Resume(self, checkpoint: Checkpoint):
+        self.accumulation[...] = checkpoint.accumulation
+        self.seeds[...] = checkpoint.seeds
+        self.frameIndex = checkpoint.frameIndex
+
+    # starts the image over from camera. with reproject the first frame keeps
+    # the samples of the pixels the old view also saw, as Application.Run does
+    # while the camera moves
+    def MoveCamera(self, camera: Camera, reproject: bool = False, **settings):
+        if reproject:
+            self.reprojection = (Reprojection(self.camera, **settings), self.accumulation.copy(), self.geometry.copy())
+
+        self.camera = camera
+        self.frameIndex = 0
+
+    def RenderFrame(self):
+        self.frameIndex += 1
+
+        for tile in self.Tiles:
+            self.RenderTile(*tile, self.frameIndex)
+
+        self.reprojection = None
+
+    def RenderTile(self, x: int, y: int, width: int, height: int, frameIndex: int):
+        accumulation = self.accumulation[y:y + height, x:x + width]
+        seeds = self.seeds[y:y + height, x:x + width]
+
+        light, newSeeds, geometry = self.TracePixels(x, y, width, height, seeds.ravel())
+
+        if frameIndex == 1 and self.reprojection is not None:
+            origin, directions = self.PrimaryRays(x, y, width, height)
+            accumulation[:] = ReprojectHistory(*self.reprojection, origin, directions, geometry).reshape(height, width, 4)
+        elif frameIndex == 1:
+            accumulation[:] = 0
+
+        accumulation[..., :3] += light.reshape(height, width, 3)
+        accumulation[..., 3] += 1
+        seeds[:] = newSeeds.reshape(height, width)
+
+        self.geometry[y:y + height, x:x + width] = geometry.reshape(height, width, 4)
+
+    # the camera rays of the tile's pixels, origins and directions
+    def PrimaryRays(self, x: int, y: int, width: int, height: int):
+        ys, xs = np.mgrid[y:y + height, x:x + width]
+
+        coordX = xs.ravel().astype(np.float32) / np.float32(self.width)
+        coordY = ys.ravel().astype(np.float32) / np.float32(self.height)
+        count = len(coordX)
+
+        ndc = np.stack((coordX * 2 - 1, coordY * 2 - 1, np.ones(count, np.float32), np.ones(count, np.float32)), axis=-1)
+
+        target = Transform(self.camera.InverseProjection, ndc)
+        target = target[:, :3] / target[:, 3:]
+
+        direction = Transform(self.camera.InverseView, np.concatenate((target, np.zeros((count, 1), np.float32)), axis=-1))
+        origin = np.tile(np.array(self.camera.position.to_list(), dtype=np.float32), (count, 1))
+
+        return origin, Normalize(direction[:, :3])
+
+    # main() of Launch.glsl for every pixel of the tile, returns the light
+    # gathered by each pixel's path, the advanced seeds and the normal and
+    # distance of the first hit
+    def TracePixels(self, x: int, y: int, width: int, height: int, seeds: np.ndarray):
+        ys = np.repeat(np.arange(y, y + height), width)
+        coordY = ys.astype(np.float32) / np.float32(self.height)
+
+        col = np.minimum(np.float32(1) - coordY + np.float32(0.3), np.float32(1))
+        skyColor = np.stack((col, col, col * np.float32(1.8)), axis=-1)
+
+        count = len(ys)
+        light = np.zeros((count, 3), dtype=np.float32)
+        color = np.ones((count, 3), dtype=np.float32)
+
+        origin, direction = self.PrimaryRays(x, y, width, height)
+        normal = np.zeros((count, 3), dtype=np.float32)
+
+        geometry = np.zeros((count, 4), dtype=np.float32)
+        geometry[:, 3] = FLT_MAX
+
+        seeds = seeds.copy()
+        active = np.arange(count)
+
+        centers, radii = self.bvh.SphereArrays()
+        sampleLights = self.sampling == "lights" and len(self.lights) > 0
+
+        # the solid angle density the current directions were sampled with
+        bsdfPdf = np.zeros(count, dtype=np.float32)
+
+        for bounce in range(self.bounceCount):
+            distances, spheres = self.bvh.TraceRays(origin[active], direction[active])
+
+            hit = spheres >= 0
+            active, distances, spheres = active[hit], distances[hit].astype(np.float32), spheres[hit]
+
+            if not len(active):
+                break
+
+            center = centers[spheres]
+            sphereColor = self.colours[spheres]
+            emission = self.emissions[spheres]
+
+            # a light a bounce found could also have been sampled directly
+            if sampleLights and bounce > 0:
+                coneSize = ConeSize(origin[active], center, radii[spheres].astype(np.float32))
+                weight = PowerHeuristic(bsdfPdf[active], LightPdf(coneSize, len(self.lights)))
+                emission = np.where(emission > 0, emission * weight, emission)
+
+            hitPoint = origin[active] + direction[active] * distances[:, None]
+            normal[active] = Normalize(hitPoint - center)
+
+            if bounce == 0:
+                geometry[active, :3], geometry[active, 3] = normal[active], distances
+
+            light[active] += sphereColor * color[active] * emission[:, None]
+            color[active] *= sphereColor
+
+            origin[active] = hitPoint + normal[active] * np.float32(0.0001)
+
+            # the last bounce is not traced, so neither are lights from it
+            if sampleLights and bounce < self.bounceCount - 1:
+                direct, seeds[active] = self.SampleLights(origin[active], normal[active], seeds[active])
+                light[active] += color[active] * direct
+
+            if self.sampling == "uniform":
+                direction[active], seeds[active] = RandomUniformHemisphereVector(normal[active], seeds[active])
+                cosTheta = np.maximum(Dot(normal[active], direction[active]), 0)
+
+                color[active] *= 2 * cosTheta[:, None]
+                bsdfPdf[active] = 1 / (2 * PI)
+            else:
+                direction[active], seeds[active] = RandomCosineHemisphereVector(normal[active], seeds[active])
+                bsdfPdf[active] = np.maximum(Dot(normal[active], direction[active]), 0) / PI
+
+        # as in the shader, a path that hit on its last bounce still gathers
+        # the sky along the direction it would have continued in
+        light += skyColor * color
+
+        return light, seeds, geometry
+
+    # SampleLights of Shaders/Lights.glsl for diffuse surfaces at origins,
+    # returns the light from one sampled emissive sphere each, per unit of the
+    # surface colour, and the advanced seeds
+    def SampleLights(self, origins: np.ndarray, normals: np.ndarray, seeds: np.ndarray):
+        u0, seeds = GenFloat(seeds, 0.0, 1.0)
+        u1, seeds = GenFloat(seeds, 0.0, 1.0)
+        u2, seeds = GenFloat(seeds, 0.0, 1.0)
+
+        lightCount = len(self.lights)
+        index = self.lights[np.minimum((u0 * np.float32(lightCount)).astype(np.int32), lightCount - 1)]
+
+        centers, radii = self.bvh.SphereArrays()
+        center = centers[index]
+
+        coneSize = ConeSize(origins, center, radii[index].astype(np.float32))
+
+        cosTheta = 1 - u1 * coneSize
+        sinTheta = np.sqrt(np.maximum(1 - cosTheta * cosTheta, 0))
+
+        direction = AroundAxis(Normalize(center - origins), sinTheta, cosTheta, 2 * PI * u2)
+        cosSurface = Dot(normals, direction)
+
+        direct = np.zeros((len(origins), 3), dtype=np.float32)
+        lit = np.flatnonzero((coneSize > 0) & (cosSurface > 0))
+
+        _, spheres = self.bvh.TraceRays(origins[lit], direction[lit])
+        lit = lit[spheres == index[lit]]
+
+        lightPdf = LightPdf(coneSize[lit], lightCount)
+        bsdfPdf = cosSurface[lit] / PI
+
+        weight = (bsdfPdf / lightPdf) * PowerHeuristic(lightPdf, bsdfPdf)
+        direct[lit] = self.colours[index[lit]] * (self.emissions[index[lit]] * weight)[:, None]
+
+        return direct, seeds
+
+    # writes <path>.pfm with the averaged float image and <path>.png clamped to 8 bits
+    def SaveImages(self, path: str):
+        image = self.Image[..., :3]
+
+        WritePFM(path + ".pfm", image)
+        WritePNG(path + ".png", (np.clip(image, 0, 1) * 255 + 0.5).astype(np.uint8))
+
+
+# both writers take images with row 0 at the bottom
+
+def WritePFM(path: str, image: np.ndarray):
+    height, width = image.shape[:2]
+
+    with open(path, "wb") as file:
+        file.write(f"PF\n{width} {height}\n-1.0\n".encode())
+        file.write(np.ascontiguousarray(image, dtype="<f4").tobytes())
+
+def WritePNG(path: str, image: np.ndarray):
+    height, width = image.shape[:2]
+    rows = np.flipud(image).reshape(height, width * 3)
+
+    raw = np.concatenate((np.zeros((height, 1), dtype=np.uint8), rows), axis=1).tobytes()
+
+    def Chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+
+    with open(path, "wb") as file:
+        file.write(b"\x89PNG\r\n\x1a\n")
+        file.write(Chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0)))
+        file.write(Chunk(b"IDAT", zlib.compress(raw)))
+        file.write(Chunk(b"IEND", b""))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="render a scene on the CPU without a window")
+    parser.add_argument("scene", help="scene file in the save.yaml format")
+    parser.add_argument("output", help="output path without extension, .pfm and .png are written")
+    parser.add_argument("--width", type=int, default=800)
+    parser.add_argument("--height", type=int, default=600)
+    parser.add_argument("--samples", type=int, default=16)
+    parser.add_argument("--tile-size", type=int, default=64)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--checkpoint", default=None, help="checkpoint file to resume from and save to")
+    parser.add_argument("--checkpoint-interval", type=float, default=60.0, help="seconds between checkpoints")
+    parser.add_argument("--bvh-width", type=int, default=2, choices=(2, 4, 8), help="children per BVH node when tracing")
+    parser.add_argument("--bvh-bits", type=int, default=None, choices=(8, 16), help="quantize wide BVH child bounds")
+    args = parser.parse_args()
+
+    # only the wide BVH has quantized bounds
+    if args.bvh_bits is not None and args.bvh_width == 2:
+        parser.error("--bvh-bits needs --bvh-width 4 or 8")
+
+    objects = LoadScene(args.scene)
+    camera = Camera(90, args.width / args.height, 0.1, 100.0)
+    renderer = Renderer(objects, camera, args.width, args.height, args.tile_size, args.seed)
+
+    if args.bvh_width > 2:
+        renderer.bvh = WideBVH(renderer.bvh, args.bvh_width, args.bvh_bits)
+
+    checkpoint = None
+
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint, SceneColumns(objects), camera, args.width, args.height, args.checkpoint_interval)
+
+        if checkpoint.resumed:
+            renderer.Resume(checkpoint)
+            print(f"resumed from {args.checkpoint} at sample {renderer.frameIndex}")
+
+    # --samples is the total, a resumed render only adds what is missing
+    samples = max(args.samples - renderer.frameIndex, 0)
+
+    start = time.perf_counter()
+    renderer.Render(samples, verbose=True, checkpoint=checkpoint)
+    print(f"{samples} samples in {time.perf_counter() - start:.2f}s")
+
+    if checkpoint is not None:
+        checkpoint.Save(renderer.accumulation, renderer.seeds, renderer.frameIndex)
+        checkpoint.Close()
+
+    renderer.SaveImages(args.output)
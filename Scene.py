@@ -0,0 +1,224 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import glm
+import numpy as np
+import yaml
+
+from Objects import *
+
+
+# save.yaml holds a list of spheres, each as 
+# {"Properties": {"Center": [x, y, z], "Colour": [r, g, b], "Radius": r, "Emission": e}}
+#
+# a binary scene is a 64 byte header followed by float32 columns, center
+# (count, 3), colour (count, 3), radius (count,) and emission (count,), back to
+# back. it loads by memory mapping, nothing is parsed per sphere. files ending
+# in .yaml or .yml are YAML, anything else is binary.
+
+SCENE_HEADER = np.dtype([
+    ("magic", "S4"),
+    ("version", "<u4"),
+    ("count", "<u8")
+])
+
+SCENE_HEADER_SIZE = 64
+SCENE_MAGIC = b"RTSC"
+SCENE_VERSION = 1
+
+# name and row width of each column, in file order
+COLUMNS = (("center", 3), ("colour", 3), ("radius", 1), ("emission", 1))
+
+
+def IsYAML(path: str) -> bool:
+    return path.lower().endswith((".yaml", ".yml"))
+
+def LoadScene(path: str) -> list:
+    if not IsYAML(path):
+        return ColumnsToObjects(LoadSceneColumns(path))
+
+    with open(path, "r") as file:
+        data = yaml.safe_load(file) or []
+
+    objects = [
+        Sphere(
+            glm.vec3(obj["Properties"]["Center"]), 
+            obj["Properties"]["Radius"], 
+            glm.vec3(obj["Properties"]["Colour"]), 
+            obj["Properties"]["Emission"]
+        ) 
+        for obj in data
+    ]
+
+    for i, obj in enumerate(objects):
+        obj.index = i
+
+    return objects
+
+def SaveScene(path: str, objects: list):
+    if not IsYAML(path):
+        SaveSceneColumns(path, SceneColumns(objects))
+        return
+
+    with open(path, "w") as file:
+        l = [ 
+                {  
+                    "Properties": {
+                        "Center": o.center.to_list(),
+                        "Colour": o.colour.to_list(),
+                        "Radius": o.radius,
+                        "Emission": o.emission
+                    }
+                } 
+
+                for o in objects
+            ]
+
+        yaml.dump(l, file)
+
+
+# the spheres as float64 rows in the GetSphere order of Launch.glsl,
+# center, colour, radius, emission
+def SceneArray(objects: list) -> np.ndarray:
+    rows = [o.center.to_list() + o.colour.to_list() + [o.radius, o.emission] for o in objects]
+    return np.array(rows, dtype=np.float64).reshape(-1, 8)
+
+
+def EmptyColumns() -> dict:
+    return {name: np.zeros((0, width) if width > 1 else 0, dtype=np.float32) for name, width in COLUMNS}
+
+def SceneColumns(objects: list) -> dict:
+    rows = SceneArray(objects).astype(np.float32)
+
+    return {
+        "center": rows[:, 0:3],
+        "colour": rows[:, 3:6],
+        "radius": rows[:, 6],
+        "emission": rows[:, 7]
+    }
+
+def ColumnsToObjects(columns: dict) -> list:
+    objects = []
+
+    for i, (center, colour, radius, emission) in enumerate(zip(columns["center"].tolist(), columns["colour"].tolist(),
+                                                                columns["radius"].tolist(), columns["emission"].tolist())):
+        sphere = Sphere(glm.vec3(center), radius, glm.vec3(colour), emission)
+        sphere.index = i
+        objects.append(sphere)
+
+    return objects
+
+# rows of 8 float32 laid out as GetSphere reads them, ready for the SSBO
+def SphereData(columns: dict) -> np.ndarray:
+    return np.concatenate((columns["center"], columns["colour"],
+                           columns["radius"][:, None], columns["emission"][:, None]), axis=1, dtype=np.float32)
+
+
+# the columns of a scene file, memory mapped read only for binary scenes
+def LoadSceneColumns(path: str) -> dict:
+    if IsYAML(path):
+        return SceneColumns(LoadScene(path))
+
+    header = np.fromfile(path, dtype=SCENE_HEADER, count=1)
+
+    if len(header) == 0 or header[0]["magic"] != SCENE_MAGIC or header[0]["version"] != SCENE_VERSION:
+        raise ValueError(f"{path} is not a binary scene")
+
+    count = int(header[0]["count"])
+
+    if count == 0:
+        return EmptyColumns()
+
+    data = np.memmap(path, dtype=np.float32, mode="r", offset=SCENE_HEADER_SIZE, shape=(count * 8,))
+    columns, offset = {}, 0
+
+    for name, width in COLUMNS:
+        column = data[offset:offset + count * width]
+        columns[name] = column.reshape(count, width) if width > 1 else column
+        offset += count * width
+
+    return columns
+
+def SaveSceneColumns(path: str, columns: dict):
+    if IsYAML(path):
+        SaveScene(path, ColumnsToObjects(columns))
+        return
+
+    with SceneWriter(path) as writer:
+        writer.Write(columns["center"], columns["colour"], columns["radius"], columns["emission"])
+
+
+# writes a binary scene in batches without holding it in memory. every column
+# goes to its own temporary file until Close, which joins them behind the
+# header. the scene replaces path in one rename, so a file that is memory
+# mapped somewhere stays valid
+class SceneWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.directory = os.path.dirname(os.path.abspath(path))
+        self.count = 0
+
+        self.files = {name: tempfile.TemporaryFile(dir=self.directory) for name, _ in COLUMNS}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, kind, *args):
+        if kind is None:
+            self.Close()
+        else:
+            self.Discard()
+
+    # appends a batch, any argument may be a single value for the whole batch
+    def Write(self, center, colour, radius, emission):
+        count = max(len(np.atleast_2d(center)), len(np.atleast_2d(colour)), np.size(radius), np.size(emission))
+
+        values = {"center": center, "colour": colour, "radius": radius, "emission": emission}
+
+        for name, width in COLUMNS:
+            shape = (count, width) if width > 1 else (count,)
+            column = np.broadcast_to(np.asarray(values[name], dtype=np.float32), shape)
+
+            self.files[name].write(np.ascontiguousarray(column).tobytes())
+
+        self.count += count
+
+    def Close(self):
+        header = np.zeros(1, dtype=SCENE_HEADER)
+        header["magic"], header["version"], header["count"] = SCENE_MAGIC, SCENE_VERSION, self.count
+
+        descriptor, temporary = tempfile.mkstemp(dir=self.directory)
+
+        with os.fdopen(descriptor, "wb") as file:
+            file.write(header.tobytes().ljust(SCENE_HEADER_SIZE, b"\0"))
+
+            for name, _ in COLUMNS:
+                self.files[name].seek(0)
+                shutil.copyfileobj(self.files[name], file)
+
+        os.replace(temporary, self.path)
+        self.Discard()
+
+    def Discard(self):
+        for file in self.files.values():
+            file.close()
+
+        self.files = {}
+
+
+def ImportYAML(yamlPath: str, scenePath: str):
+    SaveSceneColumns(scenePath, LoadSceneColumns(yamlPath))
+
+def ExportYAML(scenePath: str, yamlPath: str):
+    SaveSceneColumns(yamlPath, LoadSceneColumns(scenePath))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="convert scenes between YAML and the binary format")
+    parser.add_argument("input", help="scene to read, .yaml or binary")
+    parser.add_argument("output", help="scene to write, .yaml or binary")
+    args = parser.parse_args()
+
+    SaveSceneColumns(args.output, LoadSceneColumns(args.input))
@@ -0,0 +1,637 @@
+import argparse
+import sys
+import time
+
+import glm
+import numpy as np
+import OpenGL.GL as GL
+
+from BVH import *
+from Benchmark import *
+from GPUBVH import SHADER_STACK_SIZE, CompareHits, FlattenForShader, TraceFlattened
+
+# live edits of a SphereSet while it is on the GPU. LiveScene adds, moves,
+# recolours and deletes spheres on the CPU, keeps its BVH up to date and
+# remembers which rows changed. SceneBuffers uploads only the byte ranges
+# that differ from what the GPU already holds, into buffers with room to
+# grow, and reports how many bytes a frame cost. BVH nodes keep their slots
+# in the node buffer across edits, see NodeSlots:
+#
+#   python SceneEdits.py 100000
+#   PYOPENGL_PLATFORM=egl EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python SceneEdits.py 100000 --gpu
+
+
+# the half open [first, last) ranges covering sorted rows, rows at most gap
+# apart share a range since one larger upload is cheaper than two calls
+def CoalesceRows(rows: np.ndarray, gap: int = 0) -> np.ndarray:
+    if not len(rows):
+        return np.zeros((0, 2), dtype=np.int64)
+
+    breaks = np.flatnonzero(np.diff(rows) > gap + 1)
+
+    firsts = rows[np.r_[0, breaks + 1]]
+    lasts = rows[np.r_[breaks, len(rows) - 1]] + 1
+
+    return np.stack((firsts, lasts), axis=1)
+
+# an array of rows as a (rows, bytes per row) view
+def RowBytes(rows: np.ndarray) -> np.ndarray:
+    rows = np.ascontiguousarray(rows)
+    return rows.view(np.uint8).reshape(len(rows), rows.itemsize * int(np.prod(rows.shape[1:])))
+
+
+# a storage buffer of rows with spare capacity and a copy of what it holds.
+# Write uploads the rows that differ from that copy, coalesced into ranges,
+# and grows the buffer on the GPU when the rows no longer fit
+class DeltaBuffer:
+    def __init__(self, rows: np.ndarray, spare: float = 0.5, gap: int = 4, gl=GL):
+        self.gl = gl
+        self.spare, self.gap = spare, gap
+
+        data = RowBytes(rows)
+        self.rowBytes = data.shape[1]
+        self.count = len(data)
+
+        self.mirror = np.zeros((max(int(len(data) * (1 + spare)), 16), self.rowBytes), dtype=np.uint8)
+        self.mirror[:len(data)] = data
+
+        self.bufferID = self._Allocate()
+        self.uploadedBytes = self.mirror.nbytes
+        self.grows = 0
+
+    @property
+    def capacity(self) -> int:
+        return len(self.mirror)
+
+    # makes the buffer hold rows, changed are the only rows (besides new ones
+    # past the old end) that may differ, all of them are compared when None.
+    # returns the bytes and ranges uploaded
+    def Write(self, rows: np.ndarray, changed=None):
+        data = RowBytes(rows)
+
+        if data.shape[1] != self.rowBytes:
+            raise ValueError(f"rows of {data.shape[1]} bytes do not fit a buffer of {self.rowBytes} byte rows")
+
+        count = len(data)
+
+        if count > self.capacity:
+            self._Grow(count)
+
+        if changed is None:
+            candidates = np.arange(count)
+        else:
+            changed = np.asarray(changed, dtype=np.int64)
+            candidates = np.union1d(changed[changed < count], np.arange(self.count, count))
+
+        candidates = candidates[(data[candidates] != self.mirror[candidates]).any(axis=1)]
+        ranges = CoalesceRows(candidates, self.gap)
+
+        for first, last in ranges.tolist():
+            self.mirror[first:last] = data[first:last]
+            self.gl.glNamedBufferSubData(self.bufferID, first * self.rowBytes, (last - first) * self.rowBytes,
+                                         self.mirror[first:last])
+
+        self.count = count
+
+        uploaded = int(np.sum(ranges[:, 1] - ranges[:, 0])) * self.rowBytes
+        self.uploadedBytes += uploaded
+
+        return uploaded, len(ranges)
+
+    def BindUnit(self, unit: int = 0):
+        self.gl.glBindBufferBase(self.gl.GL_SHADER_STORAGE_BUFFER, unit, self.bufferID)
+
+    # the whole buffer back from the GPU, to check it against the mirror
+    def Read(self) -> np.ndarray:
+        data = np.empty(self.mirror.nbytes, dtype=np.uint8)
+        self.gl.glGetNamedBufferSubData(self.bufferID, 0, self.mirror.nbytes, data)
+
+        return data.reshape(-1, self.rowBytes)
+
+    def Destroy(self):
+        self.gl.glDeleteBuffers(1, [self.bufferID])
+
+    def _Allocate(self) -> int:
+        gl = self.gl
+
+        bufferID = gl.glGenBuffers(1)
+        gl.glBindBuffer(gl.GL_SHADER_STORAGE_BUFFER, bufferID)
+        gl.glBufferData(gl.GL_SHADER_STORAGE_BUFFER, self.mirror.nbytes, self.mirror, gl.GL_DYNAMIC_DRAW)
+        gl.glBindBuffer(gl.GL_SHADER_STORAGE_BUFFER, 0)
+
+        return bufferID
+
+    # a larger buffer that takes the old one's rows on the GPU, nothing is
+    # uploaded for them again
+    def _Grow(self, count: int):
+        oldID, oldBytes = self.bufferID, self.count * self.rowBytes
+
+        mirror = np.zeros((max(int(count * (1 + self.spare)), 2 * self.capacity), self.rowBytes), dtype=np.uint8)
+        mirror[:self.count] = self.mirror[:self.count]
+        self.mirror = mirror
+
+        self.bufferID = self.gl.glGenBuffers(1)
+        self.gl.glBindBuffer(self.gl.GL_SHADER_STORAGE_BUFFER, self.bufferID)
+        self.gl.glBufferData(self.gl.GL_SHADER_STORAGE_BUFFER, self.mirror.nbytes, None, self.gl.GL_DYNAMIC_DRAW)
+        self.gl.glBindBuffer(self.gl.GL_SHADER_STORAGE_BUFFER, 0)
+
+        self.gl.glCopyNamedBufferSubData(oldID, self.bufferID, 0, 0, oldBytes)
+        self.gl.glNamedBufferSubData(self.bufferID, oldBytes, self.mirror.nbytes - oldBytes, self.mirror[self.count:])
+        self.gl.glDeleteBuffers(1, [oldID])
+
+        self.grows += 1
+
+
+# a SphereSet and its BVH that take edits between frames. the set's rows live
+# in a larger array so adding rarely copies, its data is a view of the rows
+# in use. a deleted sphere leaves the BVH and its row is zeroed, Add fills
+# such holes first so indices of the other spheres never change
+class LiveScene:
+    def __init__(self, spheres: SphereSet, bvh: BVH = None, spare: float = 0.5):
+        self.spheres = spheres
+
+        count = len(spheres)
+        self.rows = np.zeros((max(int(count * (1 + spare)), 16), 8), dtype=np.float32)
+        self.rows[:count] = spheres.data
+        spheres.data = self.rows[:count]
+
+        self.alive = np.zeros(len(self.rows), dtype=bool)
+        self.alive[:count] = True
+        self.free = []
+
+        if bvh is None:
+            bvh = BVH()
+            bvh.Build(spheres)
+
+        self.bvh = bvh
+
+        # rows edited since the last Flush, those whose bounds changed, and
+        # whether the tree gained or lost a sphere
+        self._dirty = set()
+        self._moved = set()
+        self._treeEdited = False
+
+    def __len__(self) -> int:
+        return int(np.count_nonzero(self.alive))
+
+    def Add(self, center, radius: float, colour, emission: float = 0.0) -> int:
+        if self.free:
+            index = self.free.pop()
+        else:
+            index = len(self.spheres)
+
+            if index == len(self.rows):
+                self._Grow()
+
+            self.spheres.data = self.rows[:index + 1]
+
+        self.rows[index] = [*center, *colour, radius, emission]
+        self.alive[index] = True
+        self._dirty.add(index)
+
+        self.bvh.InsertIndex(index)
+        self._treeEdited = True
+
+        return index
+
+    def Move(self, index: int, center, radius: float = None):
+        self._Check(index)
+
+        self.rows[index, 0:3] = center
+
+        if radius is not None:
+            self.rows[index, 6] = radius
+
+        self._dirty.add(index)
+        self._moved.add(index)
+
+    def Recolour(self, index: int, colour, emission: float = None):
+        self._Check(index)
+
+        self.rows[index, 3:6] = colour
+
+        if emission is not None:
+            self.rows[index, 7] = emission
+
+        self._dirty.add(index)
+
+    def Delete(self, index: int):
+        self._Check(index)
+
+        self.bvh.Remove(index)
+        self._treeEdited = True
+
+        self.rows[index] = 0
+        self.alive[index] = False
+        self.free.append(index)
+
+        self._dirty.add(index)
+        self._moved.discard(index)
+
+    # brings the BVH up to date with the moves since the last call. returns
+    # the rows edited since then, in order, and whether the tree may have
+    # changed. recolours leave it as it is
+    def Flush(self):
+        treeEdited = self._treeEdited or bool(self._moved)
+
+        if self._moved:
+            self.bvh.Update(sorted(self._moved))
+
+        dirty = np.array(sorted(self._dirty), dtype=np.int64)
+        self._dirty.clear()
+        self._moved.clear()
+        self._treeEdited = False
+
+        return dirty, treeEdited
+
+    # the columns of the spheres that are alive, for saving
+    def Columns(self) -> dict:
+        return SphereSet(self.spheres.data[self.alive[:len(self.spheres)]]).Columns()
+
+    def _Check(self, index: int):
+        if not 0 <= index < len(self.spheres) or not self.alive[index]:
+            raise ValueError(f"sphere {index} is not in the scene")
+
+    def _Grow(self):
+        count = len(self.rows)
+
+        self.rows = np.concatenate((self.rows, np.zeros((count, 8), dtype=np.float32)))
+        self.alive = np.concatenate((self.alive, np.zeros(count, dtype=bool)))
+
+
+# the nodes of a BVH as GPU_NODE rows that keep their place while the tree
+# is edited. BVH.Flatten numbers nodes level by level, so a single insert or
+# remove shifts most of the rows after it. here every inner node owns a pair
+# of slots for its two children, which Shaders/BVH.glsl reads at leftFirst
+# and leftFirst + 1, for as long as it stays an inner node. Update finds the
+# nodes that InsertIndex, Remove, Refit or a rebuild touched by comparing the
+# tree's node arrays with a copy of them, and rewrites only their rows and
+# those of their children. leaves point straight into the BVH's own
+# primitiveIndices, whose ranges stay where they are between rebuilds
+class NodeSlots:
+    def __init__(self, bvh: BVH):
+        self.bvh = bvh
+        self.Layout()
+
+    @property
+    def rows(self) -> np.ndarray:
+        return self._rows[:self.slotCount]
+
+    @property
+    def primitiveIndices(self) -> np.ndarray:
+        return self.bvh.primitiveIndices[:self.bvh.primitiveIndexCount]
+
+    # every slot from scratch, level by level as BVH.Flatten numbers them
+    def Layout(self):
+        bvh = self.bvh
+        levels = [np.zeros(1, dtype=np.int32)]
+
+        while True:
+            inner = levels[-1][bvh.leftChild[levels[-1]] >= 0]
+
+            if not len(inner):
+                break
+
+            levels.append(np.stack((bvh.leftChild[inner], bvh.rightChild[inner]), axis=1).ravel())
+
+        if len(levels) > SHADER_STACK_SIZE:
+            raise ValueError(f"BVH depth {len(levels) - 1} is too deep for the shader's stack of {SHADER_STACK_SIZE}")
+
+        order = np.concatenate(levels)
+        self.slotCount = len(order)
+
+        self.slotOf = np.full(bvh.nodeCount, -1, dtype=np.int32)
+        self.slotOf[order] = np.arange(len(order), dtype=np.int32)
+
+        self.pairOf = np.full(bvh.nodeCount, -1, dtype=np.int32)
+        inner = order[bvh.leftChild[order] >= 0]
+        self.pairOf[inner] = self.slotOf[bvh.leftChild[inner]]
+
+        self.freePairs = []
+
+        self._rows = np.zeros(self.slotCount, dtype=GPU_NODE)
+        self._rows[self.slotOf[order]] = self._Rows(order)
+
+        self._Snapshot()
+
+    # brings the rows up to date with the tree, returns the slots written or
+    # None when everything was laid out again
+    def Update(self):
+        bvh = self.bvh
+        count, known = bvh.nodeCount, len(self.slotOf)
+
+        # a rebuild numbers the nodes anew, nothing keeps its place then
+        if count < known:
+            self.Layout()
+            return None
+
+        arrays = self._Arrays()
+        changed = np.zeros(count, dtype=bool)
+        changed[known:] = True
+
+        for array, copy in zip(arrays, self._copies):
+            differs = array[:known] != copy
+            changed[:known] |= differs[:, 0] | differs[:, 1] | differs[:, 2] if differs.ndim > 1 else differs
+
+        changed = np.flatnonzero(changed).astype(np.int32)
+
+        if 2 * len(changed) > count:
+            self.Layout()
+            return None
+
+        self.slotOf = _Extend(self.slotOf, count)
+        self.pairOf = _Extend(self.pairOf, count)
+
+        reachable = (bvh.parent[changed] >= 0) | (changed == 0)
+        inner = changed[reachable & (bvh.leftChild[changed] >= 0)]
+
+        # pairs of nodes that are leaves or cut loose now are free again
+        for node in changed[bvh.leftChild[changed] < 0].tolist() + changed[~reachable].tolist():
+            if self.pairOf[node] >= 0:
+                self.freePairs.append(int(self.pairOf[node]))
+                self.pairOf[node] = -1
+
+        for node in inner.tolist():
+            if self.pairOf[node] < 0:
+                self.pairOf[node] = self._AllocatePair()
+
+            # the children of a node that moved down by a rotation or an insert
+            # may now be past the shader's stack
+            if len(bvh._Ancestors(node)) + 1 > SHADER_STACK_SIZE:
+                raise ValueError(f"BVH depth {len(bvh._Ancestors(node))} is too deep for the shader's stack of "
+                                 f"{SHADER_STACK_SIZE}")
+
+        left, right = bvh.leftChild[inner], bvh.rightChild[inner]
+        self.slotOf[left], self.slotOf[right] = self.pairOf[inner], self.pairOf[inner] + 1
+
+        written = np.unique(np.concatenate((changed[reachable], left, right)))
+        slots = self.slotOf[written]
+
+        self._rows[slots] = self._Rows(written)
+
+        for index, array in enumerate(arrays):
+            if count > known:
+                self._copies[index] = np.concatenate((self._copies[index], array[known:]))
+
+            self._copies[index][changed] = array[changed]
+
+        return np.unique(slots)
+
+    def _AllocatePair(self) -> int:
+        if self.freePairs:
+            return self.freePairs.pop()
+
+        slot = self.slotCount
+        self.slotCount += 2
+
+        if self.slotCount > len(self._rows):
+            rows = np.zeros(max(self.slotCount, 2 * len(self._rows)), dtype=GPU_NODE)
+            rows[:len(self._rows)] = self._rows
+            self._rows = rows
+
+        return slot
+
+    # the rows of nodes: an inner node's leftFirst is the first slot of its
+    # pair, a leaf's is where its range starts in primitiveIndices
+    def _Rows(self, nodes: np.ndarray) -> np.ndarray:
+        bvh = self.bvh
+        leaf = bvh.leftChild[nodes] < 0
+        counts = bvh.primitiveCount[nodes]
+
+        rows = np.zeros(len(nodes), dtype=GPU_NODE)
+        rows["min"] = bvh.nodeMin[nodes]
+        rows["max"] = bvh.nodeMax[nodes]
+        rows["leftFirst"] = np.where(leaf, np.where(counts > 0, bvh.primitiveOffset[nodes], -1), self.pairOf[nodes])
+        rows["count"] = np.where(leaf, counts, 0)
+
+        return rows
+
+    def _Arrays(self) -> tuple:
+        bvh, count = self.bvh, self.bvh.nodeCount
+
+        return (bvh.nodeMin[:count], bvh.nodeMax[:count], bvh.leftChild[:count], bvh.rightChild[:count],
+                bvh.parent[:count], bvh.primitiveOffset[:count], bvh.primitiveCount[:count])
+
+    def _Snapshot(self):
+        self._copies = [array.copy() for array in self._Arrays()]
+
+def _Extend(array: np.ndarray, count: int) -> np.ndarray:
+    return np.concatenate((array, np.full(count - len(array), -1, dtype=array.dtype))) if count > len(array) else array
+
+
+# the object, node, primitive index and light buffers of a LiveScene. Upload
+# once a frame sends what the edits since the last one changed
+class SceneBuffers:
+    def __init__(self, scene: LiveScene, spare: float = 0.5, gl=GL):
+        self.scene = scene
+        self.nodeSlots = NodeSlots(scene.bvh)
+
+        self.objects = DeltaBuffer(scene.spheres.data, spare, gl=gl)
+        self.nodes = DeltaBuffer(self.nodeSlots.rows, spare, gl=gl)
+        self.primitiveIndices = DeltaBuffer(self.nodeSlots.primitiveIndices, spare, gl=gl)
+        self.lights = DeltaBuffer(self.Lights(), spare, gl=gl)
+
+        # bytes and ranges of the last Upload
+        self.uploadStatistics = {}
+
+    # returns whether anything the shader reads changed, only then does the
+    # accumulated image have to start over
+    def Upload(self) -> bool:
+        start = time.perf_counter()
+        dirty, treeEdited = self.scene.Flush()
+
+        statistics = {"editedRows": len(dirty), "fullLayout": False}
+        writes = {"object": (0, 0), "node": (0, 0), "primitiveIndex": (0, 0), "light": (0, 0)}
+
+        if len(dirty):
+            writes["object"] = self.objects.Write(self.scene.spheres.data, dirty)
+            writes["light"] = self.lights.Write(self.Lights())
+
+        # a recolour leaves the tree as it is
+        if treeEdited:
+            slots = self.nodeSlots.Update()
+            statistics["fullLayout"] = slots is None
+
+            writes["node"] = self.nodes.Write(self.nodeSlots.rows, slots)
+            writes["primitiveIndex"] = self.primitiveIndices.Write(self.nodeSlots.primitiveIndices)
+
+        for name, (uploaded, ranges) in writes.items():
+            statistics[name + "Bytes"], statistics[name + "Ranges"] = uploaded, ranges
+
+        statistics["bytes"] = sum(uploaded for uploaded, _ in writes.values())
+        statistics["uploadTime"] = time.perf_counter() - start
+
+        self.uploadStatistics = statistics
+
+        return statistics["bytes"] > 0
+
+    # the spheres Shaders/Lights.glsl samples, those alive with Emission > 0
+    def Lights(self) -> np.ndarray:
+        data = self.scene.spheres.data
+        return np.flatnonzero((data[:, 7] > 0) & self.scene.alive[:len(data)]).astype(np.int32)
+
+    @property
+    def lightCount(self) -> int:
+        return self.lights.count
+
+    # binds the buffers to the units Shaders/Scene.glsl, Shaders/BVH.glsl and
+    # Shaders/Lights.glsl read
+    def BindUnits(self):
+        self.objects.BindUnit(0)
+        self.nodes.BindUnit(2)
+        self.primitiveIndices.BindUnit(3)
+        self.lights.BindUnit(4)
+
+    def Destroy(self):
+        for buffer in (self.objects, self.nodes, self.primitiveIndices, self.lights):
+            buffer.Destroy()
+
+
+# one random edit of kind on scene, within the bounds of the scene
+def RandomEdit(scene: LiveScene, kind: str, rng: np.random.Generator, minn: np.ndarray, maxx: np.ndarray):
+    alive = np.flatnonzero(scene.alive[:len(scene.spheres)])
+    index = int(rng.choice(alive))
+
+    if kind == "add":
+        scene.Add(rng.uniform(minn, maxx).tolist(), float(rng.uniform(0.2, 1.5)), rng.random(3).tolist())
+    elif kind == "move":
+        scene.Move(index, (scene.rows[index, 0:3] + rng.normal(0, 1, 3)).tolist())
+    elif kind == "recolour":
+        scene.Recolour(index, rng.random(3).tolist())
+    elif kind == "delete":
+        scene.Delete(index)
+    elif kind == "same":
+        scene.Move(index, scene.rows[index, 0:3].tolist())
+
+# the GPU buffers have to hold what the CPU has, rays traced through the
+# uploaded node slots the way the shader walks them have to find what the BVH
+# finds, and the edited BVH has to find the hits a fresh one over the same
+# rows finds
+def CheckBuffers(scene: LiveScene, buffers: SceneBuffers, gpu: bool, rayCount: int = 500) -> int:
+    failures = 0
+    held = {}
+
+    for name, buffer, rows in (("objects", buffers.objects, scene.spheres.data),
+                               ("nodes", buffers.nodes, buffers.nodeSlots.rows),
+                               ("primitive indices", buffers.primitiveIndices, buffers.nodeSlots.primitiveIndices),
+                               ("lights", buffers.lights, buffers.Lights())):
+        data = RowBytes(rows)
+        held[name] = buffer.Read()[:len(data)] if gpu else buffer.mirror[:len(data)]
+
+        if len(data) != buffer.count or not np.array_equal(held[name], data):
+            print(f"  {name} differ from the CPU")
+            failures += 1
+
+    origins, directions = RandomRays(list(SphereSet(scene.spheres.data[scene.alive[:len(scene.spheres)]])), 2000)
+    expected = scene.bvh.TraceRays(origins, directions)
+
+    # both in float32, far from the origin they may differ from TraceRays
+    def Trace(nodes, primitiveIndices):
+        return [TraceFlattened(nodes, primitiveIndices, scene.spheres.data, origin, direction)
+                for origin, direction in zip(origins[:rayCount], directions[:rayCount])]
+
+    nodes, primitiveIndices = FlattenForShader(scene.bvh)
+    held["nodes"] = np.ascontiguousarray(held["nodes"]).view(GPU_NODE).ravel()
+    held["primitive indices"] = np.ascontiguousarray(held["primitive indices"]).view(np.int32).ravel()
+
+    if Trace(held["nodes"], held["primitive indices"]) != Trace(nodes, primitiveIndices):
+        print("  rays through the node slots hit other spheres than through BVH.Flatten")
+        failures += 1
+
+    fresh = BVH()
+    fresh.Build(SphereSet(scene.spheres.data.copy()))
+
+    mismatches = CompareHits(fresh.TraceRays(origins, directions), expected)
+
+    if mismatches > len(origins) // 500:
+        print(f"  {mismatches} rays hit other spheres than a fresh BVH")
+        failures += 1
+
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="upload scene edits as byte ranges and check the buffers")
+    parser.add_argument("count", type=int, nargs="?", default=100000, help="spheres in the scene")
+    parser.add_argument("--scene", default="uniform", choices=SCENES.keys())
+    parser.add_argument("--frames", type=int, default=50, help="frames of random edits")
+    parser.add_argument("--edits", type=int, default=20, help="edits per frame")
+    parser.add_argument("--gpu", action="store_true", help="upload to a headless OpenGL context instead of a recording stub")
+    args = parser.parse_args()
+
+    if args.gpu:
+        from GPUBVH import CreateHeadlessContext
+        CreateHeadlessContext()
+        gl = GL
+    else:
+        from FrameResources import RecordingGL
+        gl = RecordingGL()
+
+    spheres = SphereSet.FromObjects(SCENES[args.scene](args.count))
+    minn, maxx = spheres.center.min(axis=0), spheres.center.max(axis=0)
+
+    scene = LiveScene(spheres)
+    buffers = SceneBuffers(scene, gl=gl)
+    rng = np.random.default_rng(0)
+
+    print(f"{args.scene} scene, {args.count} spheres, {buffers.objects.uploadedBytes + buffers.nodes.uploadedBytes + buffers.primitiveIndices.uploadedBytes} bytes for the first upload")
+    print(f"{'edit':>10} {'object B':>9} {'node B':>9} {'index B':>9} {'ranges':>7} {'reset':>6} {'upload (ms)':>12}")
+
+    # a single edit of each kind has to cost O(1) bandwidth: one object row,
+    # the node rows on one path to the root and a couple of pairs besides, and
+    # no more primitive indices than a leaf split moves. a recolour writes no
+    # nodes at all
+    depth = len(scene.bvh._InnerLevels())
+    nodeLimit = 2 * (depth + 2) * GPU_NODE.itemsize
+    indexLimit = 2 * (scene.bvh.threshold + 1) * np.dtype(np.int32).itemsize
+    failures = 0
+
+    for kind in ("same", "recolour", "move", "add", "delete"):
+        RandomEdit(scene, kind, rng, minn, maxx)
+        reset = buffers.Upload()
+        statistics = buffers.uploadStatistics
+
+        ranges = statistics["objectRanges"] + statistics["nodeRanges"] + statistics["primitiveIndexRanges"]
+        print(f"{kind:>10} {statistics['objectBytes']:>9} {statistics['nodeBytes']:>9} {statistics['primitiveIndexBytes']:>9} "
+              f"{ranges:>7} {str(reset):>6} {statistics['uploadTime'] * 1000:>12.2f}")
+
+        if (statistics["objectBytes"] > RowBytes(scene.spheres.data).shape[1] or statistics["nodeBytes"] > nodeLimit
+                or statistics["primitiveIndexBytes"] > indexLimit or (kind == "recolour" and statistics["nodeBytes"])):
+            print(f"  a single {kind} uploaded more than one path of the tree ({nodeLimit} node B, {indexLimit} index B)")
+            failures += 1
+
+    failures += CheckBuffers(scene, buffers, args.gpu)
+
+    # frames of mixed edits, adding more than is deleted so the buffers grow.
+    # frames where BVH.Update rebuilt the tree upload all of it, they are
+    # counted apart from the rest
+    kinds = ["move"] * 6 + ["recolour"] * 2 + ["add"] * 3 + ["delete"]
+    totals = {layout: {"frames": 0, "objectBytes": 0, "nodeBytes": 0, "primitiveIndexBytes": 0, "uploadTime": 0.0}
+              for layout in (False, True)}
+
+    for frame in range(args.frames):
+        for _ in range(args.edits):
+            RandomEdit(scene, kinds[rng.integers(len(kinds))], rng, minn, maxx)
+
+        buffers.Upload()
+        total = totals[buffers.uploadStatistics["fullLayout"]]
+        total["frames"] += 1
+
+        for name in ("objectBytes", "nodeBytes", "primitiveIndexBytes", "uploadTime"):
+            total[name] += buffers.uploadStatistics[name]
+
+    print(f"{args.frames} frames of {args.edits} edits, buffers grew {buffers.objects.grows}, {buffers.nodes.grows}, "
+          f"{buffers.primitiveIndices.grows} times; {len(scene)} spheres")
+
+    for layout, name in ((False, "edited in place"), (True, "rebuilt by BVH.Update")):
+        total = totals[layout]
+        frames = max(total["frames"], 1)
+
+        print(f"  {total['frames']} frames {name}: per frame {total['objectBytes'] / frames:.0f} object B, "
+              f"{total['nodeBytes'] / frames:.0f} node B, {total['primitiveIndexBytes'] / frames:.0f} index B, "
+              f"{total['uploadTime'] / frames * 1000:.2f} ms")
+
+    failures += CheckBuffers(scene, buffers, args.gpu)
+    buffers.Destroy()
+
+    sys.exit(1 if failures else 0)
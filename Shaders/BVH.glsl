@@ -0,0 +1,131 @@
+#ifndef BVH 
+#define BVH 
+
+// layout contract with BVH.Flatten and GPU_NODE in BVH.py. children of an
+// inner node sit next to each other, LeftFirst is the left one and Count is 0.
+// a leaf has Count primitives starting at LeftFirst in primitiveIndices, an
+// empty leaf has LeftFirst -1.
+struct BVHNode
+{
+    vec3 Min;
+    int  LeftFirst;
+    vec3 Max;
+    int  Count;
+};
+
+layout(std430, binding = 2) readonly buffer BVHNodes 
+{
+    BVHNode nodes[];
+};
+
+layout(std430, binding = 3) readonly buffer BVHPrimitives 
+{
+    int primitiveIndices[];
+};
+
+// a tree deeper than this is refused on upload, see SHADER_STACK_SIZE in GPUBVH.py
+#define BVH_STACK_SIZE 64
+
+// distance at which the ray enters the box, 0 from inside it, FLT_MAX on a miss
+float RayBoxEntry(vec3 origin, vec3 reciprocal, vec3 minn, vec3 maxx)
+{
+    vec3 t0 = (minn - origin) * reciprocal;
+    vec3 t1 = (maxx - origin) * reciprocal;
+
+    vec3 lower = min(t0, t1);
+    vec3 upper = max(t0, t1);
+
+    float tmin = max(max(lower.x, lower.y), lower.z);
+    float tmax = min(min(upper.x, upper.y), upper.z);
+
+    if (tmax < tmin || tmax < 0)
+    {
+        return FLT_MAX;
+    }
+
+    return max(tmin, 0.0);
+}
+
+// closest hit, ray ends up as RaySphereTest returned it for the nearest
+// sphere. nearer children are visited first and nodes that start beyond the
+// closest hit so far are skipped.
+void TraceBVH(inout RayPayload ray)
+{
+    vec3 direction = vec3(
+        ray.Direction.x == 0 ? 2.220446e-16 : ray.Direction.x,
+        ray.Direction.y == 0 ? 2.220446e-16 : ray.Direction.y,
+        ray.Direction.z == 0 ? 2.220446e-16 : ray.Direction.z
+    );
+
+    vec3 reciprocal = 1.0 / direction;
+
+    int   stack[BVH_STACK_SIZE];
+    float stackEntry[BVH_STACK_SIZE];
+    int   stackSize = 0;
+
+    stack[0] = 0;
+    stackEntry[0] = RayBoxEntry(ray.Origin, reciprocal, nodes[0].Min, nodes[0].Max);
+    stackSize = 1;
+
+    while (stackSize > 0)
+    {
+        stackSize--;
+
+        if (stackEntry[stackSize] >= ray.Distance)
+        {
+            continue;
+        }
+
+        BVHNode node = nodes[stack[stackSize]];
+
+        if (node.Count > 0)
+        {
+            for (int i = node.LeftFirst; i < node.LeftFirst + node.Count; i++)
+            {
+                int sphereIndex = primitiveIndices[i];
+                RayPayload test = RaySphereTest(ray, GetSphere(sphereIndex), sphereIndex);
+
+                if (test.Intersected && test.Distance < ray.Distance)
+                {
+                    ray = test;
+                }
+            }
+
+            continue;
+        }
+
+        if (node.LeftFirst < 0)
+        {
+            continue;
+        }
+
+        int near = node.LeftFirst;
+        int far  = node.LeftFirst + 1;
+
+        float nearEntry = RayBoxEntry(ray.Origin, reciprocal, nodes[near].Min, nodes[near].Max);
+        float farEntry  = RayBoxEntry(ray.Origin, reciprocal, nodes[far].Min, nodes[far].Max);
+
+        if (farEntry < nearEntry)
+        {
+            int index = near; near = far; far = index;
+            float entry = nearEntry; nearEntry = farEntry; farEntry = entry;
+        }
+
+        // the far child goes under the near one so the near one pops first
+        if (farEntry < ray.Distance)
+        {
+            stack[stackSize] = far;
+            stackEntry[stackSize] = farEntry;
+            stackSize++;
+        }
+
+        if (nearEntry < ray.Distance)
+        {
+            stack[stackSize] = near;
+            stackEntry[stackSize] = nearEntry;
+            stackSize++;
+        }
+    }
+}
+
+#endif
\ No newline at end of file
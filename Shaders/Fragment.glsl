@@ -5,7 +5,12 @@ out vec4 FragColor;
 
 layout(binding = 0) uniform sampler2D Image;  
 
+// the part of Image the compute pass rendered, stretched over the screen. the
+// lookup stays half a texel inside it so the filter never reads past its edge
+uniform vec2 ImageScale;
+
 void main()
 {
-    FragColor = texture(Image, TexCoords);
-}
\ No newline at end of file
+    vec2 uv = min(TexCoords * ImageScale, ImageScale - 0.5 / vec2(textureSize(Image, 0)));
+    FragColor = texture(Image, uv);
+}
@@ -7,12 +7,8 @@ layout(rgba32f, binding = 1) uniform image2D Accumulation;
 layout(r32ui, binding = 2) uniform uimage2D Seeds;
 
 #define FLT_MAX 3.4028235e+38
-#define UINT_MAX 0xFFFFFFFF
-
-layout(std430, binding = 0) buffer ObjectData 
-{
-    float data[];
-};
+#define UINT_MAX 0xFFFFFFFFu
+#define PI 3.14159265
 
 layout(binding = 1) uniform PerFrame
 {
@@ -22,38 +18,45 @@ layout(binding = 1) uniform PerFrame
     float Seed;
     float ObjectCount;
     float FrameIndex;
+
+    // on the first frame after the camera moved, Reproject is 1 when the
+    // previous view's samples are carried over instead of cleared
+    float Reproject;
+    float MaxHistory;
+    mat4  PreviousViewProjection;
+    vec3  PreviousPosition;
+    float DepthTolerance;
+    float NormalTolerance;
+
+    // spheres in the LightIndices buffer of Shaders/Lights.glsl
+    float LightCount;
+
+    // pixels traced this frame, the bottom left corner of the images. it is
+    // smaller than them while DynamicResolution.py scales the frame down
+    vec2  RenderSize;
 };
 
 #include "Ray.glsl"
 #include "Random.glsl"
-
-Sphere GetSphere(int index) 
-{
-    int realIndex = 8 * index;
-
-    Sphere sphere; 
-    sphere.Center   = vec3(data[realIndex], data[realIndex + 1], data[realIndex + 2]);
-    sphere.Color    = vec3(data[realIndex + 3], data[realIndex + 4], data[realIndex + 5]);
-    sphere.Radius   = data[realIndex + 6];
-    sphere.Emission = data[realIndex + 7];
-
-    return sphere;
-}
+#include "Scene.glsl"
+#include "BVH.glsl"
+#include "Reproject.glsl"
+#include "Lights.glsl"
 
 
 void main() 
 {
     ivec2 id = ivec2(gl_GlobalInvocationID.xy);
 
-    if(FrameIndex == 1)
+    if (any(greaterThanEqual(id, ivec2(RenderSize))))
     {
-        imageStore(Accumulation, id, vec4(0));  
+        return;
     }
 
     int bounceCount = 3;
 
     vec3 coord  = vec3(id.x, id.y, 1.0);
-    coord  /= vec3(imageSize(OutImage), 1.0);
+    coord  /= vec3(RenderSize, 1.0);
 
     float col = 1.0 - coord.y;
     col = min(col + 0.3, 1.0);
@@ -80,61 +83,81 @@ void main()
 
     uvec4 loadedSeed = imageLoad(Seeds, id);
     uint currentSeed = loadedSeed.x;
-    bool calculateDiffuse = false;
+
+    // the solid angle density the current direction was sampled with, 0 for
+    // the camera ray
+    float bsdfPdf = 0.0;
+
+    // normal and distance of the first hit
+    vec4 geometry = vec4(0.0, 0.0, 0.0, FLT_MAX);
 
     for(int bounce = 0; bounce < bounceCount; bounce++)
     {
-        for(int i = 0; i < int(ObjectCount); i++)
-        {
-            Sphere sphere = GetSphere(i);
+        vec3 origin = ray.Origin;
+
+        TraceBVH(ray);
 
-            RayPayload test = RaySphereTest(ray, sphere, i);
+        if (ray.Intersected)
+        {
+            Sphere sphere = GetSphere(ray.SphereIndex);
 
-            if(!test.Intersected)
+            if (bounce == 0)
             {
-                continue;
+                geometry = vec4(ray.Normal, ray.Distance);
             }
 
-            if (test.Distance < ray.Distance)
+            // a light a bounce found could also have been sampled directly
+            float weight = 1.0;
+
+            if (bsdfPdf > 0.0 && LightCount > 0 && sphere.Emission > 0.0)
             {
-                ray = test;
+                weight = PowerHeuristic(bsdfPdf, LightPdf(origin, sphere));
             }
-        }
-
-        if (ray.Intersected)
-        {
-            Sphere sphere = GetSphere(ray.SphereIndex);
 
-            light += sphere.Color * color * sphere.Emission;
+            light += sphere.Color * color * sphere.Emission * weight;
             color *= sphere.Color;
 
             ray.Origin  = ray.Origin + ray.Direction * ray.Distance;
             ray.Origin += ray.Normal * 0.0001;
-            ray.Direction = normalize(RandomHemisphereVector(ray.Normal, currentSeed));
+
+            // the last bounce is not traced, so neither are lights from it
+            if (bounce < bounceCount - 1 && LightCount > 0)
+            {
+                light += color * SampleLights(ray.Origin, ray.Normal, currentSeed);
+            }
+
+            ray.Direction = RandomCosineHemisphereVector(ray.Normal, currentSeed);
+            bsdfPdf = max(dot(ray.Normal, ray.Direction), 0.0) / PI;
             
             ray.Intersected = false;
             ray.Distance = FLT_MAX;
 
-            calculateDiffuse = true;
-
             continue;
         }
 
         break;
     }
 
-    float cosTheta = 1.0; 
-    
-    if (calculateDiffuse)
+    // a path that hit on its last bounce still gathers the sky along the
+    // direction it would have continued in. the cosine of that direction is
+    // in its density
+    light += skyColor * color;
+
+    vec4 history = vec4(0);
+
+    if (FrameIndex != 1)
     {
-        cosTheta = max(dot(ray.Normal, ray.Direction), 0.0);
+        history = imageLoad(Accumulation, id);
+    }
+    else if (Reproject > 0)
+    {
+        history = ReprojectHistory(rayDirection, geometry);
     }
 
-    light += skyColor * color * cosTheta;
-
-    vec4 newColor = imageLoad(Accumulation, id) + vec4(light, 1.0);
+    vec4 newColor = history + vec4(light, 1.0);
     
     imageStore(Accumulation, id, newColor);  
+    imageStore(Geometry, id, geometry);
     imageStore(Seeds, id, uvec4(currentSeed));
-    imageStore(OutImage, id, newColor / FrameIndex);  
+    imageStore(OutImage, id, newColor / newColor.w);  
 }
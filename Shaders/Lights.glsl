@@ -0,0 +1,101 @@
+#ifndef LIGHTS
+#define LIGHTS
+
+// indices of the spheres with Emission > 0, LightCount of them. direct light
+// is sampled by picking one uniformly and a direction in the cone it covers,
+// and combined with the light that diffuse bounces find by the power
+// heuristic. SampleLights in Renderer.py is the CPU port of this file.
+layout(std430, binding = 4) readonly buffer LightIndices
+{
+    int lights[];
+};
+
+float PowerHeuristic(float pdf, float otherPdf)
+{
+    return pdf * pdf / (pdf * pdf + otherPdf * otherPdf);
+}
+
+// 1 - cos of the half angle of the cone sphere covers from origin, 0 from
+// inside it. written so that small cones do not cancel to 0
+float ConeSize(vec3 origin, Sphere sphere)
+{
+    vec3 toCenter = sphere.Center - origin;
+    float sinSquared = sphere.Radius * sphere.Radius / dot(toCenter, toCenter);
+
+    if (sinSquared >= 1.0)
+    {
+        return 0.0;
+    }
+
+    return sinSquared / (1.0 + sqrt(1.0 - sinSquared));
+}
+
+// the solid angle density of SampleLights picking a direction toward sphere
+float LightPdf(vec3 origin, Sphere sphere)
+{
+    float coneSize = ConeSize(origin, sphere);
+
+    if (coneSize <= 0.0)
+    {
+        return 0.0;
+    }
+
+    return 1.0 / (LightCount * 2.0 * PI * coneSize);
+}
+
+// the light reaching a diffuse surface at origin from one sampled light, per
+// unit of its colour and with the MIS weight applied. takes three numbers
+// from seed whatever happens
+vec3 SampleLights(vec3 origin, vec3 normal, inout uint seed)
+{
+    int index = lights[min(int(GenFloat(seed, 0.0, 1.0) * LightCount), int(LightCount) - 1)];
+
+    float u1 = GenFloat(seed, 0.0, 1.0);
+    float u2 = GenFloat(seed, 0.0, 1.0);
+
+    Sphere sphere = GetSphere(index);
+    float coneSize = ConeSize(origin, sphere);
+
+    if (coneSize <= 0.0)
+    {
+        return vec3(0.0);
+    }
+
+    float cosTheta = 1.0 - u1 * coneSize;
+    float sinTheta = sqrt(max(1.0 - cosTheta * cosTheta, 0.0));
+    float phi = 2.0 * PI * u2;
+
+    vec3 axis = normalize(sphere.Center - origin);
+    vec3 tangent, bitangent;
+    OrthonormalBasis(axis, tangent, bitangent);
+
+    vec3 direction = normalize(tangent * (sinTheta * cos(phi)) + bitangent * (sinTheta * sin(phi)) + axis * cosTheta);
+    float cosSurface = dot(normal, direction);
+
+    if (cosSurface <= 0.0)
+    {
+        return vec3(0.0);
+    }
+
+    RayPayload shadow;
+
+    shadow.Origin = origin;
+    shadow.Direction = direction;
+    shadow.Distance = FLT_MAX;
+    shadow.SphereIndex = -1;
+    shadow.Intersected = false;
+
+    TraceBVH(shadow);
+
+    if (!shadow.Intersected || shadow.SphereIndex != index)
+    {
+        return vec3(0.0);
+    }
+
+    float lightPdf = 1.0 / (LightCount * 2.0 * PI * coneSize);
+    float bsdfPdf = cosSurface / PI;
+
+    return sphere.Color * sphere.Emission * (bsdfPdf / lightPdf) * PowerHeuristic(lightPdf, bsdfPdf);
+}
+
+#endif
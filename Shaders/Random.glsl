@@ -14,15 +14,31 @@ float GenFloat(inout uint seed, float min, float max)
     return min + ((float(seed) / float(UINT_MAX)) * (max-min));
 }
 
-vec3 RandomVector(inout uint seed)
+// a tangent and bitangent that make a right handed basis with the unit vector n
+void OrthonormalBasis(vec3 n, out vec3 tangent, out vec3 bitangent)
 {
-    return vec3(GenFloat(seed, -1.0, 1.0), GenFloat(seed, -1.0, 1.0), GenFloat(seed, -1.0, 1.0));
+    float signZ = n.z >= 0.0 ? 1.0 : -1.0;
+    float a = -1.0 / (signZ + n.z);
+    float b = n.x * n.y * a;
+
+    tangent   = vec3(1.0 + signZ * n.x * n.x * a, signZ * b, -signZ * n.x);
+    bitangent = vec3(b, signZ + n.y * n.y * a, -n.y);
 }
 
-vec3 RandomHemisphereVector(vec3 normal, inout uint seed)
+// a direction around normal with density cos(theta) / PI, which cancels the
+// cosine and 1 / PI of a diffuse surface
+vec3 RandomCosineHemisphereVector(vec3 normal, inout uint seed)
 {
-    vec3 randomVec = normalize(RandomVector(seed)); 
-    return dot(randomVec, normal) > 0.0 ? randomVec : -randomVec; 
+    float u1 = GenFloat(seed, 0.0, 1.0);
+    float u2 = GenFloat(seed, 0.0, 1.0);
+
+    float r = sqrt(u1);
+    float phi = 2.0 * PI * u2;
+
+    vec3 tangent, bitangent;
+    OrthonormalBasis(normal, tangent, bitangent);
+
+    return normalize(tangent * (r * cos(phi)) + bitangent * (r * sin(phi)) + normal * sqrt(max(1.0 - u1, 0.0)));
 }
 
 #endif
\ No newline at end of file
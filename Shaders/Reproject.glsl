@@ -0,0 +1,69 @@
+#ifndef REPROJECT
+#define REPROJECT
+
+// the accumulation and first hits of the previous view, copied before a frame
+// that reprojects, rendered at the same RenderSize as this one. Geometry holds
+// the normal and distance of each pixel's first hit, FLT_MAX on a miss.
+// ReprojectHistory in Renderer.py is the CPU port of this file.
+layout(rgba32f, binding = 3) uniform image2D Geometry;
+layout(rgba32f, binding = 4) uniform image2D HistoryAccumulation;
+layout(rgba32f, binding = 5) uniform image2D HistoryGeometry;
+
+// the accumulated samples the previous view has for the pixel whose primary
+// ray leaves CameraPosition along direction and hits what geometry holds. a
+// hit is looked up where the previous view saw its point, a miss where it saw
+// its direction. the pixel found there has to have missed as well, or hit at
+// the same distance from the previous camera with about the same normal, else
+// nothing is kept. at most MaxHistory samples come back.
+vec4 ReprojectHistory(vec3 direction, vec4 geometry)
+{
+    vec2 size = RenderSize;
+
+    bool miss = geometry.w >= FLT_MAX;
+    vec3 world = CameraPosition + direction * (miss ? 0.0 : geometry.w);
+
+    vec4 clip = PreviousViewProjection * (miss ? vec4(direction, 0.0) : vec4(world, 1.0));
+
+    if (clip.w <= 0)
+    {
+        return vec4(0);
+    }
+
+    vec2 pixel = floor((clip.xy / clip.w * 0.5 + 0.5) * size + 0.5);
+
+    if (any(lessThan(pixel, vec2(0))) || any(greaterThanEqual(pixel, size)))
+    {
+        return vec4(0);
+    }
+
+    ivec2 previous = ivec2(pixel);
+    vec4 previousGeometry = imageLoad(HistoryGeometry, previous);
+    bool previousMiss = previousGeometry.w >= FLT_MAX;
+
+    if (miss != previousMiss)
+    {
+        return vec4(0);
+    }
+
+    if (!miss)
+    {
+        float distance = length(world - PreviousPosition);
+
+        if (abs(previousGeometry.w - distance) > DepthTolerance * distance ||
+            dot(previousGeometry.xyz, geometry.xyz) < NormalTolerance)
+        {
+            return vec4(0);
+        }
+    }
+
+    vec4 history = imageLoad(HistoryAccumulation, previous);
+
+    if (history.w > MaxHistory)
+    {
+        history *= MaxHistory / history.w;
+    }
+
+    return history;
+}
+
+#endif
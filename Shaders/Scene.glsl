@@ -0,0 +1,23 @@
+#ifndef SCENE 
+#define SCENE 
+
+// spheres as 8 floats each, center, colour, radius and emission
+layout(std430, binding = 0) buffer ObjectData 
+{
+    float data[];
+};
+
+Sphere GetSphere(int index) 
+{
+    int realIndex = 8 * index;
+
+    Sphere sphere; 
+    sphere.Center   = vec3(data[realIndex], data[realIndex + 1], data[realIndex + 2]);
+    sphere.Color    = vec3(data[realIndex + 3], data[realIndex + 4], data[realIndex + 5]);
+    sphere.Radius   = data[realIndex + 6];
+    sphere.Emission = data[realIndex + 7];
+
+    return sphere;
+}
+
+#endif
\ No newline at end of file
@@ -0,0 +1,59 @@
+#version 450 core
+
+// closest hit of every ray in Rays through TraceBVH, for checking the shader
+// traversal against the CPU. see TraceRaysOnGPU in GPUBVH.py
+
+layout (local_size_x = 64, local_size_y = 1, local_size_z = 1) in;
+
+#define FLT_MAX 3.4028235e+38
+
+#include "Ray.glsl"
+#include "Scene.glsl"
+#include "BVH.glsl"
+
+struct TestRay
+{
+    vec4 Origin;
+    vec4 Direction;
+};
+
+struct Hit
+{
+    float Distance;
+    int   SphereIndex;
+};
+
+layout(std430, binding = 4) readonly buffer Rays 
+{
+    TestRay rays[];
+};
+
+layout(std430, binding = 5) writeonly buffer Hits 
+{
+    Hit hits[];
+};
+
+uniform int RayCount;
+
+void main() 
+{
+    int id = int(gl_GlobalInvocationID.x);
+
+    if (id >= RayCount)
+    {
+        return;
+    }
+
+    RayPayload ray;
+
+    ray.Origin = rays[id].Origin.xyz;
+    ray.Direction = rays[id].Direction.xyz;
+    ray.Distance = FLT_MAX;
+    ray.SphereIndex = -1;
+    ray.Intersected = false;
+
+    TraceBVH(ray);
+
+    hits[id].Distance = ray.Distance;
+    hits[id].SphereIndex = ray.Intersected ? ray.SphereIndex : -1;
+}
\ No newline at end of file
@@ -0,0 +1,260 @@
+import argparse
+import os
+import sys
+import time
+
+import glm
+import numpy as np
+import OpenGL.GL as GL
+
+from Benchmark import UniformScene
+from BVH import *
+from Camera import *
+from Graphics import CreateTexture, DestroyTexture
+from Renderer import *
+
+# temporal reprojection of the accumulated samples while the camera moves.
+# instead of clearing Accumulation, the first frame after a move looks every
+# pixel's first hit up in the previous view and carries that pixel's samples
+# over when the depth and normal found there agree. the math is
+# ReprojectHistory in Shaders/Reproject.glsl, Renderer.ReprojectHistory is its
+# CPU port. run on its own this checks the port and measures how much closer
+# to a converged image a sequence of small camera moves stays:
+#
+#   python TemporalReprojection.py
+#   PYOPENGL_PLATFORM=egl EGL_PLATFORM=surfaceless LIBGL_ALWAYS_SOFTWARE=1 python TemporalReprojection.py --gpu
+
+
+# the textures Shaders/Reproject.glsl reads and writes besides Accumulation.
+# the frame loop calls Save before a frame that reprojects, which copies what
+# the last frame left so the shader can read the old view while it writes
+# the new one
+class TemporalHistory:
+    def __init__(self, width: int, height: int):
+        self.width, self.height = width, height
+
+        # every pixel misses until a frame has been traced
+        misses = np.zeros((height, width, 4), dtype=np.float32)
+        misses[..., 3] = FLT_MAX
+
+        self.geometry = CreateTexture(width, height, misses)
+        self.accumulation = CreateTexture(width, height)
+        self.previousGeometry = CreateTexture(width, height, misses)
+
+    def Save(self, accumulation):
+        GL.glMemoryBarrier(GL.GL_TEXTURE_UPDATE_BARRIER_BIT)
+
+        for source, destination in ((accumulation, self.accumulation), (self.geometry, self.previousGeometry)):
+            GL.glCopyImageSubData(source, GL.GL_TEXTURE_2D, 0, 0, 0, 0, destination, GL.GL_TEXTURE_2D, 0, 0, 0, 0,
+                                  self.width, self.height, 1)
+
+    def BindImages(self):
+        GL.glBindImageTexture(3, self.geometry, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+        GL.glBindImageTexture(4, self.accumulation, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+        GL.glBindImageTexture(5, self.previousGeometry, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+
+    def Destroy(self):
+        for texture in (self.geometry, self.accumulation, self.previousGeometry):
+            DestroyTexture(texture)
+
+
+# spheres within about 20 units of the camera, as FrameResources.CheckOnGPU
+# uses, so float32 hits agree between the CPU and the shader
+def NearbySpheres(count: int) -> SphereSet:
+    spheres = SphereSet.FromObjects(UniformScene(count))
+    spheres.center[...] *= 0.1
+    spheres.radius[...] *= 0.3
+
+    return spheres
+
+def MakeCamera(width: int, height: int, position) -> Camera:
+    camera = Camera(90, width / height, 0.1, 100.0)
+    camera.position = glm.vec3(position)
+    camera.forward = glm.normalize(glm.vec3(0.4, -0.3, -1))
+
+    return camera
+
+# the camera nudged step units along its right vector move times, like a held
+# key in Camera.Update
+def CameraPath(width: int, height: int, moves: int, step: float) -> list:
+    start = MakeCamera(width, height, (0, 0, 5))
+    right = glm.normalize(glm.cross(start.forward, glm.vec3(0, 1, 0)))
+
+    return [MakeCamera(width, height, start.position + right * step * move) for move in range(moves + 1)]
+
+def RMSE(image: np.ndarray, reference: np.ndarray) -> float:
+    return float(np.sqrt(np.mean((image[..., :3] - reference[..., :3]) ** 2)))
+
+def MakeRenderer(bvh: BVH, spheres: SphereSet, camera: Camera, width: int, height: int) -> Renderer:
+    seeds = np.random.default_rng(0).integers(0, 0xFFFFFFFF, (height, width), dtype=np.uint32, endpoint=True)
+    return Renderer.FromArrays(bvh, spheres.colour, spheres.emission, camera,
+                               np.zeros((height, width, 4), dtype=np.float32), seeds)
+
+# warmup samples at the first camera of path, then one frame at each later
+# camera. returns the renderer at the end of the path
+def FollowPath(bvh, spheres, path: list, width: int, height: int, warmup: int, reproject: bool) -> Renderer:
+    renderer = MakeRenderer(bvh, spheres, path[0], width, height)
+    renderer.Render(warmup)
+
+    for camera in path[1:]:
+        renderer.MoveCamera(camera, reproject)
+        renderer.RenderFrame()
+
+    return renderer
+
+
+# reprojecting onto the same view has to carry every pixel's samples over,
+# capped at MaxHistory
+def CheckStill(bvh, spheres, width: int, height: int, warmup: int) -> int:
+    camera = MakeCamera(width, height, (0, 0, 5))
+
+    renderer = MakeRenderer(bvh, spheres, camera, width, height)
+    renderer.Render(warmup)
+    renderer.MoveCamera(MakeCamera(width, height, (0, 0, 5)), reproject=True)
+    renderer.RenderFrame()
+
+    samples = renderer.accumulation[..., 3]
+    kept = float(np.mean(samples == min(warmup, MAX_HISTORY) + 1))
+
+    print(f"still camera: {kept:.2%} of pixels kept their samples")
+
+    return 0 if kept == 1.0 else 1
+
+# the error against a converged image after the camera moved along a path,
+# with and without reprojection, and how many samples a still camera needs
+# to do as well as reprojection
+def BenchmarkPath(bvh, spheres, width: int, height: int, warmup: int, moves: int, step: float,
+                  referenceSamples: int) -> int:
+    path = CameraPath(width, height, moves, step)
+
+    reference = MakeRenderer(bvh, spheres, path[-1], width, height)
+    reference.Render(referenceSamples)
+    reference = reference.Image
+
+    start = time.perf_counter()
+    reprojected = FollowPath(bvh, spheres, path, width, height, warmup, True)
+    reprojectTime = time.perf_counter() - start
+
+    reset = FollowPath(bvh, spheres, path, width, height, warmup, False)
+
+    reprojectedError, resetError = RMSE(reprojected.Image, reference), RMSE(reset.Image, reference)
+    samples = reprojected.accumulation[..., 3]
+
+    fresh = MakeRenderer(bvh, spheres, path[-1], width, height)
+    freshError = RMSE(fresh.Image, reference)
+
+    while freshError > reprojectedError and fresh.frameIndex < referenceSamples:
+        fresh.RenderFrame()
+        freshError = RMSE(fresh.Image, reference)
+
+    print(f"{moves} moves of {step} after {warmup} samples, {width}x{height}, reference of {referenceSamples} samples")
+    print(f"  reset:       RMSE {resetError:.4f}, 1 sample per pixel")
+    print(f"  reprojected: RMSE {reprojectedError:.4f}, {np.mean(samples):.1f} samples per pixel on average, "
+          f"{np.mean(samples == 1):.1%} of pixels disoccluded, {reprojectTime:.2f}s")
+    print(f"  a still camera needs {fresh.frameIndex} samples for RMSE {freshError:.4f}")
+
+    return 0 if reprojectedError < resetError else 1
+
+
+# the same path through Launch.glsl on a headless context has to leave about
+# the image Renderer does
+def CheckOnGPU(bvh, spheres, width: int, height: int, warmup: int, moves: int, step: float) -> int:
+    from FrameResources import FrameResources, PackPerFrame, RunFrame
+    from GPUBVH import CreateHeadlessContext, FlattenForShader
+    from Graphics import GraphicsBuffer, ReadTexture
+    from ShaderCompiler import ShaderCompiler
+
+    CreateHeadlessContext()
+
+    shaders = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Shaders")
+    computeProgram = ShaderCompiler.Compile((os.path.join(shaders, "Launch.glsl"), GL.GL_COMPUTE_SHADER))
+    rasterProgram = ShaderCompiler.Compile((os.path.join(shaders, "Fragment.glsl"), GL.GL_FRAGMENT_SHADER),
+                                           (os.path.join(shaders, "Vertex.glsl"), GL.GL_VERTEX_SHADER))
+
+    nodes, primitiveIndices = FlattenForShader(bvh)
+    buffers = [GraphicsBuffer(spheres.data), GraphicsBuffer(nodes.view(np.float32)), GraphicsBuffer(primitiveIndices)]
+
+    for unit, buffer in zip((0, 2, 3), buffers):
+        buffer.BindUnit(unit)
+
+    renderer = MakeRenderer(bvh, spheres, None, width, height)
+
+    image, accumulation = CreateTexture(width, height), CreateTexture(width, height)
+    seedTexture = CreateTexture(width, height, renderer.seeds, GL.GL_R32UI, GL.GL_RED_INTEGER, GL.GL_UNSIGNED_INT)
+    history = TemporalHistory(width, height)
+
+    GL.glBindImageTexture(0, image, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(1, accumulation, 0, False, 0, GL.GL_READ_WRITE, GL.GL_RGBA32F)
+    GL.glBindImageTexture(2, seedTexture, 0, False, 0, GL.GL_READ_WRITE, GL.GL_R32UI)
+    history.BindImages()
+
+    target = CreateTexture(width, height)
+    framebuffer = GL.glGenFramebuffers(1)
+    GL.glBindFramebuffer(GL.GL_FRAMEBUFFER, framebuffer)
+    GL.glFramebufferTexture2D(GL.GL_FRAMEBUFFER, GL.GL_COLOR_ATTACHMENT0, GL.GL_TEXTURE_2D, target, 0)
+    GL.glViewport(0, 0, width, height)
+
+    path = CameraPath(width, height, moves, step)
+    resources = FrameResources()
+    groups = (-(-width // 16), -(-height // 16))
+
+    for frameIndex in range(1, warmup + 1):
+        block = PackPerFrame(path[0], 0, len(spheres), frameIndex, (width, height))
+        RunFrame(resources, computeProgram, rasterProgram, image, block, groups)
+
+    for previous, camera in zip(path, path[1:]):
+        history.Save(accumulation)
+        block = PackPerFrame(camera, 0, len(spheres), 1, (width, height), Reprojection(previous))
+        RunFrame(resources, computeProgram, rasterProgram, image, block, groups)
+
+    GL.glFinish()
+    gpuImage, gpuAccumulation = ReadTexture(image, width, height), ReadTexture(accumulation, width, height)
+
+    renderer.camera = path[0]
+    renderer.Render(warmup)
+
+    for camera in path[1:]:
+        renderer.MoveCamera(camera, reproject=True)
+        renderer.RenderFrame()
+
+    # the sample counts show whether both kept the same history, colours also
+    # differ wherever a grazing hit sent a path elsewhere in any frame
+    counts = float(np.mean(gpuAccumulation[..., 3] != renderer.accumulation[..., 3]))
+    differing = float(np.mean(np.abs(gpuImage[..., :3] - renderer.Image[..., :3]).max(axis=-1) > 1e-3))
+
+    print(f"{GL.glGetString(GL.GL_RENDERER).decode()}, after {moves} reprojected moves: {counts:.2%} of pixels "
+          f"have other sample counts than Renderer, {differing:.2%} other colours")
+
+    history.Destroy()
+    resources.Destroy()
+
+    # a pixel on the edge of the depth test can go either way. a colour flips
+    # if any of the warmup frames took another path at a grazing hit, about
+    # 0.4% of pixels each frame since bounces sample by cosine
+    return 0 if counts <= 0.005 and differing <= 0.2 else 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="check and measure temporal reprojection of accumulated samples")
+    parser.add_argument("--count", type=int, default=2000, help="spheres in the scene")
+    parser.add_argument("--width", type=int, default=96)
+    parser.add_argument("--height", type=int, default=72)
+    parser.add_argument("--warmup", type=int, default=64, help="samples before the camera starts to move")
+    parser.add_argument("--moves", type=int, default=8, help="frames the camera moves for")
+    parser.add_argument("--step", type=float, default=0.02, help="distance the camera moves per frame")
+    parser.add_argument("--reference", type=int, default=256, help="samples of the converged image")
+    parser.add_argument("--gpu", action="store_true", help="also run the path through the shader on a headless context")
+    args = parser.parse_args()
+
+    spheres = NearbySpheres(args.count)
+
+    bvh = BVH()
+    bvh.Build(spheres)
+
+    failures = CheckStill(bvh, spheres, args.width, args.height, args.warmup)
+    failures += BenchmarkPath(bvh, spheres, args.width, args.height, args.warmup, args.moves, args.step, args.reference)
+
+    if args.gpu:
+        failures += CheckOnGPU(bvh, spheres, args.width, args.height, args.warmup, args.moves, args.step)
+
+    sys.exit(1 if failures else 0)
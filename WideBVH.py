@@ -0,0 +1,339 @@
+import heapq
+import time
+
+import numpy as np
+
+from BVH import *
+from BVH import _AddStatistics
+
+# a BVH with up to width (4 or 8) children per node, collapsed from a built
+# binary BVH. the bounds of a node's children are stored together as (3,
+# width) planes, x of every child then y then z, so a ray is tested against
+# all of them with one slab test of whole rows.
+# TraceRay and TraceRays take and return the same as the BVH ones and find the
+# same hits, so either tree can be traced.
+#
+# every child slot is either an inner node (childNode >= 0) or a leaf
+# (childNode -1) whose childCount primitives start at childOffset in
+# primitiveIndices. unused slots are empty leaves with NaN bounds, which fail
+# every comparison of the slab test so no ray enters them.
+#
+# with quantization (8 or 16 bits) the child bounds are stored as integers on
+# a grid over the node's own box instead, origin + q * 2^exponent per axis.
+# minima are rounded down and maxima up, so a decoded box always contains the
+# real one and a ray can only enter more boxes, never miss a hit.
+
+
+# entry distance of the rays into every box, 0 from inside it and -1 on a
+# miss. the same comparisons as RaySlabs, the largest slab entry against the
+# smallest slab exit. minn and maxx are (..., 3, width) planes, origins and
+# reciprocals (..., 3, 1)
+def RayChildEntries(origins: np.ndarray, reciprocals: np.ndarray, minn: np.ndarray, maxx: np.ndarray) -> np.ndarray:
+    t0 = (minn - origins) * reciprocals
+    t1 = (maxx - origins) * reciprocals
+
+    lower = np.minimum(t0, t1)
+    upper = np.maximum(t0, t1)
+
+    tmin = np.maximum(np.maximum(lower[..., 0, :], lower[..., 1, :]), lower[..., 2, :])
+    tmax = np.minimum(np.minimum(upper[..., 0, :], upper[..., 1, :]), upper[..., 2, :])
+
+    return np.where((tmin <= tmax) & (tmax >= 0), np.maximum(tmin, 0), -1)
+
+
+class WideBVH:
+    def __init__(self, bvh: BVH, width: int = 4, quantization: int = None):
+        if width < 2:
+            raise ValueError("a wide BVH needs at least 2 children per node")
+
+        if quantization not in (None, 8, 16):
+            raise ValueError("child bounds are quantized to 8 or 16 bits")
+
+        self.width = width
+        self.quantization = quantization
+        self.objectData = bvh.objectData
+        self.primitiveIndices = bvh.primitiveIndices[:bvh.primitiveIndexCount].copy()
+        self._sphereArrays = bvh.SphereArrays() if bvh.primitiveIndexCount else None
+
+        start = time.perf_counter()
+        self._Collapse(bvh)
+
+        if quantization:
+            self._Quantize()
+
+        self.collapseTime = time.perf_counter() - start
+
+    @property
+    def nodeCount(self) -> int:
+        return len(self.childNode)
+
+    # bytes of the node arrays, primitive indices excluded
+    @property
+    def NodeMemoryUsage(self) -> int:
+        if self.quantization:
+            bounds = (self.nodeOrigin, self.nodeExponent, self.childMinQ, self.childMaxQ, self.childEmpty)
+        else:
+            bounds = (self.childMin, self.childMax)
+
+        return sum(a.nbytes for a in bounds + (self.childNode, self.childOffset, self.childCount))
+
+    @property
+    def MemoryUsage(self) -> int:
+        return self.NodeMemoryUsage + self.primitiveIndices.nbytes
+
+    # (minn, maxx) planes of the children of nodes, decoded from the grid when
+    # the bounds are quantized
+    def ChildBounds(self, nodes):
+        if not self.quantization:
+            return self.childMin[nodes], self.childMax[nodes]
+
+        origin = self.nodeOrigin[nodes]
+        scale = np.ldexp(np.float32(1), self.nodeExponent[nodes])
+
+        minn = origin + self.childMinQ[nodes] * scale
+        maxx = origin + self.childMaxQ[nodes] * scale
+
+        # one NaN plane is enough to fail the slab test
+        np.copyto(maxx, np.float32(np.nan), where=self.childEmpty[nodes])
+
+        return minn, maxx
+
+    def SphereArrays(self):
+        return self._sphereArrays
+
+    # every wide node starts as the two children of a binary inner node and
+    # opens its largest inner child until it has width children or only
+    # leaves, which keeps the boxes a ray is most likely to enter in one node
+    def _Collapse(self, bvh: BVH):
+        nodeCount = bvh.nodeCount
+        leftChild = bvh.leftChild[:nodeCount].tolist()
+        rightChild = bvh.rightChild[:nodeCount].tolist()
+        areas = SurfaceAreas(bvh.nodeMin[:nodeCount], bvh.nodeMax[:nodeCount]).tolist()
+
+        def Open(children: list) -> list:
+            while len(children) < self.width:
+                inner = [c for c in children if leftChild[c] >= 0]
+
+                if not inner:
+                    break
+
+                largest = max(inner, key=lambda c: areas[c])
+                children.remove(largest)
+                children += [leftChild[largest], rightChild[largest]]
+
+            return children
+
+        # a leaf root becomes the only child of the root
+        slots = [Open([leftChild[0], rightChild[0]]) if leftChild[0] >= 0 else [0]]
+        wideIndex = {}
+
+        for children in slots:
+            for child in children:
+                if leftChild[child] >= 0:
+                    wideIndex[child] = len(slots)
+                    slots.append(Open([leftChild[child], rightChild[child]]))
+
+        binary = np.full((len(slots), self.width), -1, dtype=np.int64)
+
+        for i, children in enumerate(slots):
+            binary[i, :len(children)] = children
+
+        used = binary >= 0
+        binary = np.where(used, binary, 0)
+
+        leaf = bvh.leftChild[binary] < 0
+        empty = ~used | (leaf & (bvh.primitiveCount[binary] == 0))
+
+        childMin = np.where(empty[..., None], np.float32(np.nan), bvh.nodeMin[binary]).astype(np.float32)
+        childMax = np.where(empty[..., None], np.float32(np.nan), bvh.nodeMax[binary]).astype(np.float32)
+
+        self.childMin = np.ascontiguousarray(childMin.transpose(0, 2, 1))
+        self.childMax = np.ascontiguousarray(childMax.transpose(0, 2, 1))
+
+        self.childNode = np.full(binary.shape, -1, dtype=np.int32)
+
+        inner = used & ~leaf
+        self.childNode[inner] = [wideIndex[c] for c in binary[inner].tolist()]
+
+        self.childOffset = np.where(leaf & ~empty, bvh.primitiveOffset[binary], 0).astype(np.int32)
+        self.childCount = np.where(leaf & ~empty, bvh.primitiveCount[binary], 0).astype(np.int32)
+
+    # replaces childMin and childMax by their grid coordinates. the grid step
+    # is a power of two no finer than a float32 step at the node's position,
+    # so every step of q moves the decoded value. bounds are rounded outwards
+    # in float64 first, then nudged until ChildBounds decodes them outside the
+    # real ones in float32
+    def _Quantize(self):
+        levels = (1 << self.quantization) - 1
+        dtype = np.uint8 if self.quantization == 8 else np.uint16
+
+        self.childEmpty = np.isnan(self.childMin[:, :1, :])
+
+        origin = np.fmin.reduce(self.childMin, axis=2, keepdims=True)
+        top = np.fmax.reduce(self.childMax, axis=2, keepdims=True)
+
+        # nodes without any primitive keep a unit grid at the world origin
+        origin = np.nan_to_num(origin, nan=0.0, posinf=0.0, neginf=0.0)
+        top = np.maximum(np.nan_to_num(top, nan=0.0, posinf=0.0, neginf=0.0), origin)
+
+        # one step of headroom at the top covers rounding when decoding
+        step = np.maximum((top.astype(np.float64) - origin) / (levels - 1), np.spacing(np.maximum(np.abs(origin), np.abs(top))))
+        exponent = np.ceil(np.log2(np.maximum(step, np.finfo(np.float32).tiny))).astype(np.int8)
+
+        scale = np.ldexp(1.0, exponent.astype(np.int32))
+
+        childMin = np.where(self.childEmpty, origin, self.childMin)
+        childMax = np.where(self.childEmpty, origin, self.childMax)
+
+        minQ = np.clip(np.floor((childMin - origin.astype(np.float64)) / scale), 0, levels)
+        maxQ = np.clip(np.ceil((childMax - origin.astype(np.float64)) / scale), 0, levels)
+
+        self.nodeOrigin = origin.astype(np.float32)
+        self.nodeExponent = exponent
+
+        decodeScale = np.ldexp(np.float32(1), exponent)
+
+        while True:
+            low = ((self.nodeOrigin + minQ.astype(np.float32) * decodeScale) > childMin) & (minQ > 0)
+            high = ((self.nodeOrigin + maxQ.astype(np.float32) * decodeScale) < childMax) & (maxQ < levels)
+
+            if not (low.any() or high.any()):
+                break
+
+            minQ = np.where(low, minQ - 1, minQ)
+            maxQ = np.where(high, maxQ + 1, maxQ)
+
+        self.childMinQ = minQ.astype(dtype)
+        self.childMaxQ = maxQ.astype(dtype)
+
+        del self.childMin, self.childMax
+
+    # closest hit, see BVH.TraceRay. children are pushed with their entry
+    # distances from one slab test per node and popped nearest first
+    def TraceRay(self, ray: Ray, rayObjectFunction, rayHitFunction=None, rayMissFunction=None, statistics=None):
+        counts = {"rays": 1, "nodesVisited": 0, "nodesPruned": 0, "primitiveTests": 0}
+
+        origin = np.array(ray.origin.to_list(), dtype=np.float32)[:, None]
+        reciprocal = np.array(ray.directionReciprocal.to_list(), dtype=np.float32)[:, None]
+
+        childNode, childOffset, childCount = self.childNode.ravel(), self.childOffset.ravel(), self.childCount.ravel()
+
+        heap = [(0.0, -1)]
+
+        minimumDistance = float("inf")
+        userData = None
+
+        while heap:
+            distance, slot = heapq.heappop(heap)
+
+            if distance > minimumDistance:
+                counts["nodesPruned"] += len(heap) + 1
+                break
+
+            counts["nodesVisited"] += 1
+            node = childNode[slot] if slot >= 0 else 0
+
+            if node < 0:
+                offset, count = childOffset[slot], childCount[slot]
+                counts["primitiveTests"] += int(count)
+
+                for leaf in self.primitiveIndices[offset:offset + count]:
+                    newDistance, newUserData = rayObjectFunction(ray, self.objectData[leaf].object)
+
+                    if 0 <= newDistance < minimumDistance:
+                        minimumDistance, userData = newDistance, newUserData
+
+                continue
+
+            entries = RayChildEntries(origin, reciprocal, *self.ChildBounds(node)).tolist()
+
+            for child, entry in enumerate(entries):
+                if entry < 0:
+                    continue
+
+                if entry > minimumDistance:
+                    counts["nodesPruned"] += 1
+                    continue
+
+                heapq.heappush(heap, (entry, node * self.width + child))
+
+        _AddStatistics(statistics, counts)
+
+        if minimumDistance == float("inf"):
+            if rayMissFunction:
+                return rayMissFunction(ray)
+        else:
+            if rayHitFunction:
+                return rayHitFunction(userData)
+
+        return None
+
+    # batched closest hit against spheres, see BVH.TraceRays. (ray, node)
+    # pairs test all children of the node at once
+    def TraceRays(self, origins, directions, batchSize: int = 65536, statistics=None):
+        origins = np.asarray(origins, dtype=np.float32).reshape(-1, 3)
+        directions = NormalizeDirections(directions)
+        reciprocals = ReciprocalDirections(directions)
+
+        distances = np.full(len(origins), np.inf)
+        primitives = np.full(len(origins), -1, dtype=np.int32)
+
+        if not len(self.primitiveIndices):
+            return distances, primitives
+
+        counts = {"rays": len(origins), "nodesVisited": 0, "nodesPruned": 0, "primitiveTests": 0}
+
+        for start in range(0, len(origins), batchSize):
+            rays = np.arange(start, min(start + batchSize, len(origins)))
+            self._TraceRayStream(rays, origins, directions, reciprocals, distances, primitives, counts)
+
+        _AddStatistics(statistics, counts)
+
+        return distances, primitives
+
+    def _TraceRayStream(self, rays, origins, directions, reciprocals, distances, primitives, counts):
+        centers, radii = self.SphereArrays()
+        childNode, childOffset, childCount = self.childNode.ravel(), self.childOffset.ravel(), self.childCount.ravel()
+
+        nodes = np.zeros(len(rays), dtype=np.int32)
+
+        while len(rays):
+            entries = RayChildEntries(origins[rays, :, None], reciprocals[rays, :, None], *self.ChildBounds(nodes))
+
+            hit = entries >= 0
+            closer = entries <= distances[rays, None]
+
+            counts["nodesPruned"] += int(np.count_nonzero(hit & ~closer))
+            pair, child = np.nonzero(hit & closer)
+
+            rays, slots = rays[pair], nodes[pair] * self.width + child
+            counts["nodesVisited"] += len(slots)
+
+            leaf = childNode[slots] < 0
+
+            leafRays, leafSlots = rays[leaf], slots[leaf]
+            leafCounts = childCount[leafSlots]
+
+            pairRays = np.repeat(leafRays, leafCounts)
+            counts["primitiveTests"] += len(pairRays)
+            firsts = np.repeat(childOffset[leafSlots] - np.cumsum(leafCounts) + leafCounts, leafCounts)
+            pairPrimitives = self.primitiveIndices[firsts + np.arange(len(pairRays))]
+
+            pairDistances = RaySphereIntersections(origins[pairRays], directions[pairRays],
+                                                   centers[pairPrimitives], radii[pairPrimitives])
+
+            valid = pairDistances >= 0
+            pairRays, pairPrimitives, pairDistances = pairRays[valid], pairPrimitives[valid], pairDistances[valid]
+
+            order = np.lexsort((pairDistances, pairRays))
+            pairRays, pairPrimitives, pairDistances = pairRays[order], pairPrimitives[order], pairDistances[order]
+
+            first = np.ones(len(pairRays), dtype=bool)
+            first[1:] = pairRays[1:] != pairRays[:-1]
+            pairRays, pairPrimitives, pairDistances = pairRays[first], pairPrimitives[first], pairDistances[first]
+
+            closer = pairDistances < distances[pairRays]
+            distances[pairRays[closer]] = pairDistances[closer]
+            primitives[pairRays[closer]] = pairPrimitives[closer]
+
+            rays, nodes = rays[~leaf], childNode[slots[~leaf]]